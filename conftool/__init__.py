@@ -7,13 +7,34 @@ import socket
 
 import yaml
 
-from pkg_resources import get_distribution, DistributionNotFound
-
+# Use the libyaml bindings, that are much faster, if available
 try:
-    __version__ = get_distribution(__name__).version
-    """The version of the installed conftool module."""
-except DistributionNotFound:
-    pass
+    from yaml import CSafeDumper as YamlDumper, CSafeLoader as YamlLoader
+except ImportError:  # pragma: no cover
+    from yaml import SafeDumper as YamlDumper, SafeLoader as YamlLoader
+
+
+def __getattr__(name):
+    """Look up the version of the installed conftool module only when it's needed."""
+    if name == "__version__":
+        try:
+            from importlib import metadata
+        except ImportError:  # python < 3.8
+            from pkg_resources import get_distribution, DistributionNotFound
+
+            try:
+                version = get_distribution(__name__).version
+            except DistributionNotFound:
+                version = None
+        else:
+            try:
+                version = metadata.version(__name__)
+            except metadata.PackageNotFoundError:
+                version = None
+        if version is not None:
+            globals()["__version__"] = version
+            return version
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 
 _log = logging.getLogger(__name__)
@@ -46,7 +67,9 @@ class IRCSocketHandler(logging.Handler):
             self.user = pwd.getpwuid(os.getuid())[0]
 
     def emit(self, record):
-        message = f"!log {self.user}@{socket.gethostname()} {record.getMessage()}"
+        # Records can name the user performing the action, e.g. for conftool-server
+        user = getattr(record, "user", None) or self.user
+        message = f"!log {user}@{socket.gethostname()} {record.getMessage()}"
         message = message.encode("utf-8")
 
         try:
@@ -102,14 +125,24 @@ def yaml_log_error(name, exc, critical):
         logger("Error parsing yaml file %s: %s", name, exc)
 
 
+def yaml_load(stream):
+    """Equivalent of yaml.safe_load, using libyaml if available."""
+    return yaml.load(stream, Loader=YamlLoader)
+
+
+def yaml_dump(data, stream=None, **kwargs):
+    """Equivalent of yaml.safe_dump, using libyaml if available."""
+    return yaml.dump(data, stream, Dumper=YamlDumper, **kwargs)
+
+
 def yaml_safe_load(filename, default=None):
-    """Wrapper around PyYAML safe_load with file loading and error handling.
+    """Wrapper around yaml_load with file loading and error handling.
     Returns the python object corresponding to the loaded YAML.
     """
 
     try:
         with open(filename, "r", encoding="utf-8") as file:
-            return yaml.safe_load(file)
+            return yaml_load(file)
     except (IOError, yaml.YAMLError) as exc:
         critical = default is None
         yaml_log_error(filename, exc, critical)
@@ -3,9 +3,7 @@ import shlex
 import subprocess
 import tempfile
 
-import yaml
-
-from conftool import yaml_safe_load, kvobject
+from conftool import yaml_dump, yaml_safe_load, kvobject
 
 
 config = {}
@@ -42,7 +40,6 @@ class GetAction:
         self.entity = obj
 
     def run(self):
-        self.entity.fetch()
         if self.entity.exists:
             return str(self.entity)
         else:
@@ -120,7 +117,7 @@ class EditAction(GetAction):
             f = open(self.temp, "wb")
         f.write("# Editing object {}\n".format(self.entity.pprint()).encode("utf-8"))
         self.entity.fetch()
-        yaml.safe_dump(self.entity._to_net(), stream=f, encoding="utf-8")
+        yaml_dump(self.entity._to_net(), stream=f, encoding="utf-8")
         f.close()
 
     def _edit(self):
@@ -134,13 +131,15 @@ class EditAction(GetAction):
 
 
 class SetAction:
-    def __init__(self, obj, act):
-        """Action to perform when editing an object"""
+    def __init__(self, obj, act, values=None):
+        """Action to perform when editing an object, with the values in act unless given"""
         self.entity = obj
         if not self.entity.exists:
             raise ActionError("Entity %s doesn't exist" % self.entity.name)
 
-        self.args = self._parse_action(act)
+        if values is None:
+            values = self._parse_action(act)
+        self.args = values
         self.description = ""
 
     def _parse_action(self, arg):
@@ -192,10 +191,11 @@ class SetAction:
             raise ActionValidationError("The provided data is not valid: %s" % e)
 
         desc = []
-        for k, v in self.args.items():
-            curval = getattr(self.entity, k)
-            if v != curval:
-                msg = "%s: %s changed %s => %s" % (self.entity.pprint(), k, curval, v)
-                desc.append(msg)
+        current = self.entity._to_net()
+        # update() will not write to the backend if nothing changed
         self.entity.update(self.args)
+        for k, v in self.entity._to_net().items():
+            if k in self.args and v != current.get(k):
+                msg = "%s: %s changed %s => %s" % (self.entity.pprint(), k, current.get(k), v)
+                desc.append(msg)
         return "\n".join(desc)
@@ -1,18 +1,19 @@
 import sys
-import os
-from conftool import _log
+from conftool import _log, drivers
+from conftool.drivers import instrumentation
 
 
 class Backend:
     def __init__(self, config):
         self.config = config
-        curr_dir = os.path.dirname(__file__)
-        driver_file = os.path.join(curr_dir, "drivers/{}.py".format(self.config.driver))
-        ctx = {}
         try:
-            exec(compile(open(driver_file).read(), driver_file, "exec"), ctx)
-            cls = ctx["Driver"]
+            cls, async_cls = drivers.get_driver(self.config.driver)
             self.driver = cls(config)
+            if instrumentation.is_enabled():
+                self.driver = instrumentation.InstrumentedDriver(self.driver)
+            self.async_driver = async_cls(
+                self.driver, max_workers=config.driver_options.get("async_workers")
+            )
         except Exception as e:
             _log.critical("Could not load driver %s: %s", self.config.driver, e, exc_info=True)
             sys.exit(3)
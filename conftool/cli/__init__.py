@@ -1,7 +1,12 @@
 """Simple conftool initialization class."""
 
+import argparse
+import atexit
+import sys
 from typing import Dict, Optional
+import conftool
 from conftool import configuration, setup_irc
+from conftool.drivers import instrumentation
 from conftool.kvobject import KVObject, Entity
 from conftool.loader import Schema
 
@@ -37,7 +42,7 @@ class ConftoolClient:
         if schema is not None:
             self.schema = Schema.from_data(schema)
         elif schemafile is not None:
-            self.schema = Schema.from_file(schemafile)
+            self.schema = Schema.from_file(schemafile, cache_path=self.configuration.cache_path)
         else:
             raise ValueError(
                 "Either a configfile or a configuration must be passed to ConftoolClient()"
@@ -54,3 +59,56 @@ class ConftoolClient:
             return self.schema.entities[entity_name]
         except KeyError as exc:
             raise ObjectTypeError(entity_name) from exc
+
+
+class VersionAction(argparse.Action):
+    """Like argparse's version action, but only looks up the version when requested."""
+
+    def __init__(
+        self, option_strings, dest=argparse.SUPPRESS, default=argparse.SUPPRESS, help=None
+    ):
+        super().__init__(
+            option_strings=option_strings,
+            dest=dest,
+            default=default,
+            nargs=0,
+            help=help or "show program's version number and exit",
+        )
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        print("{} {}".format(parser.prog, conftool.__version__))
+        parser.exit()
+
+
+def add_timings_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the options to report statistics about the calls to the datastore."""
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        default=False,
+        help="Print statistics about the calls to the datastore at exit",
+    )
+    parser.add_argument(
+        "--timings-json",
+        metavar="FILE",
+        default=None,
+        help="Save statistics about the calls to the datastore to FILE, as JSON, at exit",
+    )
+
+
+def setup_timings(args: argparse.Namespace) -> None:
+    """Instrument the drivers if requested, and report the statistics at exit.
+
+    Must be called before the backend is set up.
+    """
+    if not (args.timings or args.timings_json):
+        return
+    instrumentation.enable()
+    atexit.register(_report_timings, args.timings, args.timings_json)
+
+
+def _report_timings(summary: bool, filename: Optional[str]) -> None:
+    if summary:
+        print(instrumentation.stats.summary(), file=sys.stderr)
+    if filename is not None:
+        instrumentation.stats.dump(filename)
@@ -0,0 +1,269 @@
+"""
+Rolling depools and repools of nodes, as used by `confctl rolling`.
+
+The hosts of the selected nodes are split in batches, so that depooling a whole
+batch never leaves any service with more than the allowed fraction of its nodes
+depooled. The batches are then depooled, optionally restarted by a command, and
+repooled one at a time, possibly ramping their weight up over several steps.
+"""
+
+import math
+import os
+import shlex
+import subprocess
+import time
+
+from collections import Counter, defaultdict
+
+from conftool import _log
+from conftool.drivers import BackendError, WriteError
+from conftool.kvobject import KVObject
+
+
+class RollingError(Exception):
+    """Raised when a rolling operation can't go on."""
+
+
+def service_of(node):
+    """The path of the service of node, relative to the base path of nodes."""
+    return os.path.dirname(node.pprint())
+
+
+def plan(nodes, selected, batch_size=None, max_fraction=None):
+    """
+    Split the hosts of the selected nodes in batches, to be depooled together.
+
+    Only the selected nodes that are pooled are part of the batches. nodes is a
+    snapshot of all the nodes, used to count how many nodes of each service are
+    depooled already: with max_fraction, a batch never depools more than that
+    fraction of the nodes of any service, counting those. Without either limit,
+    hosts are depooled one at a time. Returns the list of batches, each a list of
+    nodes. Raises ValueError if some host can't be depooled at all.
+    """
+    allowed = None
+    if max_fraction is not None:
+        totals = Counter(service_of(node) for node in nodes)
+        down = Counter(service_of(node) for node in nodes if node.pooled != "yes")
+        allowed = {svc: math.floor(max_fraction * totals[svc]) - down[svc] for svc in totals}
+    elif batch_size is None:
+        batch_size = 1
+
+    hosts = defaultdict(list)
+    for node in selected:
+        if node.pooled == "yes":
+            hosts[node.name].append(node)
+
+    if allowed is not None:
+        unsafe = sorted(
+            {service_of(n) for ns in hosts.values() for n in ns if allowed[service_of(n)] < 1}
+        )
+        if unsafe:
+            raise ValueError(
+                "Depooling any node of {} would exceed the maximum fraction".format(
+                    ", ".join(unsafe)
+                )
+            )
+
+    batches = []
+    remaining = sorted(hosts)
+    while remaining:
+        batch = []
+        used = Counter()
+        skipped = []
+        for host in remaining:
+            services = Counter(service_of(node) for node in hosts[host])
+            if batch_size is not None and len(batch) >= batch_size:
+                fits = False
+            elif allowed is not None:
+                fits = all(used[svc] + n <= allowed[svc] for svc, n in services.items())
+            else:
+                fits = True
+            if fits:
+                batch.extend(hosts[host])
+                used.update(services)
+            else:
+                skipped.append(host)
+        batches.append(batch)
+        remaining = skipped
+    return batches
+
+
+def hostnames(batch):
+    return sorted({node.name for node in batch})
+
+
+class Rollout:
+    """
+    Depools and repools batches of nodes, one batch at a time.
+
+    Each batch is kept depooled for wait seconds, after which command, if any, is
+    run with the hostnames of the batch as arguments, and the batch is repooled.
+    The weight of the repooled nodes follows the ramp, a list of percentages of
+    their original weight, moving one step every ramp_interval seconds; the
+    next batch doesn't wait for the ramp to end, as its nodes are pooled already.
+    All the changes due at the same time are written in one go, and only if the
+    nodes weren't modified by anyone else since they were last read or written.
+    """
+
+    def __init__(self, batches, wait=0, command=None, ramp=(100,), ramp_interval=0, output=print):
+        self.batches = batches
+        self.wait = wait
+        self.command = command
+        self.ramp = ramp
+        self.ramp_interval = ramp_interval
+        self.output = output
+        # The original weights of the repooled nodes, by key
+        self.targets = {}
+        # The ramp steps still to be taken, as (time, nodes, percentage)
+        self.pending = []
+        # The keys of the nodes that couldn't be written, left alone from then on
+        self.failed = set()
+
+    def run(self):
+        """Run all the batches. Returns True on success."""
+        for i, batch in enumerate(self.batches, 1):
+            try:
+                self._write(batch, {"pooled": "no"})
+                self.output(
+                    "Batch {}/{}: depooled {}".format(
+                        i, len(self.batches), ", ".join(hostnames(batch))
+                    )
+                )
+                self._sleep(self.wait)
+                if self.command is not None:
+                    self._run_command(batch)
+                self._repool(batch)
+            except RollingError as e:
+                _log.error("Stopping at batch %d: %s", i, e)
+                _log.error("These hosts are left depooled: %s", ", ".join(hostnames(batch)))
+                return self._stop(batch)
+            except BackendError as e:
+                # Also raised if a node was modified by someone else
+                _log.error("Stopping at batch %d, failure writing to the kvstore: %s", i, e)
+                return self._stop(batch)
+        if self._finish_ramps():
+            return True
+        return self._stop([])
+
+    def _stop(self, batch):
+        """Take the ramp steps left, then report the state of batch. Returns False."""
+        self._finish_ramps()
+        self._report(batch)
+        return False
+
+    def _report(self, batch):
+        """Log the current state of the nodes of batch, and of those that failed."""
+        keys = {node.key for node in batch} | self.failed
+        nodes = [node for b in self.batches for node in b if node.key in keys]
+        _log.error("Check the state of these nodes:")
+        for node in nodes:
+            node.fetch()
+            if node.exists:
+                _log.error("  %s: pooled=%s, weight=%s", node.pprint(), node.pooled, node.weight)
+            else:
+                _log.error("  %s: could not be read", node.pprint())
+
+    def _weights(self, nodes, percent):
+        """The weights of nodes at a step of the ramp, never rounding a weight down to 0."""
+        weights = []
+        for node in nodes:
+            target = self.targets[node.key]
+            weights.append((node, max(1, round(target * percent / 100)) if target else 0))
+        return weights
+
+    def _repool(self, batch):
+        self.targets.update((node.key, node.weight) for node in batch)
+        changes = [
+            (node, {"pooled": "yes", "weight": w}) for node, w in self._weights(batch, self.ramp[0])
+        ]
+        try:
+            self._write_changes(changes)
+        finally:
+            # Even if some nodes failed, the others were repooled and need ramping up
+            now = time.monotonic()
+            for step, percent in enumerate(self.ramp[1:], 1):
+                self.pending.append((now + step * self.ramp_interval, batch, percent))
+            repooled = [node for node in batch if node.key not in self.failed]
+            if repooled:
+                self.output(
+                    "Repooled {} at {}% of the weight".format(
+                        ", ".join(hostnames(repooled)), self.ramp[0]
+                    )
+                )
+
+    def _due(self, now):
+        """Pop the ramp steps due at now, returning the changes they make."""
+        due = [step for step in self.pending if step[0] <= now]
+        self.pending = [step for step in self.pending if step[0] > now]
+        changes = []
+        for _, batch, percent in due:
+            nodes = [node for node in batch if node.key not in self.failed]
+            if not nodes:
+                continue
+            changes.extend((node, {"weight": w}) for node, w in self._weights(nodes, percent))
+            self.output(
+                "Ramped {} up to {}% of the weight".format(", ".join(hostnames(nodes)), percent)
+            )
+        return changes
+
+    def _write(self, nodes, values):
+        self._write_changes([(node, values) for node in nodes])
+
+    def _write_changes(self, changes):
+        """Write changes, with the ramp steps due, in a single batch."""
+        changes = self._due(time.monotonic()) + changes
+        if not changes:
+            return
+        try:
+            with KVObject.batch(strict=True):
+                for node, values in changes:
+                    for key, value in values.items():
+                        setattr(node, key, value)
+                    node.write()
+        except WriteError as e:
+            self.failed.update(e.errors)
+            raise
+        except BackendError:
+            # We can't know which of the changes were written
+            self.failed.update(node.key for node, _ in changes)
+            raise
+
+    def _sleep(self, seconds):
+        """
+        Sleep for seconds, taking the ramp steps that fall due meanwhile. Those due
+        at the end are left to the write that follows.
+        """
+        deadline = time.monotonic() + seconds
+        while True:
+            now = time.monotonic()
+            next_step = min((step[0] for step in self.pending), default=None)
+            if next_step is None or next_step >= deadline:
+                if deadline > now:
+                    time.sleep(deadline - now)
+                return
+            if next_step > now:
+                time.sleep(next_step - now)
+            self._write_changes([])
+
+    def _finish_ramps(self):
+        """Take the remaining ramp steps. Returns True if all of them were written."""
+        success = True
+        while self.pending:
+            try:
+                self._sleep(min(step[0] for step in self.pending) - time.monotonic())
+                self._write_changes([])
+            except BackendError as e:
+                # The nodes that failed are skipped from now on, the others go on
+                _log.error("Failure ramping up the weights: %s", e)
+                success = False
+        return success
+
+    def _run_command(self, batch):
+        cmd = shlex.split(self.command) + hostnames(batch)
+        _log.info("Running %s", " ".join(cmd))
+        try:
+            res = subprocess.run(cmd)
+        except OSError as e:
+            raise RollingError("Could not run {}: {}".format(self.command, e))
+        if res.returncode != 0:
+            raise RollingError("{} exited with status {}".format(self.command, res.returncode))
@@ -0,0 +1,290 @@
+"""
+conftool-server keeps a conftool session open, and serves requests over a Unix socket.
+
+The schema is loaded and the driver connected once, and if the driver supports
+it, reads are served from an in-memory snapshot of the data, which a background
+thread keeps synchronized by watching for changes.
+
+The protocol is line-based: every request is a JSON object on a single line,
+answered by a JSON object on a single line, with a boolean "success" and either
+a "result" or an "error". The requests are:
+
+* {"op": "get", "entity": ENTITY, "tags": [TAG, ...], "name": NAME}
+* {"op": "select", "entity": ENTITY, "selector": "tag=regex,..."}
+* {"op": "set", "entity": ENTITY, "selector": "tag=regex,...", "values": {...}}
+* {"op": "confctl", "argv": [ARG, ...], "config": FILE, "schema": FILE}, which
+  runs a confctl command as `confctl batch` would. The response has its
+  "messages" and the "log" of its warnings and errors instead of a result. This
+  is what confctl uses when it finds the socket of the server.
+
+The entity defaults to node. Changes are announced as performed by the user
+connected to the socket, so access to it must be restricted: the socket is only
+accessible to the user and group running the server.
+"""
+
+import argparse
+import json
+import logging
+import os
+import pwd
+import signal
+import socket
+import socketserver
+import struct
+import sys
+import threading
+
+from contextlib import contextmanager
+
+from conftool import _log, action, configuration, get_username
+from conftool.cli import ConftoolClient, ObjectTypeError, VersionAction
+from conftool.drivers import BackendError
+from conftool.kvobject import KVObject
+
+DEFAULT_SOCKET = "/run/conftool/conftool.sock"
+
+_irc = logging.getLogger("conftool.announce")
+
+
+class CapturedLogHandler(logging.Handler):
+    """Collects the warnings and errors logged by one thread."""
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.thread = threading.get_ident()
+        self.lines = []
+        self.setFormatter(logging.Formatter("%(levelname)s:%(name)s:%(message)s"))
+
+    def filter(self, record):
+        return record.thread == self.thread and record.name != _irc.name
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+
+
+@contextmanager
+def captured_logs():
+    handler = CapturedLogHandler()
+    _log.addHandler(handler)
+    try:
+        yield handler.lines
+    finally:
+        _log.removeHandler(handler)
+
+
+def peer_user(sock, claimed=None):
+    """
+    The name of the user connected to the socket. Only root can act on behalf of
+    the user it claims to be, as sudo users do.
+    """
+    try:
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+        _, uid, _ = struct.unpack("3i", creds)
+        user = pwd.getpwuid(uid).pw_name
+    except (AttributeError, OSError, KeyError):
+        return None
+    if uid == 0 and claimed:
+        return claimed
+    return user
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                response = self.server.dispatch(request, self.request)
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                response = {"success": False, "error": "Invalid request: {}".format(e)}
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, client, config_file, schema_file):
+        if os.path.exists(path):
+            # Left over by a previous run
+            os.unlink(path)
+        umask = os.umask(0o117)
+        try:
+            super().__init__(path, RequestHandler)
+        finally:
+            os.umask(umask)
+        self.client = client
+        # The files the client was set up with, that confctl must be using too
+        self.files = (os.path.abspath(config_file), os.path.abspath(schema_file))
+
+    def dispatch(self, request, sock):
+        op = getattr(self, "op_{}".format(request["op"]), None)
+        if op is None:
+            return {"success": False, "error": "Unknown operation {}".format(request["op"])}
+        user = peer_user(sock, request.get("user"))
+        try:
+            return op(request, user)
+        except ObjectTypeError as e:
+            return {"success": False, "error": "Object type {} is not available".format(e)}
+        except (BackendError, action.ActionError, ValueError) as e:
+            return {"success": False, "error": str(e)}
+
+    def _entity(self, request):
+        return self.client.get(request.get("entity", "node"))
+
+    def op_get(self, request, user):
+        obj = self._entity(request)(*request["tags"], request["name"])
+        if not obj.exists:
+            return {"success": False, "error": "{} not found".format(obj.pprint())}
+        return {"success": True, "result": obj.asdict()}
+
+    def op_select(self, request, user):
+        from conftool.cli.tool import parse_selector
+
+        query = parse_selector(request["selector"])
+        objects = self._entity(request).query(query, hydrate=True)
+        return {"success": True, "result": [obj.asdict() for obj in objects]}
+
+    def op_set(self, request, user):
+        from conftool.cli.tool import parse_selector
+
+        values = request["values"]
+        if not isinstance(values, dict):
+            raise ValueError("values must be an object")
+        query = parse_selector(request["selector"])
+        messages = []
+        with KVObject.batch():
+            for obj in self._entity(request).query(query, hydrate=True):
+                messages.append(action.SetAction(obj, None, values=values).run())
+        if messages:
+            _irc.warning(
+                "conftool action : set/%s; selector: %s",
+                ":".join("{}={}".format(k, v) for k, v in sorted(values.items())),
+                request["selector"],
+                extra={"user": user},
+            )
+        return {"success": True, "result": messages}
+
+    def op_confctl(self, request, user):
+        from conftool.cli.tool import ConfirmationNeededError, run_command
+
+        if (request.get("config"), request.get("schema")) != self.files:
+            return {"success": False, "fallback": True, "error": "Different configuration"}
+        response = {"success": False, "messages": []}
+        with captured_logs() as log:
+            try:
+                response["success"] = run_command(
+                    request["argv"], argparse.Namespace(), self.client, response["messages"], user
+                )
+            except ConfirmationNeededError as e:
+                response["error"] = str(e)
+                # The client can run the command itself only if nothing was changed yet
+                if e.units_run == 0:
+                    response["fallback"] = True
+            except SystemExit:
+                response["error"] = "Command aborted"
+        response["log"] = log
+        return response
+
+
+def watch(driver, timeout, stop):
+    """Keep the read cache of the driver synchronized until stop is set."""
+    while not stop.is_set():
+        try:
+            if not driver.watch_cache(timeout):
+                _log.info("The driver has no read cache, reads will go to the datastore")
+                return
+        except BackendError as e:
+            _log.error("Failed to synchronize the read cache: %s", e)
+            stop.wait(timeout)
+
+
+def remote_command(path, cmdline, args):
+    """
+    Run a confctl command via conftool-server listening at path, returning its
+    response, or None if the command must be run locally.
+    """
+    request = {
+        "op": "confctl",
+        "argv": cmdline,
+        "config": os.path.abspath(args.config),
+        "schema": os.path.abspath(args.schema),
+        "user": get_username(),
+    }
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(path)
+            sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            with sock.makefile("r", encoding="utf-8") as fh:
+                response = json.loads(fh.readline())
+    except (OSError, ValueError) as e:
+        _log.debug("Could not use conftool-server at %s: %s", path, e)
+        return None
+    if response.get("fallback", False):
+        _log.debug("conftool-server can't run the command: %s", response.get("error"))
+        return None
+    return response
+
+
+def parse_args(cmdline):
+    parser = argparse.ArgumentParser(
+        description="Keep a conftool session open, and serve requests over a Unix socket"
+    )
+    parser.add_argument("--version", action=VersionAction)
+    parser.add_argument("--config", help="Config file", default="/etc/conftool/config.yaml")
+    parser.add_argument(
+        "--schema",
+        default="/etc/conftool/schema.yaml",
+        help="Schema file that defines additional object types",
+    )
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, help="Path of the socket to listen on")
+    parser.add_argument(
+        "--watch-timeout",
+        type=float,
+        default=10,
+        help="How long to watch for changes before checking the snapshot of the data (seconds)",
+    )
+    parser.add_argument("--debug", action="store_true", default=False, help="print debug info")
+    return parser.parse_args(cmdline)
+
+
+def main(cmdline=None):
+    if cmdline is None:
+        cmdline = sys.argv[1:]
+    args = parse_args(cmdline)
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(name)s::%(funcName)s: %(message)s",
+        datefmt="%F %T",
+    )
+    try:
+        config = configuration.get(args.config)
+        # Serve the reads from a snapshot of the data, if the driver supports it
+        config = config._replace(driver_options=dict({"read_cache": True}, **config.driver_options))
+        client = ConftoolClient(config=config, schemafile=args.schema)
+    except configuration.ConfigurationError as e:
+        _log.critical("Invalid configuration: %s", e)
+        sys.exit(1)
+    if client.schema.has_errors:
+        _log.critical("The schema is broken, not starting")
+        sys.exit(1)
+
+    server = Server(args.socket, client, args.config, args.schema)
+    stop = threading.Event()
+    watcher = threading.Thread(
+        target=watch, args=(KVObject.backend.driver, args.watch_timeout, stop), daemon=True
+    )
+    watcher.start()
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    _log.info("Listening on %s", args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+        os.unlink(args.socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,8 @@ import logging
 import os
 import sys
 
-from conftool import __version__, _log, configuration, loader, yaml_safe_load
+from conftool import _log, configuration, loader, yaml_safe_load
+from conftool.cli import VersionAction, add_timings_arguments, setup_timings
 from conftool.kvobject import KVObject
 from conftool.drivers import BackendError
 
@@ -85,6 +86,15 @@ class Syncer:
             _log.info("Removing stale objects for %s", name)
             syncers[name].cleanup()
 
+        _log.info("Updating the index of the nodes of every host")
+        node = self.schema.entities["node"]
+        try:
+            node.update_index()
+        except BackendError as e:
+            # The data is synced anyway, and readers don't use a stale index
+            _log.error("Could not update the index of the nodes: %s", e)
+            node.invalidate_index()
+
 
 class EntitySyncer:
     def __init__(self, name, cls):
@@ -119,13 +129,14 @@ class EntitySyncer:
     def load(self):
         # Now we have all the data, let's translate those to tags/entities
         to_load, self.to_remove = self.get_changes(self.data)
-        for key in to_load:
-            tags = key.split("/")
+        objects = [self.cls.lazy(*key.split("/")) for key in to_load]
+        self.cls.fetch_many(objects)
+        for obj in objects:
+            key = obj.pprint()
             _log.debug("Loading %s:%s", self.entity, key)
-            obj = self.cls(*tags)
             if obj.exists:
                 # For some reason, the object already exists, do nothing
-                _log.warning("Not loading %s:%s: object already exists")
+                _log.warning("Not loading %s:%s: object already exists", self.entity, key)
                 continue
             _log.info("Creating %s with tags %s", self.entity, key)
             obj.write()
@@ -139,11 +150,11 @@ class EntitySyncer:
                     self.to_remove,
                 )
             return
-        for key in self.to_remove:
-            tags = key.split("/")
-            obj = self.cls(*tags)
+        objects = [self.cls.lazy(*key.split("/")) for key in self.to_remove]
+        self.cls.fetch_many(objects)
+        for obj in objects:
             if obj.exists:
-                _log.info("Removing %s with tags %s", self.entity, key)
+                _log.info("Removing %s with tags %s", self.entity, obj.pprint())
                 obj.delete()
 
     def get_changes(self, exp_data):
@@ -167,7 +178,7 @@ def get_args(args):
     parser = argparse.ArgumentParser(
         description="Tool to sync the declared " "configuration on-disk with the kvstore " "data"
     )
-    parser.add_argument("--version", action="version", version="%(prog)s " + __version__)
+    parser.add_argument("--version", action=VersionAction)
     parser.add_argument("--directory", help="Directory containing the files to sync")
     parser.add_argument(
         "--config", help="Optional configuration file", default="/etc/conftool/config.yaml"
@@ -178,6 +189,7 @@ def get_args(args):
         default="/etc/conftool/schema.yaml",
         help="Schema file that defines additional object types",
     )
+    add_timings_arguments(parser)
     return parser.parse_args(args)
 
 
@@ -198,6 +210,7 @@ def main(arguments=None):
         datefmt="%F %T",
     )
 
+    setup_timings(args)
     try:
         c = configuration.get(args.config)
         KVObject.setup(c)
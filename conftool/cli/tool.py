@@ -4,27 +4,60 @@ from __future__ import print_function
 
 import argparse
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext, redirect_stdout
+import copy
 import logging
 import json
 import os
 import re
+import shlex
 import socket
 import sys
 
-import yaml
-
-from conftool import __version__, _log, action, configuration, setup_irc
-from conftool.cli import ObjectTypeError, ConftoolClient
+from conftool import _log, action, configuration, setup_irc, yaml_dump
+from conftool.cli import (
+    ObjectTypeError,
+    ConftoolClient,
+    VersionAction,
+    add_timings_arguments,
+    rolling,
+    setup_timings,
+)
 from conftool.kvobject import KVObject
-from conftool.drivers import BackendError
+from conftool.drivers import BackendError, SERIALIZABLE, WriteError
+
+
+def parse_selector(selector):
+    """Parse a label selector in the form tag=regex,... to a query."""
+    query = {}
+    for tag in selector.split(","):
+        k, expr = tag.split("=", 1)
+        # All our selector are anchored regexes
+        query[k] = re.compile("^%s$" % expr)
+    return query
+
+
+class ConfirmationNeededError(Exception):
+    """Raised when a confirmation is needed but can't be asked for."""
+
+    # How many action units of the command had run already
+    units_run = 0
 
 
 class ToolCliBase:
-    def __init__(self, args):
+    def __init__(self, args, client=None):
         self.args = args
-        self.client = ConftoolClient(configfile=self.args.config, schemafile=self.args.schema)
+        if client is None:
+            client = ConftoolClient(configfile=self.args.config, schemafile=self.args.schema)
+        self.client = client
         self.entity = self.client.get(self.args.object_type)
         self.irc = logging.getLogger("conftool.announce")
+        # Where the results of the actions go, and if we can ask for confirmations
+        self.output = print
+        self.interactive = True
+        # The user to announce the actions as, if not the one running the process
+        self.user = None
 
     @property
     def tags(self):
@@ -32,32 +65,98 @@ class ToolCliBase:
 
     def announce(self):
         if self._action != "get" and not self.args.quiet:
-            self.irc.warning("conftool action : %s; selector: %s", self._action, self._namedef)
+            self.irc.warning(
+                "conftool action : %s; selector: %s",
+                self._action,
+                self._namedef,
+                extra={"user": self.user},
+            )
 
     def setup(self):
         c = configuration.get(self.args.config)
         KVObject.setup(c)
         setup_irc(c)
 
+    def check_interactive(self):
+        """Abort if a confirmation is needed but can't be asked for, as in batch mode."""
+        if not self.interactive:
+            raise ConfirmationNeededError("The selection needs a confirmation")
+
+    def consistency(self, read_only):
+        """
+        Context manager for the reads of a command: with --stale-ok, read-only
+        commands can be served stale data by any member of the cluster.
+        """
+        if not getattr(self.args, "stale_ok", False):
+            return nullcontext()
+        if not read_only:
+            _log.warning("Ignoring --stale-ok, as the command modifies data")
+            return nullcontext()
+        return KVObject.backend.driver.with_consistency(SERIALIZABLE)
+
+    @property
+    def parallel(self):
+        """The number of actions to run concurrently. Edits are interactive, so they never are."""
+        if self._action == "edit":
+            return 1
+        return max(getattr(self.args, "parallel", 1), 1)
+
+    def _run_on(self, obj):
+        """Run the action on obj, returning the message to print or None on failure."""
+        try:
+            a = action.get_action(obj, self._action)
+            return a.run()
+        except action.ActionError as e:
+            _log.error("Invalid action, reason: %s", str(e))
+        except BackendError as e:
+            _log.error("Error when trying to %s on %s", self._action, self._namedef)
+            _log.error("Failure writing to the kvstore: %s", str(e))
+        except Exception as e:
+            _log.error("Error when trying to %s on %s", self._action, self._namedef)
+            _log.exception("Generic action failure: %s", str(e))
+        return None
+
+    def _run_all(self, objects):
+        """Run the action on all objects, returning the results in the same order."""
+        if self.parallel == 1:
+            return [self._run_on(obj) for obj in objects]
+        # Workers must read at the consistency level, and write to the batch, of this thread
+        driver = KVObject.backend.driver
+        level = driver.read_consistency
+
+        @KVObject.bind_batch
+        def run_on(obj):
+            with driver.with_consistency(level):
+                return self._run_on(obj)
+
+        with ThreadPoolExecutor(self.parallel) as executor:
+            return list(executor.map(run_on, objects))
+
     def _run_action(self):
         fail = False
-        for obj in self.host_list():
-            try:
-                a = action.get_action(obj, self._action)
-                msg = a.run()
-            except action.ActionError as e:
-                fail = True
-                _log.error("Invalid action, reason: %s", str(e))
-            except BackendError as e:
-                fail = True
-                _log.error("Error when trying to %s on %s", self._action, self._namedef)
-                _log.error("Failure writing to the kvstore: %s", str(e))
-            except Exception as e:
+        objects = []
+        messages = []
+        failed_keys = set()
+        # Concurrent actions can't write by themselves, so their writes are sent together
+        batch = KVObject.batch() if self.parallel > 1 else nullcontext()
+        try:
+            with self.consistency(self._action == "get"), batch:
+                objects = list(self.host_list())
+                messages = self._run_all(objects)
+        except WriteError as e:
+            for key, error in sorted(e.errors.items()):
+                _log.error("Error when trying to %s on %s", self._action, key)
+                _log.error("Failure writing to the kvstore: %s", str(error))
+            failed_keys = set(e.errors)
+        except BackendError as e:
+            _log.error("Error when trying to %s on %s", self._action, self._namedef)
+            _log.error("Failure writing to the kvstore: %s", str(e))
+            return False
+        for obj, msg in zip(objects, messages):
+            if msg is None or obj.key in failed_keys:
                 fail = True
-                _log.error("Error when trying to %s on %s", self._action, self._namedef)
-                _log.exception("Generic action failure: %s", str(e))
             else:
-                print(msg)
+                self.output(msg)
         if not fail:
             self.announce()
             return True
@@ -66,8 +165,8 @@ class ToolCliBase:
 
 
 class ToolCli(ToolCliBase):
-    def __init__(self, args):
-        super().__init__(args)
+    def __init__(self, args, client=None):
+        super().__init__(args, client)
         self._tags = self.args.taglist.split(",")
 
     @property
@@ -85,7 +184,11 @@ class ToolCli(ToolCliBase):
         for objname in self._tagged_host_list():
             arguments = list(self.tags)
             arguments.append(objname)
-            yield self.entity(*arguments)
+            if self.parallel > 1:
+                # Objects are read by the workers running the actions
+                yield self.entity.lazy(*arguments)
+            else:
+                yield self.entity(*arguments)
 
     def _tagged_host_list(self):
         cur_dir = self.entity.dir(*self.tags)
@@ -95,9 +198,9 @@ class ToolCli(ToolCliBase):
             objlist = [k for (k, v) in all_objects]
             if self._action == "get":
                 if self.args.yaml:
-                    print(yaml.dump(dict(all_objects), default_flow_style=False))
+                    self.output(yaml_dump(dict(all_objects), default_flow_style=False))
                 else:
-                    print(json.dumps(dict(all_objects)))
+                    self.output(json.dumps(dict(all_objects)))
                 return []
             else:
                 retval = objlist
@@ -115,6 +218,7 @@ class ToolCli(ToolCliBase):
             retval = [objname for objname in objlist if r.match(objname)]
             warn = len(objlist) <= 2 * len(retval)
         if warn and self._action[0:3] in ["set", "del"]:
+            self.check_interactive()
             ToolCli.raise_warning()
         return retval
 
@@ -125,6 +229,7 @@ class ToolCli(ToolCliBase):
                 self._action,
                 self._namedef,
                 self._tags,
+                extra={"user": self.user},
             )
 
     def run_action(self, unit):
@@ -155,20 +260,17 @@ class ToolCli(ToolCliBase):
 class ToolCliByLabel(ToolCliBase):
     """Subclass used for the select mode"""
 
-    def __init__(self, args):
-        super().__init__(args)
+    def __init__(self, args, client=None):
+        super().__init__(args, client)
         self.selectors = {}
         self.parse_selectors()
 
     def parse_selectors(self):
-        for tag in self.args.selector.split(","):
-            k, expr = tag.split("=", 1)
-            # All our selector are anchored regexes
-            self.selectors[k] = re.compile("^%s$" % expr)
+        self.selectors.update(parse_selector(self.args.selector))
 
     def host_list(self):
         """Gets all the hosts matching our selectors"""
-        objects = [obj for obj in self.entity.query(self.selectors)]
+        objects = [obj for obj in self.entity.query(self.selectors, hydrate=True)]
         # Any selector that includes multiple objects will show a list of
         # host that have been selected
         if self._action != "get" and len(objects) > 1:
@@ -191,10 +293,11 @@ class ToolCliByLabel(ToolCliBase):
         if self.args.host and len(hosts_set) <= 1:
             # The host option is set and all objects belong to the same host
             return
+        self.check_interactive()
 
         print("The selector you chose has selected the following objects:")
         if self.args.yaml:
-            print(yaml.dump(tag_hosts, default_flow_style=False))
+            print(yaml_dump(dict(tag_hosts), default_flow_style=False))
         else:
             print(json.dumps(tag_hosts))
         print("Ok to continue? [y/N]")
@@ -212,7 +315,7 @@ class ToolCliSimpleAction(ToolCliByLabel):
         "drain": "set/weight=0",
     }
 
-    def __init__(self, args):
+    def __init__(self, args, client=None):
         if args.object_type != "node":
             _log.error("%s can only act on node objects", args.mode)
             sys.exit(1)
@@ -221,11 +324,18 @@ class ToolCliSimpleAction(ToolCliByLabel):
             args.selector += ",service={}".format(args.service)
         args.action = [self.simple_actions[args.mode]]
         args.mode = "select"
-        super().__init__(args)
+        super().__init__(args, client)
 
     def host_list(self):
         """Gets all the hosts matching our selectors"""
-        return [obj for obj in self.entity.query(self.selectors)]
+        # Look up the nodes of the host in the index, instead of scanning all of them
+        objects = None
+        if re.fullmatch(r"[\w.-]+", self.args.hostname):
+            objects = self.entity.from_index(self.args.hostname)
+        if objects is None:
+            return [obj for obj in self.entity.query(self.selectors, hydrate=True)]
+        service = self.selectors.get("service")
+        return [obj for obj in objects if service is None or service.match(obj.tags["service"])]
 
     @classmethod
     def add_subparsers(cls, subparsers):
@@ -247,13 +357,149 @@ class ToolCliSimpleAction(ToolCliByLabel):
             )
 
 
-def parse_args(cmdline):
+class ToolCliRolling(ToolCliBase):
+    """Subclass used for the rolling mode"""
+
+    def __init__(self, args, client=None):
+        if args.object_type != "node":
+            _log.error("%s can only act on node objects", args.mode)
+            sys.exit(1)
+        args.action = ["rolling"]
+        super().__init__(args, client)
+        self.selectors = parse_selector(self.args.selector)
+
+    @staticmethod
+    def parse_ramp(ramp):
+        """Parse the comma-separated percentages of a weight ramp."""
+        steps = [int(step) for step in ramp.split(",")]
+        if any(step <= 0 for step in steps) or steps != sorted(steps) or steps[-1] != 100:
+            raise ValueError("the steps must be increasing percentages, ending at 100")
+        return steps
+
+    def matches(self, obj):
+        for tag, regex in self.selectors.items():
+            if not regex.match(obj.name if tag == "name" else obj.tags.get(tag, "")):
+                return False
+        return True
+
+    def run_action(self, unit):
+        self._action = unit
+        self._namedef = self.args.selector
+        if self.args.batch_size is not None and self.args.batch_size < 1:
+            _log.error("The batch size must be at least 1")
+            return False
+        if self.args.max_fraction is not None and not 0 < self.args.max_fraction <= 1:
+            _log.error("The maximum fraction must be between 0 and 1")
+            return False
+        try:
+            ramp = self.parse_ramp(self.args.ramp)
+        except ValueError as e:
+            _log.error("Invalid weight ramp %s: %s", self.args.ramp, e)
+            return False
+        # The capacity checks all work on a single snapshot of the nodes
+        nodes = list(self.entity.query({}, hydrate=True))
+        try:
+            batches = rolling.plan(
+                nodes,
+                [obj for obj in nodes if self.matches(obj)],
+                batch_size=self.args.batch_size,
+                max_fraction=self.args.max_fraction,
+            )
+        except ValueError as e:
+            _log.error("Can't roll %s: %s", self._namedef, e)
+            return False
+        if not batches:
+            _log.warning("No pooled node matches %s", self._namedef)
+            return True
+        plan = [
+            "Batch {}: {}".format(i, ", ".join(rolling.hostnames(b)))
+            for i, b in enumerate(batches, 1)
+        ]
+        if self.args.dry_run:
+            for line in plan:
+                self.output(line)
+            return True
+        self.check_interactive()
+        print("The selected nodes will be depooled and repooled in these batches:")
+        print("\n".join(plan))
+        print("Ok to continue? [y/N]")
+        a = input("confctl>")
+        if a.lower() != "y":
+            print("Aborting")
+            sys.exit(1)
+        self.announce()
+        rollout = rolling.Rollout(
+            batches,
+            wait=self.args.wait,
+            command=self.args.command,
+            ramp=ramp,
+            ramp_interval=self.args.ramp_interval,
+            output=self.output,
+        )
+        return rollout.run()
+
+    @staticmethod
+    def add_subparser(subparsers):
+        parser = subparsers.add_parser(
+            "rolling", help="Depool and repool the selected nodes, a batch of hosts at a time"
+        )
+        parser.add_argument(
+            "selector",
+            help="Label selector in the form tag=regex: "
+            "dc=eqiad,cluster=cache_.*,service=nginx,name=.*.eqiad.wmnet",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            metavar="N",
+            default=None,
+            help="Depool up to N hosts at a time (default: 1, unless --max-fraction is given)",
+        )
+        parser.add_argument(
+            "--max-fraction",
+            type=float,
+            metavar="FRACTION",
+            default=None,
+            help="Never leave more than this fraction of the nodes of a service depooled",
+        )
+        parser.add_argument(
+            "--wait",
+            type=float,
+            default=0,
+            help="How long to keep each batch depooled (seconds)",
+        )
+        parser.add_argument(
+            "--command",
+            default=None,
+            help="Command to run while each batch is depooled, with its hostnames as arguments",
+        )
+        parser.add_argument(
+            "--ramp",
+            default="100",
+            help="Comma-separated percentages of the weight to repool the nodes with, "
+            "one step at a time, e.g. 10,50,100 (default: 100)",
+        )
+        parser.add_argument(
+            "--ramp-interval",
+            type=float,
+            default=60,
+            help="How long to wait between the steps of the weight ramp (seconds)",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            default=False,
+            help="Only show the batches the hosts would be depooled in",
+        )
+
+
+def parse_args(cmdline, namespace=None):
     parser = argparse.ArgumentParser(
         description="Tool to interact with the WMF config store",
         epilog="More details at" " <https://wikitech.wikimedia.org/wiki/conftool>.",
         fromfile_prefix_chars="@",
     )
-    parser.add_argument("--version", action="version", version="%(prog)s " + __version__)
+    parser.add_argument("--version", action=VersionAction)
     parser.add_argument("--config", help="Config file", default="/etc/conftool/config.yaml")
     parser.add_argument("--object-type", dest="object_type", default="node")
     parser.add_argument("--yaml", action="store_true", default=False, help="output values in YAML")
@@ -275,11 +521,38 @@ def parse_args(cmdline):
         default="/etc/conftool/schema.yaml",
         help="Schema file that defines additional object types",
     )
+    parser.add_argument(
+        "--stale-ok",
+        action="store_true",
+        dest="stale_ok",
+        default=False,
+        help="Allow get actions to read possibly stale data from any member of the cluster",
+    )
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        metavar="N",
+        default=1,
+        help="Run the actions on up to N objects concurrently (default: 1)",
+    )
+    parser.add_argument(
+        "--server-socket",
+        default="/run/conftool/conftool.sock",
+        help="Run the commands via conftool-server if it listens on this socket",
+    )
+    parser.add_argument(
+        "--local",
+        action="store_true",
+        default=False,
+        help="Run the commands in this process even if conftool-server is running",
+    )
+    add_timings_arguments(parser)
 
     # Subparsers for the various operating models
     simple_actions = "/".join(ToolCliSimpleAction.simple_actions.keys())
     subparsers = parser.add_subparsers(
-        help="Program mode: select, tags or {}".format(simple_actions), dest="mode"
+        help="Program mode: select, tags, batch, rolling or {}".format(simple_actions),
+        dest="mode",
     )
     subparsers.required = True
     # Tags mode
@@ -313,7 +586,24 @@ def parse_args(cmdline):
     )
     # POOL/DEPOOL/DRAIN/DECOMMISSION scripts
     ToolCliSimpleAction.add_subparsers(subparsers)
-    return parser.parse_args(cmdline)
+    ToolCliRolling.add_subparser(subparsers)
+    batch = subparsers.add_parser(
+        "batch", help="Run the select, tags or {} commands read from a file".format(simple_actions)
+    )
+    batch.add_argument(
+        "file",
+        nargs="?",
+        type=argparse.FileType("r"),
+        default="-",
+        help="File with one command per line (default: stdin)",
+    )
+    batch.add_argument(
+        "--read-cache",
+        action="store_true",
+        help="Serve the reads from a snapshot of the data kept up to date by the driver, "
+        "when it supports it",
+    )
+    return parser.parse_args(cmdline, namespace)
 
 
 def mangle_argv(cmdline):
@@ -325,6 +615,113 @@ def mangle_argv(cmdline):
     return cmdline
 
 
+def get_cli(args, client=None):
+    if args.mode == "select":
+        return ToolCliByLabel(args, client)
+    elif args.mode == "tags":
+        return ToolCli(args, client)
+    elif args.mode in ToolCliSimpleAction.simple_actions.keys():
+        return ToolCliSimpleAction(args, client)
+    elif args.mode == "rolling":
+        return ToolCliRolling(args, client)
+    else:
+        raise ValueError(args.mode)
+
+
+def run_batch(args):
+    """
+    Run the commands read from args.file, one per line, in a single session.
+
+    Each line is a select, tags or simple action command, as they would be passed
+    to confctl; options not given on the line are the ones of the batch command,
+    whose configuration and schema are used throughout. The result of each line
+    is printed as a JSON object. Returns the exit status.
+    """
+    config = configuration.get(args.config)
+    if args.read_cache:
+        config = config._replace(driver_options=dict(config.driver_options, read_cache=True))
+    client = ConftoolClient(config=config, schemafile=args.schema)
+    exit_status = 0
+    for lineno, line in enumerate(args.file, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        result = {"line": lineno, "command": line, "success": False, "messages": []}
+        # Anything the commands print besides their results goes to stderr
+        with redirect_stdout(sys.stderr):
+            try:
+                result["success"] = run_command(shlex.split(line), args, client, result["messages"])
+            except ObjectTypeError as e:
+                result["error"] = "Object type {} is not available in the current schema".format(e)
+            except ConfirmationNeededError as e:
+                result["error"] = str(e)
+            except (SystemExit, ValueError) as e:
+                # Invalid commands, or commands aborted with an error
+                result["error"] = str(e) if isinstance(e, ValueError) else "Command aborted"
+        if not result["success"]:
+            exit_status = 1
+        print(json.dumps(result), flush=True)
+    return exit_status
+
+
+def run_command(cmdline, args, client, messages, user=None):
+    """
+    Run a confctl command non-interactively with an existing client, on top of
+    the options in args. The messages it outputs are appended to messages, and
+    its actions are announced as performed by user, if given.
+
+    Returns True on success. If an action unit needs a confirmation, the
+    ConfirmationNeededError raised tells how many units had run before it.
+    """
+    cmd_args = parse_args(mangle_argv(cmdline), namespace=copy.copy(args))
+    if cmd_args.mode == "batch":
+        raise ValueError("Batch commands can't be nested")
+    if not cmd_args.action:
+        raise ValueError("No action given")
+    cli = get_cli(cmd_args, client)
+    cli.output = messages.append
+    cli.interactive = False
+    cli.user = user
+    success = True
+    for i, unit in enumerate(cmd_args.action):
+        try:
+            if not cli.run_action(unit):
+                success = False
+        except ConfirmationNeededError as e:
+            e.units_run = i
+            raise
+    return success
+
+
+def use_server(args):
+    """Check if the command can be run via conftool-server."""
+    # Rolling operations are long-running and need the terminal, so they run here
+    if args.local or args.mode in ["batch", "rolling"] or args.timings or args.timings_json:
+        return False
+    # Edits need the terminal
+    for unit in args.action or []:
+        act = unit[0] if isinstance(unit, list) else unit
+        if act == "edit":
+            return False
+    return os.path.exists(args.server_socket)
+
+
+def run_remote(args, cmdline):
+    """Run the command via conftool-server. Returns the exit status, or None if it can't."""
+    from conftool.cli import server
+
+    response = server.remote_command(args.server_socket, cmdline, args)
+    if response is None:
+        return None
+    for line in response.get("log", []):
+        print(line, file=sys.stderr)
+    if "error" in response:
+        _log.error(response["error"])
+    for msg in response["messages"]:
+        print(msg)
+    return 0 if response["success"] else 1
+
+
 def main(cmdline=None):
     if cmdline is None:
         cmdline = sys.argv[1:]
@@ -336,16 +733,22 @@ def main(cmdline=None):
         logging.basicConfig(level=logging.DEBUG)
     else:
         logging.basicConfig(level=logging.WARN)
+    setup_timings(args)
+
+    if use_server(args):
+        exit_status = run_remote(args, cmdline)
+        if exit_status is not None:
+            sys.exit(exit_status)
+
+    if args.mode == "batch":
+        try:
+            sys.exit(run_batch(args))
+        except configuration.ConfigurationError as e:
+            _log.critical("Invalid configuration: %s", e)
+            sys.exit(1)
 
     try:
-        if args.mode == "select":
-            cli = ToolCliByLabel(args)
-        elif args.mode == "tags":
-            cli = ToolCli(args)
-        elif args.mode in ToolCliSimpleAction.simple_actions.keys():
-            cli = ToolCliSimpleAction(args)
-        else:
-            raise ValueError(args.mode)
+        cli = get_cli(args)
     except ObjectTypeError:
         _log.critical("Object type %s is not available in the current schema", args.object_type)
         sys.exit(1)
@@ -1,5 +1,20 @@
 import functools
+import importlib
 import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+# Consistency levels of reads: linearizable reads always return the latest
+# committed data, serializable ones can be served by any member of the cluster,
+# without a round trip to the leader, and can thus return stale data.
+LINEARIZABLE = "linearizable"
+SERIALIZABLE = "serializable"
+CONSISTENCY_LEVELS = (LINEARIZABLE, SERIALIZABLE)
+
+# The value returned by versioned listings for the keys whose data can't be decoded
+MALFORMED = object()
 
 
 class BackendError(Exception):
@@ -10,9 +25,55 @@ class NotFoundError(BackendError):
     pass
 
 
+class ConflictError(BackendError):
+    """Raised when a conditional write finds the key modified since the given index."""
+
+
+class WriteError(BackendError):
+    """Raised when some of the writes sent together failed, with their errors by key."""
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__(
+            "Failed to write {} keys: {}".format(
+                len(errors), "; ".join("{}: {}".format(k, e) for k, e in sorted(errors.items()))
+            )
+        )
+
+
 class BaseDriver:
+    # Consistency of the reads if not set with the `consistency` driver option
+    default_consistency = LINEARIZABLE
+    # The maximum number of connections to each host, if the driver limits them
+    pool_size = None
+
     def __init__(self, config):
         self.base_path = os.path.join(config.namespace, config.api_version)
+        self.consistency = config.driver_options.get("consistency", self.default_consistency)
+        if self.consistency not in CONSISTENCY_LEVELS:
+            raise ValueError("Invalid consistency level {}".format(self.consistency))
+        self._local = threading.local()
+
+    @property
+    def read_consistency(self):
+        """The consistency level of the reads performed by the current thread."""
+        return getattr(self._local, "consistency", self.consistency)
+
+    @contextmanager
+    def with_consistency(self, level):
+        """
+        Context manager to perform the reads in the current thread at the given
+        consistency level. Drivers can ignore it, but those caching data must not
+        serve the reads asked to be linearizable this way from their caches.
+        """
+        if level not in CONSISTENCY_LEVELS:
+            raise ValueError("Invalid consistency level {}".format(level))
+        previous = self.read_consistency
+        self._local.consistency = level
+        try:
+            yield
+        finally:
+            self._local.consistency = previous
 
     def abspath(self, path):
         """
@@ -45,11 +106,42 @@ class BaseDriver:
         path in the form [(relative_path1, data1), (relative_path2, data2), ...]
         """
 
-    def write(self, key, value):
+    def all_data_versioned(self, path):
+        """
+        Same as all_data, but every tuple includes the index of the data read,
+        as returned by read_versioned. Drivers should return the value of keys
+        whose data can't be decoded as MALFORMED instead of failing the whole
+        listing, so that callers can deal with them one at a time.
+        """
+        return [(relpath, data, None) for relpath, data in self.all_data(path)]
+
+    def write(self, key, value, prev_index=None):
         """
         Write the value `value` to key `key`.
         Should return a dict with the key value written
+
+        If `prev_index` is not None, the write should only be performed if the key
+        wasn't modified since it was read at that index (0 meaning the key didn't exist),
+        raising ConflictError otherwise. Without it, the value is merged into the
+        current one. Drivers not supporting conditional writes can ignore it.
+        """
+
+    def write_many(self, items):
+        """
+        Write a list of (key, value, prev_index) tuples, each one as write() would,
+        and return the list of the results: for every item, either the value
+        written or the BackendError its write failed with.
+
+        Drivers can override this to send the writes together; if an exception is
+        raised, any subset of the writes might have been performed.
         """
+        results = []
+        for key, value, prev_index in items:
+            try:
+                results.append(self.write(key, value, prev_index=prev_index))
+            except BackendError as e:
+                results.append(e)
+        return results
 
     def delete(self, key):
         """
@@ -61,6 +153,13 @@ class BaseDriver:
         Read the value at `key` to a dict. Raises an exception on failure
         """
 
+    def read_versioned(self, key):
+        """
+        Read the value at `key`, returning a (data, index) tuple where index identifies
+        the version of the data read, or is None if the driver doesn't support it.
+        """
+        return (self.read(key), None)
+
     def ls(self, path):
         """
         returns a list of direct children of directory.
@@ -68,6 +167,148 @@ class BaseDriver:
         if not self.is_dir(path):
             raise ValueError("{} is not a directory".format(self.abspath(path)))
 
+    def http_pools(self):
+        """
+        Return the urllib3 pool managers the driver uses to talk to the datastore,
+        so that the requests can be instrumented.
+        """
+        return []
+
+    def watch_cache(self, timeout):
+        """
+        Wait up to timeout seconds for changes in the datastore, and bring the read
+        cache of the driver up to date with them, so that long-running processes
+        can keep it synchronized. Returns False if the driver has no read cache.
+        """
+        return False
+
+
+class AsyncDriver:
+    """
+    Asyncio interface to a driver.
+
+    This default implementation runs the calls to the synchronous driver in a
+    pool of threads, so that many of them can be in flight at the same time.
+    Driver modules can provide a native implementation as their AsyncDriver class.
+
+    Unless max_workers is given, there are as many threads as connections the
+    driver keeps open to each host, as more calls would just wait for one.
+    """
+
+    # Number of threads for drivers that don't limit their connections
+    default_workers = 32
+
+    def __init__(self, driver, max_workers=None):
+        self.driver = driver
+        if max_workers is None:
+            max_workers = driver.pool_size or self.default_workers
+        self.max_workers = max_workers
+        self._executor = None
+
+    @property
+    def executor(self):
+        # Only start threads if the asyncio interface is used
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_workers)
+        return self._executor
+
+    async def _call(self, method, *args, listing=False, **kwargs):
+        # Not imported at the top, so that synchronous users don't pay for it
+        import asyncio
+
+        # The calls happen in other threads, so pass along our consistency level
+        level = self.driver.read_consistency
+
+        def call():
+            with self.driver.with_consistency(level):
+                res = getattr(self.driver, method)(*args, **kwargs)
+                # Listings can be lazy, so consume them in the pool as well.
+                return list(res) if listing else res
+
+        return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+
+    async def is_dir(self, path):
+        return await self._call("is_dir", path)
+
+    async def all_keys(self, path):
+        return await self._call("all_keys", path, listing=True)
+
+    async def all_data(self, path):
+        return await self._call("all_data", path, listing=True)
+
+    async def all_data_versioned(self, path):
+        return await self._call("all_data_versioned", path, listing=True)
+
+    async def write(self, key, value, prev_index=None):
+        return await self._call("write", key, value, prev_index=prev_index)
+
+    async def write_many(self, items):
+        return await self._call("write_many", items)
+
+    async def delete(self, key):
+        return await self._call("delete", key)
+
+    async def read(self, key):
+        return await self._call("read", key)
+
+    async def read_versioned(self, key):
+        return await self._call("read_versioned", key)
+
+    async def ls(self, path):
+        return await self._call("ls", path, listing=True)
+
+
+def _entry_points(group):
+    try:
+        from importlib import metadata
+    except ImportError:  # python < 3.8
+        import pkg_resources
+
+        return list(pkg_resources.iter_entry_points(group))
+    eps = metadata.entry_points()
+    if hasattr(eps, "select"):
+        return list(eps.select(group=group))
+    return list(eps.get(group, []))
+
+
+# Driver name => (Driver class, AsyncDriver class), filled on first use
+_registry = {}
+
+
+def get_driver(name):
+    """
+    Return the (Driver, AsyncDriver) classes of the driver called `name`.
+
+    Drivers are the modules in this package defining a Driver class, and optionally
+    an AsyncDriver one. Other packages can provide drivers by declaring an entry
+    point in the `conftool.drivers` group, referring to either such a module or
+    to a driver class. Drivers are only imported when first requested.
+    """
+    if name in _registry:
+        return _registry[name]
+    module_name = "{}.{}".format(__name__, name)
+    try:
+        provider = importlib.import_module(module_name)
+    except ModuleNotFoundError as e:
+        # Only look for plugins if the module itself is missing, not one of its dependencies
+        if e.name != module_name:
+            raise
+        for entry_point in _entry_points("conftool.drivers"):
+            if entry_point.name == name:
+                provider = entry_point.load()
+                break
+        else:
+            raise ValueError("No driver named {}".format(name))
+    if isinstance(provider, type):
+        classes = (provider, AsyncDriver)
+    else:
+        try:
+            classes = (provider.Driver, getattr(provider, "AsyncDriver", AsyncDriver))
+        except AttributeError:
+            raise ValueError("{} does not define a driver".format(provider.__name__))
+    _registry[name] = classes
+    return classes
+
 
 def wrap_exception(exc):
     def actual_wrapper(fn):
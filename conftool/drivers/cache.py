@@ -0,0 +1,119 @@
+import json
+import os
+import tempfile
+
+from conftool import _log
+from conftool.drivers import NotFoundError
+
+
+class ReadCache:
+    """
+    Local snapshot of a subtree of the kv store, persisted to disk.
+
+    The snapshot records the store index it is up to date with, so that
+    drivers can bring it up to date by only applying what changed after it.
+    Values are stored as the raw strings found in the kv store.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.source = None
+        self.index = None
+        self.nodes = {}  # key => (raw value, modified index)
+        self.dirs = set()
+
+    def load(self):
+        """Load the snapshot from disk. Returns True on success."""
+        try:
+            with open(self.filename) as fh:
+                data = json.load(fh)
+            self.source = data["source"]
+            self.index = data["index"]
+            self.nodes = {key: tuple(node) for key, node in data["nodes"].items()}
+            self.dirs = set(data["dirs"])
+            return True
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            _log.warning("Discarding unreadable cache file %s: %s", self.filename, e)
+            self.reset(None, None)
+            return False
+
+    def save(self):
+        """Atomically save the snapshot to disk. Failures are only logged."""
+        data = {
+            "source": self.source,
+            "index": self.index,
+            "nodes": self.nodes,
+            "dirs": sorted(self.dirs),
+        }
+        dirname = os.path.dirname(self.filename)
+        try:
+            os.makedirs(dirname, mode=0o755, exist_ok=True)
+            fd, tmpfile = tempfile.mkstemp(dir=dirname, prefix=".tmp-")
+            # mkstemp creates the file readable only by us, as the snapshot should stay
+            with os.fdopen(fd, "w") as fh:
+                json.dump(data, fh)
+            os.replace(tmpfile, self.filename)
+        except OSError as e:
+            _log.debug("Could not save cache file %s: %s", self.filename, e)
+
+    def reset(self, source, index):
+        """Empty the snapshot."""
+        self.source = source
+        self.index = index
+        self.nodes = {}
+        self.dirs = set()
+
+    def set(self, key, value, index):
+        self.nodes[key] = (value, index)
+        self._add_parents(key)
+
+    def mkdir(self, key):
+        self.dirs.add(key)
+        self._add_parents(key)
+
+    def delete(self, key):
+        """Remove a key, or a directory and everything beneath it."""
+        prefix = key.rstrip("/") + "/"
+        self.nodes.pop(key, None)
+        self.dirs.discard(key)
+        for k in [k for k in self.nodes if k.startswith(prefix)]:
+            del self.nodes[k]
+        self.dirs = set(d for d in self.dirs if not d.startswith(prefix))
+
+    def read(self, key):
+        """Return the (raw value, index) tuple for a key."""
+        try:
+            return self.nodes[key]
+        except KeyError:
+            raise NotFoundError()
+
+    def is_dir(self, key):
+        return key.rstrip("/") in self.dirs
+
+    def children(self, key):
+        """Return a (key, raw value, index, is_dir) tuple for each direct child of key."""
+        parent = key.rstrip("/")
+        values = [
+            (k, value, index, False)
+            for k, (value, index) in sorted(self.nodes.items())
+            if os.path.dirname(k) == parent
+        ]
+        dirs = [(d, None, None, True) for d in sorted(self.dirs) if os.path.dirname(d) == parent]
+        return values + dirs
+
+    def leaves(self, key):
+        """Return a (key, raw value, index) tuple for each value beneath key."""
+        prefix = key.rstrip("/") + "/"
+        return [
+            (k, value, index)
+            for k, (value, index) in sorted(self.nodes.items())
+            if k.startswith(prefix)
+        ]
+
+    def _add_parents(self, key):
+        parent = os.path.dirname(key)
+        while parent not in ("/", "") and parent not in self.dirs:
+            self.dirs.add(parent)
+            parent = os.path.dirname(parent)
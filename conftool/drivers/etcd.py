@@ -1,10 +1,19 @@
 import json
 import os
+import socket
+import tempfile
+import threading
+import time
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 
 import etcd
 import urllib3
 
 from conftool import drivers, yaml_safe_load, _log
+from conftool.drivers.cache import ReadCache
 
 """
 
@@ -19,8 +28,43 @@ This driver will look at the following config files:
 
 read them as YAML files, and then pass every config switch found in there
 to python-etcd.
+
+If the driver option `read_cache` is true, reads are served from a snapshot
+of the whole namespace saved under `cache_path`, which is brought up to date
+at the first read by watching for the changes made since the snapshot's
+etcd index, one at a time. If etcd's index moved by more than
+`read_cache_max_replay` (default: 50), or if no change shows up within
+`read_cache_watch_timeout` (default: 1 second) because the index was advanced
+by keys outside of the namespace, the whole namespace is read again instead.
+Long-running processes can keep the snapshot synchronized with watch_cache().
+
+`write_concurrency` (default: 8) is the number of writes write_many() sends
+at the same time over the client's pool of connections.
+
+Reads are serializable by default, so they can be served by any cluster member;
+set the `consistency` driver option to `linearizable` to perform quorum reads.
+
+Connections to etcd are pooled and reused for the lifetime of the driver:
+
+* `pool_size` (default: python-etcd's per_host_pool_size) is the maximum number
+  of connections kept open to each cluster member. It should be at least as large
+  as `write_concurrency`, and it's the default number of threads serving the
+  asyncio interface (the `async_workers` option).
+* `keepalive` (default: false) enables TCP keep-alive on those connections, so
+  that idle ones aren't dropped by firewalls between parallel operations.
+* `read_affinity` (default: false) sends the serializable reads to the cluster
+  member answering the fastest, which is usually the one in the local datacenter.
+  Members are probed at startup, and the ranking is cached under
+  `cache_path`, or `~/.cache/conftool` if that can't be written, for
+  `read_affinity_ttl` seconds (default: 3600). Writes and quorum reads still go
+  to the configured hosts.
 """
 
+# python-etcd's default per_host_pool_size
+_DEFAULT_POOL_SIZE = 10
+# A node read from the read cache, quacking like an etcd.EtcdResult
+CachedNode = namedtuple("CachedNode", ["key", "value", "modifiedIndex", "dir"])
+
 
 def get_config(configfile):
     conf = {}
@@ -42,8 +86,18 @@ def get_config(configfile):
     return conf
 
 
+def _user_cache_path():
+    """The cache directory of the user, for the files that can't be saved under cache_path."""
+    # As in get_config, the home of the user we're sudoing as, if any
+    user_home = os.path.expanduser("~{}".format(os.environ.get("USER", "")))
+    return os.path.join(user_home, ".cache", "conftool")
+
+
 class Driver(drivers.BaseDriver):
     lock_ttl = 60
+    probe_timeout = 1
+    # python-etcd doesn't perform quorum reads unless asked to
+    default_consistency = drivers.SERIALIZABLE
 
     def __init__(self, config):
         super().__init__(config)
@@ -59,27 +113,173 @@ class Driver(drivers.BaseDriver):
                 "please set suppress_san_warnings to false in your driver configuration."
             )
 
+        if "pool_size" in config.driver_options:
+            driver_config["per_host_pool_size"] = config.driver_options["pool_size"]
         self.client = etcd.Client(**driver_config)
+        self.pool_size = driver_config.get("per_host_pool_size", _DEFAULT_POOL_SIZE)
+        if config.driver_options.get("keepalive", False):
+            self._enable_keepalive()
         super().__init__(config)
+        self.read_client = self.client
+        if config.driver_options.get("read_affinity", False):
+            ranking_files = [
+                os.path.join(path, "etcd-endpoints.json")
+                for path in (config.cache_path, _user_cache_path())
+            ]
+            ttl = config.driver_options.get("read_affinity_ttl", 3600)
+            endpoints = self._rank_endpoints(ranking_files, ttl)
+            if endpoints and endpoints[0] != self.client.base_uri:
+                self.read_client = self._client_for(endpoints[0], driver_config)
+        self.cache = None
+        self.cache_synced = False
+        self.cache_lock = threading.Lock()
+        if config.driver_options.get("read_cache", False):
+            self.cache = ReadCache(os.path.join(config.cache_path, "etcd-read-cache.json"))
+            self.cache_watch_timeout = config.driver_options.get("read_cache_watch_timeout", 1)
+            self.cache_max_replay = config.driver_options.get("read_cache_max_replay", 50)
+        self.write_concurrency = config.driver_options.get("write_concurrency", 8)
+
+    def _enable_keepalive(self):
+        """Turn on TCP keep-alive on the connections the client will open."""
+        options = urllib3.connection.HTTPConnection.default_socket_options + [
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        ]
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30))
+        self.client.http.connection_pool_kw["socket_options"] = options
+
+    def _rank_endpoints(self, ranking_files, ttl):
+        """
+        Return the client URLs of the cluster members, fastest first. The ranking is
+        read from the first of ranking_files that is fresh enough, else the members
+        are probed and the ranking is saved to the first of them that can be written.
+        """
+        source = "{}{}".format(self.client.expected_cluster_id, self.client.base_uri)
+        for ranking_file in ranking_files:
+            try:
+                with open(ranking_file) as fh:
+                    ranking = json.load(fh)
+                if ranking["source"] == source and ranking["expires"] > time.time():
+                    return ranking["endpoints"]
+            except (OSError, ValueError, KeyError, TypeError):
+                pass
+        try:
+            members = self.client.machines
+        except etcd.EtcdException as e:
+            _log.warning("Could not list the etcd cluster members: %s", e)
+            return []
+        latencies = {}
+        for member in members:
+            start = time.monotonic()
+            try:
+                self.client.http.request(
+                    "GET", member + "/version", timeout=self.probe_timeout, retries=False
+                )
+            except urllib3.exceptions.HTTPError as e:
+                _log.debug("Could not probe etcd member %s: %s", member, e)
+                continue
+            latencies[member] = time.monotonic() - start
+        endpoints = sorted(latencies, key=latencies.get)
+        _log.debug("etcd members by latency: %s", endpoints)
+        ranking = {"source": source, "expires": time.time() + ttl, "endpoints": endpoints}
+        for i, ranking_file in enumerate(ranking_files):
+            # Only the fallback locations are created if missing
+            if self._save_ranking(ranking_file, ranking, create_dir=i > 0):
+                break
+        return endpoints
+
+    @staticmethod
+    def _save_ranking(ranking_file, ranking, create_dir=False):
+        """Atomically save the ranking of the members to ranking_file. Returns True on success."""
+        tmpfile = None
+        try:
+            dirname = os.path.dirname(ranking_file)
+            if create_dir:
+                os.makedirs(dirname, mode=0o700, exist_ok=True)
+            fd, tmpfile = tempfile.mkstemp(dir=dirname, prefix=".tmp-")
+            with os.fdopen(fd, "w") as fh:
+                json.dump(ranking, fh)
+            os.chmod(tmpfile, 0o644)
+            os.replace(tmpfile, ranking_file)
+            return True
+        except (OSError, TypeError, ValueError) as e:
+            # Expected for the users who can't write to cache_path, so not worth a warning
+            _log.debug("Could not save the etcd members ranking to %s: %s", ranking_file, e)
+            if tmpfile is not None:
+                try:
+                    os.unlink(tmpfile)
+                except OSError:
+                    pass
+            return False
+
+    def _client_for(self, endpoint, driver_config):
+        """Return a client for endpoint only, sharing the pool of connections of ours."""
+        url = urlparse(endpoint)
+        client_config = dict(driver_config, protocol=url.scheme, host=url.hostname, port=url.port)
+        client_config.pop("srv_domain", None)
+        client_config["allow_reconnect"] = False
+        client = etcd.Client(**client_config)
+        client.http = self.client.http
+        return client
+
+    def _read(self, key, **kwdargs):
+        """
+        Perform a read at the current consistency level, on the closest member if
+        possible.
+        """
+        if self.read_consistency == drivers.LINEARIZABLE and not kwdargs.get("wait"):
+            kwdargs["quorum"] = True
+        if self.read_client is self.client or kwdargs.get("quorum"):
+            return self.client.read(key, **kwdargs)
+        try:
+            return self.read_client.read(key, **kwdargs)
+        except etcd.EtcdWatchTimedOut:
+            raise
+        except etcd.EtcdConnectionFailed as e:
+            _log.warning(
+                "Reading from %s failed (%s), reverting to the configured hosts",
+                self.read_client.base_uri,
+                e,
+            )
+            self.read_client = self.client
+            return self.client.read(key, **kwdargs)
+
+    def http_pools(self):
+        # The read client shares the same pool
+        return [self.client.http]
 
     @drivers.wrap_exception(etcd.EtcdException)
     def is_dir(self, path):
         p = self.abspath(path)
+        if self._use_cache(p):
+            return self.cache.is_dir(p)
         try:
-            res = self.client.read(p)
+            res = self._read(p)
             return res.dir
         except etcd.EtcdKeyNotFound:
             return False
 
-    @drivers.wrap_exception(etcd.EtcdException)
     def read(self, path):
+        return self.read_versioned(path)[0]
+
+    @drivers.wrap_exception(etcd.EtcdException)
+    def read_versioned(self, path):
         key = self.abspath(path)
         res = self._fetch(key)
-        return self._data(res)
+        return (self._data(res), res.modifiedIndex)
 
     @drivers.wrap_exception(etcd.EtcdException)
-    def write(self, path, value):
+    def write(self, path, value, prev_index=None):
         key = self.abspath(path)
+        if prev_index is not None:
+            try:
+                return self._write_if_unchanged(key, value, prev_index)
+            except (etcd.EtcdCompareFailed, etcd.EtcdAlreadyExist):
+                raise drivers.ConflictError(
+                    "{} was modified since index {}".format(key, prev_index)
+                )
+            finally:
+                self.cache_synced = False
         try:
             res = self._fetch(key, quorum=True)
             old_value = json.loads(res.value)
@@ -89,53 +289,210 @@ class Driver(drivers.BaseDriver):
         except drivers.NotFoundError:
             val = json.dumps(value)
             self.client.write(key, val, prevExist=False)
+        finally:
+            self.cache_synced = False
+
+    def write_many(self, items):
+        """
+        Send the writes concurrently. etcd v2 has no multi-key transactions, so all
+        writes are attempted, and each one succeeds or fails on its own.
+        """
+        if len(items) < 2:
+            return super().write_many(items)
+        with ThreadPoolExecutor(min(len(items), self.write_concurrency)) as executor:
+            futures = [
+                executor.submit(self.write, key, value, prev_index=prev_index)
+                for key, value, prev_index in items
+            ]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except drivers.BackendError as e:
+                results.append(e)
+        return results
 
     def ls(self, path, recursive=False):
         """Given a path, returns a tuple (key, data) for each value found"""
-        objects = self._ls(path, recursive=recursive)
-        fullpath = self.abspath(path) + "/"
-        return [(el.key.replace(fullpath, ""), self._data(el)) for el in objects]
+        return [(relpath, self._data(el)) for relpath, el in self._walk(path, recursive, True)]
 
     def all_keys(self, path):
-        # The full path we're searching in
-        base_path = self.abspath(path) + "/"
-
-        def split_path(p):
-            """Strip the root path and normalize elements"""
-            r = p.replace(base_path, "").replace("//", "/")
-            return r.split("/")
-
-        return [split_path(el.key) for el in self._ls(path, recursive=True) if not el.dir]
+        # Keys only, no need to decode the values
+        return [relpath.replace("//", "/").split("/") for relpath, _ in self._walk(path)]
 
     def all_data(self, path):
         """Return a (path, object) tuple for all the objects"""
-        base_path = self.abspath(path) + "/"
+        return [(relpath, self._data(el)) for relpath, el in self._walk(path)]
+
+    def all_data_versioned(self, path):
+        """Return a (path, object, index) tuple for all the objects"""
         return [
-            (obj.key.replace(base_path, ""), self._data(obj))
-            for obj in self._ls(path, recursive=True)
-            if not obj.dir
+            (relpath, self._listed_data(el), el.modifiedIndex) for relpath, el in self._walk(path)
         ]
 
+    def _walk(self, path, recursive=True, dirs=False):
+        """
+        Lazily yield a (relative path, node) tuple for each node under path, from a
+        single read. Values are left encoded, so they're only decoded if needed.
+        """
+        nodes = self._ls(path, recursive=recursive)
+        prefix = self.abspath(path).rstrip("/") + "/"
+        return ((el.key.replace(prefix, "", 1), el) for el in nodes if dirs or not el.dir)
+
     @drivers.wrap_exception(etcd.EtcdException)
     def _ls(self, path, recursive=False):
         key = self.abspath(path)
+        if self._use_cache(key):
+            if not self.cache.is_dir(key):
+                raise ValueError("{} is not a directory".format(key))
+            if recursive:
+                return [CachedNode(k, v, idx, False) for k, v, idx in self.cache.leaves(key)]
+            return [CachedNode(*child) for child in self.cache.children(key)]
         try:
-            res = self.client.read(key, recursive=recursive)
+            res = self._read(key, recursive=recursive)
         except etcd.EtcdException:
             raise ValueError("{} is not a directory".format(key))
-        return [el for el in res.leaves if el.key != key]
+        return (el for el in res.leaves if el.key != key)
 
     @drivers.wrap_exception(etcd.EtcdException)
     def delete(self, path):
         key = self.abspath(path)
         self.client.delete(key)
+        self.cache_synced = False
+
+    def _write_if_unchanged(self, key, value, prev_index):
+        """Write the full value, only if the key is still at prev_index."""
+        val = json.dumps(value)
+        if prev_index == 0:
+            res = self.client.write(key, val, prevExist=False)
+        else:
+            res = self.client.write(key, val, prevIndex=prev_index)
+        return self._data(res)
 
     def _fetch(self, key, **kwdargs):
+        if not kwdargs and self._use_cache(key):
+            if self.cache.is_dir(key):
+                return CachedNode(key, None, None, True)
+            return CachedNode(key, *self.cache.read(key), False)
         try:
-            return self.client.read(key, **kwdargs)
+            return self._read(key, **kwdargs)
         except etcd.EtcdKeyNotFound:
             raise drivers.NotFoundError()
 
+    @drivers.wrap_exception(etcd.EtcdException)
+    def watch_cache(self, timeout):
+        if self.cache is None:
+            return False
+        self._use_cache(self.base_path)
+        kwargs = {}
+        if self.cache.index is not None:
+            kwargs["waitIndex"] = self.cache.index + 1
+        try:
+            self._read(self.base_path, recursive=True, wait=True, timeout=timeout, **kwargs)
+        except (etcd.EtcdWatchTimedOut, etcd.EtcdEventIndexCleared, etcd.EtcdKeyNotFound):
+            # Either nothing changed, or the sync will reload the whole snapshot
+            pass
+        with self.cache_lock:
+            self._sync_cache()
+        return True
+
+    def _use_cache(self, key):
+        """Check if a read of key can be served from the read cache, syncing it if needed."""
+        if self.cache is None:
+            return False
+        if key != self.base_path and not key.startswith(self.base_path + "/"):
+            return False
+        if getattr(self._local, "consistency", None) == drivers.LINEARIZABLE:
+            # Explicitly asked for up to date data, e.g. to resolve a conflict
+            return False
+        if not self.cache_synced:
+            with self.cache_lock:
+                if not self.cache_synced:
+                    self._sync_cache()
+        return True
+
+    def _sync_cache(self):
+        """Bring the read cache up to date with etcd."""
+        if self.cache.index is None:
+            self.cache.load()
+        # A non-recursive read is cheap, and tells us the current etcd index
+        try:
+            res = self._read(self.base_path)
+        except etcd.EtcdKeyNotFound:
+            # Nothing to cache (yet)
+            self.cache.reset(None, None)
+            self.cache_synced = True
+            return
+        source = "{}{}".format(self.client.expected_cluster_id, self.base_path)
+        current = res.etcd_index
+        if self.cache.source != source or self.cache.index is None or self.cache.index > current:
+            self._reload_cache(source)
+        elif current - self.cache.index > self.cache_max_replay:
+            _log.debug("Too many changes since index %d, reloading", self.cache.index)
+            self._reload_cache(source)
+        elif self.cache.index < current:
+            _log.debug("Updating the read cache from index %d to %d", self.cache.index, current)
+            try:
+                self._replay_cache_events(current)
+            except etcd.EtcdEventIndexCleared:
+                _log.debug("Too many changes since index %d, reloading", self.cache.index)
+                self._reload_cache(source)
+            except etcd.EtcdWatchTimedOut:
+                # The rest happened outside of our namespace, and waiting for
+                # it again at every start would be slower than reloading
+                _log.debug("No more changes in the namespace up to index %d, reloading", current)
+                self._reload_cache(source)
+        else:
+            self.cache_synced = True
+            return
+        self.cache.save()
+        self.cache_synced = True
+
+    def _reload_cache(self, source):
+        res = self._read(self.base_path, recursive=True)
+        cache = ReadCache(self.cache.filename)
+        cache.reset(source, res.etcd_index)
+        cache.mkdir(self.base_path)
+        for el in res.leaves:
+            if el.key == self.base_path:
+                continue
+            if el.dir:
+                cache.mkdir(el.key)
+            else:
+                cache.set(el.key, el.value, el.modifiedIndex)
+        # Other threads can keep reading from the old snapshot until it's replaced
+        self.cache = cache
+
+    def _replay_cache_events(self, current):
+        """
+        Apply to the cache all the changes in our namespace up to index current.
+        Raises EtcdWatchTimedOut if the last ones happened outside of it.
+        """
+        index = self.cache.index
+        while index < current:
+            event = self._read(
+                self.base_path,
+                recursive=True,
+                wait=True,
+                waitIndex=index + 1,
+                timeout=self.cache_watch_timeout,
+            )
+            if event.action in ("delete", "expire", "compareAndDelete"):
+                self.cache.delete(event.key)
+            elif event.dir:
+                self.cache.mkdir(event.key)
+            else:
+                self.cache.set(event.key, event.value, event.modifiedIndex)
+            index = event.modifiedIndex
+        self.cache.index = max(index, current)
+
+    def _listed_data(self, etcdresult):
+        """Decode the value of a listed key, returning MALFORMED if it can't be."""
+        try:
+            return self._data(etcdresult)
+        except drivers.BackendError:
+            return drivers.MALFORMED
+
     def _data(self, etcdresult):
         if etcdresult is None or etcdresult.dir:
             return None
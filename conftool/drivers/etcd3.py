@@ -0,0 +1,306 @@
+import base64
+import json
+
+import urllib3
+
+from conftool import drivers, _log
+
+"""
+
+Driver for the etcd v3 API, through its JSON gateway.
+
+It connects to the hosts in the conftool configuration, trying them in order,
+and accepts the following driver options:
+
+* `ca_cert`, `cert`, `key`: TLS files to use for the connection
+* `username`, `password`: credentials to authenticate with; the auth token is
+  renewed when etcd rejects it
+* `timeout` (default: 10): timeout of each request, in seconds
+* `api_prefix` (default: '/v3'): prefix of the gateway's endpoints
+* `page_size` (default: 1000): number of keys to fetch with each range read
+* `max_txn_ops` (default: 128): the maximum number of operations per transaction,
+  as configured on the etcd server
+* `consistency` (default: 'linearizable'): set to 'serializable' to let any member
+  serve the reads, without going through the leader
+
+The v3 keyspace is flat: directories are just the common prefixes of keys.
+Indexes returned by read_versioned are the keys' mod revisions.
+"""
+
+
+def _b64(data):
+    return base64.b64encode(data.encode("utf-8")).decode("ascii")
+
+
+def _unb64(data):
+    return base64.b64decode(data).decode("utf-8")
+
+
+def _prefix_end(prefix):
+    """The end of the range of keys starting with prefix."""
+    # Prefixes are /-terminated strings, so incrementing the last byte is safe
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class Driver(drivers.BaseDriver):
+    # Retries of a transaction if the keys keep changing under us
+    txn_retries = 5
+
+    def __init__(self, config):
+        super().__init__(config)
+        options = config.driver_options
+        self.hosts = [host.rstrip("/") for host in config.hosts]
+        self.api_prefix = options.get("api_prefix", "/v3")
+        self.page_size = options.get("page_size", 1000)
+        self.max_txn_ops = options.get("max_txn_ops", 128)
+        self.timeout = options.get("timeout", 10)
+        self.http = urllib3.PoolManager(
+            ca_certs=options.get("ca_cert"),
+            cert_file=options.get("cert"),
+            key_file=options.get("key"),
+            retries=False,
+        )
+        self.credentials = None
+        if options.get("username"):
+            self.credentials = {"name": options["username"], "password": options["password"]}
+        self.token = None
+
+    def http_pools(self):
+        return [self.http]
+
+    def is_dir(self, path):
+        prefix = self.abspath(path).rstrip("/") + "/"
+        res = self._post(
+            "kv/range",
+            self._read_request(
+                {"key": _b64(prefix), "range_end": _b64(_prefix_end(prefix)), "count_only": True}
+            ),
+        )
+        return int(res.get("count", 0)) > 0
+
+    def read(self, path):
+        return self.read_versioned(path)[0]
+
+    def read_versioned(self, path):
+        key = self.abspath(path)
+        res = self._post("kv/range", self._read_request({"key": _b64(key)}))
+        if not res.get("kvs"):
+            raise drivers.NotFoundError()
+        kv = res["kvs"][0]
+        return (self._data(kv), int(kv["mod_revision"]))
+
+    def write(self, path, value, prev_index=None):
+        res = self._write_chunk([(path, value, prev_index)])[0]
+        if isinstance(res, drivers.BackendError):
+            raise res
+        return res
+
+    def write_many(self, items):
+        """
+        Write the items in etcd transactions, atomically if they fit in a single one:
+        if a transaction fails, all of its items fail with the same error.
+
+        Writes with a prev_index fail with a ConflictError if their key isn't at
+        that revision anymore, without affecting the others. The other values are
+        merged into the current ones read in a consistent snapshot, and written
+        only if none of the keys changed in the meantime.
+        """
+        results = []
+        for start in range(0, len(items), self.max_txn_ops):
+            end = start + self.max_txn_ops
+            chunk = items[start:end]
+            try:
+                results.extend(self._write_chunk(chunk))
+            except drivers.BackendError as e:
+                # Nothing in the transaction was written
+                results.extend([e] * len(chunk))
+        return results
+
+    def delete(self, path):
+        key = self.abspath(path)
+        res = self._post("kv/deleterange", {"key": _b64(key)})
+        if not int(res.get("deleted", 0)):
+            raise drivers.NotFoundError()
+
+    def ls(self, path, recursive=False):
+        """Given a path, returns a tuple (key, data) for each value found"""
+        if recursive:
+            return self.all_data(path)
+        children = {}
+        for relpath, kv in self._range(path):
+            name, _, rest = relpath.partition("/")
+            if rest:
+                # A "directory"
+                children.setdefault(name, None)
+            else:
+                children[name] = self._data(kv)
+        if not children:
+            raise ValueError("{} is not a directory".format(self.abspath(path)))
+        return list(children.items())
+
+    def all_keys(self, path):
+        return [relpath.split("/") for relpath, _ in self._range(path, keys_only=True)]
+
+    def all_data(self, path):
+        """Return a (path, object) tuple for all the objects"""
+        return [(relpath, self._data(kv)) for relpath, kv in self._range(path)]
+
+    def all_data_versioned(self, path):
+        """Return a (path, object, index) tuple for all the objects"""
+        return [
+            (relpath, self._listed_data(kv), int(kv["mod_revision"]))
+            for relpath, kv in self._range(path)
+        ]
+
+    def _range(self, path, keys_only=False):
+        """
+        Return a (relative path, kv) tuple for each key under path, paginating the
+        range reads at the revision of the first one, for a consistent snapshot.
+        """
+        prefix = self.abspath(path).rstrip("/") + "/"
+        request = self._read_request(
+            {
+                "key": _b64(prefix),
+                "range_end": _b64(_prefix_end(prefix)),
+                "limit": self.page_size,
+                "keys_only": keys_only,
+            }
+        )
+        start = len(prefix)
+        results = []
+        while True:
+            res = self._post("kv/range", request)
+            kvs = res.get("kvs", [])
+            for kv in kvs:
+                results.append((_unb64(kv["key"])[start:], kv))
+            if not res.get("more", False) or not kvs:
+                break
+            request["revision"] = res["header"]["revision"]
+            # Restart right after the last key we got
+            request["key"] = _b64(_unb64(kvs[-1]["key"]) + "\0")
+        return results
+
+    def _read_request(self, request):
+        """Add the current consistency level to a range request."""
+        if self.read_consistency == drivers.SERIALIZABLE:
+            request["serializable"] = True
+        return request
+
+    def _write_chunk(self, items):
+        """Write items in a transaction, returning the list of their results."""
+        keys = [self.abspath(path) for path, _, _ in items]
+        if all(prev_index is not None for _, _, prev_index in items):
+            # Try to write the full values, if nothing changed since they were read
+            revisions = [prev_index for _, _, prev_index in items]
+            values = [value for _, value, _ in items]
+            if self._txn(keys, revisions, values):
+                return values
+        results = [None] * len(items)
+        todo = list(range(len(items)))
+        for _ in range(self.txn_retries):
+            current = self._snapshot([keys[i] for i in todo])
+            remaining = []
+            revisions = []
+            values = []
+            for i in todo:
+                _, value, prev_index = items[i]
+                old_value, revision = current.get(keys[i], ({}, 0))
+                if prev_index is None:
+                    value = dict(old_value, **value)
+                elif prev_index != revision:
+                    results[i] = drivers.ConflictError(
+                        "{} was modified since revision {}".format(keys[i], prev_index)
+                    )
+                    continue
+                remaining.append(i)
+                revisions.append(revision)
+                values.append(value)
+            todo = remaining
+            if not todo or self._txn([keys[i] for i in todo], revisions, values):
+                for i, value in zip(todo, values):
+                    results[i] = value
+                return results
+            _log.debug("Some of %s were modified while writing, retrying", ",".join(keys))
+        raise drivers.BackendError("Too many concurrent modifications of {}".format(",".join(keys)))
+
+    def _snapshot(self, keys):
+        """Read the keys in a single transaction, returning a key => (value, revision) dict."""
+        ops = [{"request_range": {"key": _b64(key)}} for key in keys]
+        res = self._post("kv/txn", {"success": ops})
+        current = {}
+        for response in res.get("responses", []):
+            for kv in response.get("response_range", {}).get("kvs", []):
+                current[_unb64(kv["key"])] = (self._data(kv), int(kv["mod_revision"]))
+        return current
+
+    def _txn(self, keys, revisions, values):
+        """Put all values, only if all keys are at the given mod revisions (0: missing)."""
+        compare = [
+            {"key": _b64(key), "target": "MOD", "result": "EQUAL", "mod_revision": revision}
+            for key, revision in zip(keys, revisions)
+        ]
+        success = [
+            {"request_put": {"key": _b64(key), "value": _b64(json.dumps(value))}}
+            for key, value in zip(keys, values)
+        ]
+        res = self._post("kv/txn", {"compare": compare, "success": success})
+        return res.get("succeeded", False)
+
+    def _listed_data(self, kv):
+        """Decode the value of a listed key, returning MALFORMED if it can't be."""
+        try:
+            return self._data(kv)
+        except drivers.BackendError:
+            return drivers.MALFORMED
+
+    def _data(self, kv):
+        if "value" not in kv:
+            return None
+        try:
+            return json.loads(_unb64(kv["value"]))
+        except ValueError:
+            raise drivers.BackendError(
+                "The kvstore contains malformed data at key %s" % _unb64(kv["key"])
+            )
+
+    def _post(self, endpoint, data, authenticate=True, reauthenticate=True):
+        """
+        Send a request to the first host that responds, and return the decoded response.
+        If the auth token is rejected, as it happens when it expires, a new one is
+        requested and the request is sent again, once.
+        """
+        if authenticate and self.credentials is not None and self.token is None:
+            self.token = self._post("auth/authenticate", self.credentials, False)["token"]
+        headers = {"Content-Type": "application/json"}
+        if authenticate and self.token is not None:
+            headers["Authorization"] = self.token
+        body = json.dumps(data).encode("utf-8")
+        errors = []
+        for host in self.hosts:
+            url = "{}{}/{}".format(host, self.api_prefix, endpoint)
+            try:
+                res = self.http.request(
+                    "POST", url, body=body, headers=headers, timeout=self.timeout
+                )
+            except urllib3.exceptions.HTTPError as e:
+                _log.debug("Request to %s failed: %s", url, e)
+                errors.append(str(e))
+                continue
+            try:
+                payload = json.loads(res.data.decode("utf-8"))
+            except ValueError:
+                payload = {}
+            if res.status != 200:
+                error = payload.get("error", res.data)
+                if (
+                    reauthenticate
+                    and authenticate
+                    and self.token is not None
+                    and (res.status == 401 or "invalid auth token" in str(error))
+                ):
+                    _log.debug("The auth token was rejected, authenticating again")
+                    self.token = None
+                    return self._post(endpoint, data, authenticate, reauthenticate=False)
+                raise drivers.BackendError("Backend error: {} {}".format(res.status, error))
+            return payload
+        raise drivers.BackendError("Backend error: no host available: {}".format("; ".join(errors)))
@@ -0,0 +1,97 @@
+import fcntl
+import json
+import os
+import tempfile
+
+from contextlib import contextmanager
+
+from conftool import drivers
+from conftool.drivers import memory
+
+"""
+
+Reference driver storing every key as a JSON file in a directory tree, useful
+for tests and benchmarks that don't need a running etcd but want the data to
+persist between runs.
+
+It follows the semantics of the etcd driver, and accepts the following
+driver options:
+
+* `root` (default: `cache_path`/filesystem-driver): the directory holding the data
+* `latency` (default: 0): artificial latency added to each round trip to
+  the backend, in seconds.
+
+Indexes are kept in a counter file, and writes are serialized with a lock file,
+both in the root directory.
+"""
+
+
+class Driver(memory.Driver):
+    def __init__(self, config):
+        super().__init__(config)
+        self.root = config.driver_options.get(
+            "root", os.path.join(config.cache_path, "filesystem-driver")
+        )
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.root, key.lstrip("/"))
+
+    @contextmanager
+    def _locked(self):
+        with self.lock:
+            with open(os.path.join(self.root, ".lock"), "w") as fh:
+                fcntl.flock(fh, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def _get(self, key):
+        path = self._path(key)
+        if not os.path.isfile(path):
+            raise drivers.NotFoundError()
+        with open(path) as fh:
+            try:
+                data = json.load(fh)
+            except ValueError:
+                raise drivers.BackendError("The kvstore contains malformed data at key %s" % key)
+        return (data["value"], data["index"])
+
+    def _set(self, key, value):
+        index_file = os.path.join(self.root, ".index")
+        try:
+            with open(index_file) as fh:
+                index = int(fh.read()) + 1
+        except FileNotFoundError:
+            index = 1
+        self._dump(index_file, index)
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._dump(path, {"value": value, "index": index})
+
+    def _remove(self, key):
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            raise drivers.NotFoundError()
+
+    def _items(self, prefix):
+        base = self._path(prefix)
+        items = []
+        for dirpath, dirnames, filenames in os.walk(base):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.startswith("."):
+                    continue
+                path = os.path.join(dirpath, filename)
+                key = "/" + os.path.relpath(path, self.root)
+                items.append((key,) + self._get(key))
+        return sorted(items)
+
+    def _dump(self, path, data):
+        """Atomically replace the content of a file."""
+        fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        with os.fdopen(fd, "w") as fh:
+            json.dump(data, fh)
+        os.replace(tmpfile, path)
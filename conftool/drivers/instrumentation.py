@@ -0,0 +1,216 @@
+import bisect
+import functools
+import json
+import threading
+import time
+
+"""
+
+Instrumentation of the drivers.
+
+When enabled, the drivers created by the backend are wrapped in an
+InstrumentedDriver, which records for every call to the driver API the latency,
+the number of errors and the size of the JSON data read or written. The HTTP
+requests the driver makes to the datastore are counted as round trips, together
+with the size of their responses.
+
+Statistics from all the drivers are collected in the module-level `stats`.
+"""
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf"))
+
+# The driver methods that are instrumented
+METHODS = (
+    "is_dir",
+    "read",
+    "read_versioned",
+    "write",
+    "write_many",
+    "delete",
+    "ls",
+    "all_keys",
+    "all_data",
+    "all_data_versioned",
+)
+
+_enabled = False
+
+
+def enable():
+    """Instrument the drivers created from now on."""
+    global _enabled
+    _enabled = True
+
+
+def is_enabled():
+    return _enabled
+
+
+class CallStats:
+    """Statistics about the calls to a driver method."""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.bytes = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.histogram = [0] * len(BUCKETS)
+
+    def record(self, elapsed, nbytes, failed):
+        self.calls += 1
+        self.errors += int(failed)
+        self.bytes += nbytes
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.histogram[bisect.bisect_left(BUCKETS, elapsed)] += 1
+
+    def percentile(self, pct):
+        """Estimate a latency percentile, as the upper bound of the bucket it falls in."""
+        rank = self.calls * pct / 100.0
+        seen = 0
+        for bound, count in zip(BUCKETS, self.histogram):
+            seen += count
+            if count and seen >= rank:
+                return min(bound, self.max_time)
+        return self.max_time
+
+    def asdict(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "bytes": self.bytes,
+            "total_time": self.total_time,
+            "max_time": self.max_time,
+            "histogram": {str(bound): count for bound, count in zip(BUCKETS, self.histogram)},
+        }
+
+
+class Stats:
+    """Thread-safe collection of the statistics of the drivers."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.monotonic()
+            self.methods = {}
+            self.round_trips = 0
+            self.received = 0
+
+    def record(self, method, elapsed, nbytes=0, failed=False):
+        with self.lock:
+            self.methods.setdefault(method, CallStats()).record(elapsed, nbytes, failed)
+
+    def record_round_trip(self, nbytes):
+        with self.lock:
+            self.round_trips += 1
+            self.received += nbytes
+
+    def asdict(self):
+        with self.lock:
+            return {
+                "elapsed": time.monotonic() - self.started,
+                "round_trips": self.round_trips,
+                "received_bytes": self.received,
+                "methods": {name: stats.asdict() for name, stats in sorted(self.methods.items())},
+            }
+
+    def summary(self):
+        """A human-readable summary of the statistics."""
+        with self.lock:
+            lines = [
+                "{:<20} {:>7} {:>7} {:>10} {:>10} {:>10} {:>10}".format(
+                    "method", "calls", "errors", "bytes", "total ms", "p50 ms", "p95 ms"
+                )
+            ]
+            for name, stats in sorted(self.methods.items()):
+                lines.append(
+                    "{:<20} {:>7} {:>7} {:>10} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+                        name,
+                        stats.calls,
+                        stats.errors,
+                        stats.bytes,
+                        stats.total_time * 1000,
+                        stats.percentile(50) * 1000,
+                        stats.percentile(95) * 1000,
+                    )
+                )
+            lines.append(
+                "{} round trips to the datastore, {} bytes received in {:.1f} ms".format(
+                    self.round_trips, self.received, (time.monotonic() - self.started) * 1000
+                )
+            )
+        return "\n".join(lines)
+
+    def dump(self, filename):
+        """Save the statistics as JSON."""
+        with open(filename, "w") as fh:
+            json.dump(self.asdict(), fh, indent=4, sort_keys=True)
+
+
+stats = Stats()
+
+
+def _size(data):
+    """Size of data as JSON, for the data that is read or written."""
+    try:
+        return len(json.dumps(data))
+    except (TypeError, ValueError):
+        return 0
+
+
+class InstrumentedDriver:
+    """Proxy to a driver recording statistics about the calls to its API in `stats`."""
+
+    def __init__(self, driver):
+        self.driver = driver
+        for pool in driver.http_pools():
+            pool.urlopen = self._count_round_trips(pool.urlopen)
+
+    def __getattr__(self, attr):
+        value = getattr(self.driver, attr)
+        if attr in METHODS:
+            return self._instrument(attr, value)
+        return value
+
+    def _instrument(self, name, method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            start = time.monotonic()
+            nbytes = 0
+            failed = True
+            try:
+                if name == "write":
+                    nbytes += _size(args[1] if len(args) > 1 else kwargs.get("value"))
+                elif name == "write_many":
+                    nbytes += sum(_size(value) for _, value, _ in args[0])
+                res = method(*args, **kwargs)
+                if name in ("ls", "all_keys", "all_data", "all_data_versioned"):
+                    # Listings can be lazy, consume them to take them into account
+                    res = list(res)
+                if name == "write_many":
+                    # Failed writes return no data
+                    nbytes += _size([r for r in res if not isinstance(r, Exception)])
+                elif name != "is_dir":
+                    nbytes += _size(res)
+                failed = False
+                return res
+            finally:
+                stats.record(name, time.monotonic() - start, nbytes, failed)
+
+        return wrapper
+
+    @staticmethod
+    def _count_round_trips(urlopen):
+        @functools.wraps(urlopen)
+        def wrapper(*args, **kwargs):
+            res = urlopen(*args, **kwargs)
+            # Don't consume streamed bodies, rely on the declared length
+            stats.record_round_trip(int(res.headers.get("Content-Length") or 0))
+            return res
+
+        return wrapper
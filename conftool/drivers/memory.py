@@ -0,0 +1,157 @@
+import copy
+import threading
+import time
+
+from contextlib import contextmanager
+
+from conftool import drivers
+
+"""
+
+Reference driver keeping all data in memory, mainly useful for tests and
+benchmarks that don't need a running etcd.
+
+It follows the semantics of the etcd driver, and accepts the following
+driver options:
+
+* `latency` (default: 0): artificial latency added to each round trip to
+  the backend, in seconds.
+
+The number of round trips performed is available as `round_trips`.
+"""
+
+
+class Driver(drivers.BaseDriver):
+    def __init__(self, config):
+        super().__init__(config)
+        self.latency = float(config.driver_options.get("latency", 0))
+        self.round_trips = 0
+        self.data = {}  # key => (value, index)
+        self.index = 0
+        self.lock = threading.Lock()
+
+    def is_dir(self, path):
+        self._round_trip()
+        with self._locked():
+            return bool(self._items(self._dir_prefix(path)))
+
+    def read(self, path):
+        return self.read_versioned(path)[0]
+
+    def read_versioned(self, path):
+        self._round_trip()
+        with self._locked():
+            return self._get(self.abspath(path))
+
+    def write(self, path, value, prev_index=None):
+        self._round_trip()
+        with self._locked():
+            return self._write(self.abspath(path), value, prev_index)
+
+    def write_many(self, items):
+        """All the writes are performed while holding the lock, in a single round trip."""
+        self._round_trip()
+        results = []
+        with self._locked():
+            for path, value, prev_index in items:
+                try:
+                    results.append(self._write(self.abspath(path), value, prev_index))
+                except drivers.BackendError as e:
+                    results.append(e)
+        return results
+
+    def delete(self, path):
+        self._round_trip()
+        with self._locked():
+            self._remove(self.abspath(path))
+
+    def ls(self, path, recursive=False):
+        """Given a path, returns a tuple (key, data) for each value found"""
+        if recursive:
+            return self.all_data(path)
+        children = {}
+        for relpath, value, _ in self._list(path):
+            name, _, rest = relpath.partition("/")
+            if rest:
+                children.setdefault(name, None)
+            else:
+                children[name] = value
+        return list(children.items())
+
+    def all_keys(self, path):
+        return [relpath.split("/") for relpath, _, _ in self._list(path)]
+
+    def all_data(self, path):
+        """Return a (path, object) tuple for all the objects"""
+        return [(relpath, value) for relpath, value, _ in self._list(path)]
+
+    def all_data_versioned(self, path):
+        """Return a (path, object, index) tuple for all the objects"""
+        return self._list(path)
+
+    def _round_trip(self):
+        self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _dir_prefix(self, path):
+        return self.abspath(path).rstrip("/") + "/"
+
+    def _list(self, path):
+        """Return a (relative path, value, index) tuple for all values under path."""
+        self._round_trip()
+        prefix = self._dir_prefix(path)
+        start = len(prefix)
+        with self._locked():
+            items = self._items(prefix)
+        if not items:
+            raise ValueError("{} is not a directory".format(self.abspath(path)))
+        return [(key[start:], value, index) for key, value, index in items]
+
+    def _write(self, key, value, prev_index):
+        """Write a value if the key is still at prev_index, or merge it into the current one."""
+        try:
+            current, index = self._get(key)
+        except drivers.NotFoundError:
+            current, index = None, 0
+        if prev_index is not None:
+            if prev_index != index:
+                raise drivers.ConflictError(
+                    "{} was modified since index {}".format(key, prev_index)
+                )
+        elif current is not None:
+            value = dict(current, **value)
+        self._set(key, value)
+        return copy.deepcopy(value)
+
+    # Storage primitives, to be called while holding the lock.
+    @contextmanager
+    def _locked(self):
+        with self.lock:
+            yield
+
+    def _get(self, key):
+        """Return the (value, index) tuple for key."""
+        try:
+            value, index = self.data[key]
+        except KeyError:
+            raise drivers.NotFoundError()
+        return (copy.deepcopy(value), index)
+
+    def _set(self, key, value):
+        self.index += 1
+        self.data[key] = (copy.deepcopy(value), self.index)
+
+    def _remove(self, key):
+        try:
+            del self.data[key]
+        except KeyError:
+            raise drivers.NotFoundError()
+
+    def _items(self, prefix):
+        """Return a sorted list of (key, value, index) tuples for all keys under prefix."""
+        return [
+            (key, copy.deepcopy(value), index)
+            for key, (value, index) in sorted(self.data.items())
+            if key.startswith(prefix)
+        ]
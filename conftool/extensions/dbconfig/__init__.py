@@ -2,7 +2,7 @@ import argparse
 import logging
 import sys
 
-from conftool import __version__
+from conftool.cli import VersionAction, add_timings_arguments, setup_timings
 from conftool.extensions.dbconfig.cli import DbConfigCli
 
 
@@ -11,7 +11,7 @@ def parse_args(cmdline):
         description="Tool to perform simple operations of configuration for databases in mediawiki",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
     )
-    parser.add_argument("--version", action="version", version="%(prog)s " + __version__)
+    parser.add_argument("--version", action=VersionAction)
     parser.add_argument("--config", help="Config file", default="/etc/conftool/config.yaml")
     parser.add_argument("--debug", action="store_true", default=False, help="print debug info")
     # TODO: how necessary / safe is this option?
@@ -27,6 +27,14 @@ def parse_args(cmdline):
         default="/etc/conftool/schema.yaml",
         help="Schema file that defines additional object types",
     )
+    parser.add_argument(
+        "--stale-ok",
+        action="store_true",
+        dest="stale_ok",
+        default=False,
+        help="Allow read-only commands to read possibly stale data from any member of the cluster",
+    )
+    add_timings_arguments(parser)
     parser.add_argument("-s", "--scope", help="Refer any action to this datacenter.")
     # Hidden argument, needed for subclassing `conftool.cli.tool.ToolCli`
     parser.add_argument("--object_type", default="mwconfig", help=argparse.SUPPRESS)
@@ -202,6 +210,7 @@ def main(cmdline=None):
     else:
         logging.basicConfig(level=logging.WARN)
     # TODO: INFO logging by default? or is that too noisy?
+    setup_timings(args)
 
     cli = DbConfigCli(args)
     cli.setup()
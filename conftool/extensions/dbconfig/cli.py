@@ -8,6 +8,8 @@ from conftool.extensions.dbconfig.entities import Instance, Section
 
 
 ALL_SELECTOR = "all"
+# Commands that only read data
+READ_ONLY_COMMANDS = ["get", "diff", "generate"]
 
 
 class DbConfigCli(ToolCliBase):
@@ -28,7 +30,8 @@ class DbConfigCli(ToolCliBase):
         behaviour by selecting which sub-cli to use based on args.object_name
         """
         # TODO: the below uses a Golang-ish idiom
-        result = getattr(self, "_run_on_{}".format(self.args.object_name))()
+        with self.consistency(self.args.command in READ_ONLY_COMMANDS):
+            result = getattr(self, "_run_on_{}".format(self.args.object_name))()
         if not result.success:
             print("Execution FAILED\nReported errors:", file=sys.stderr)
         if result.messages:
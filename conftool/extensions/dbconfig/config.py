@@ -11,12 +11,20 @@ from pathlib import Path
 from conftool import get_username
 from conftool.extensions.dbconfig.action import ActionResult, phaste
 
-# If we have icdiff installed, use it for interactive output.
-# If we don't, fall back to difflib.unified_diff().
-try:
-    import icdiff
-except ImportError:
-    icdiff = None
+
+def _icdiff():
+    """
+    Return the icdiff module, or None if it's not installed.
+
+    If we have icdiff installed, use it for interactive output.
+    If we don't, fall back to difflib.unified_diff().
+    It's only imported when a diff is shown, as it's slow to import.
+    """
+    try:
+        import icdiff
+    except ImportError:
+        icdiff = None
+    return icdiff
 
 
 class DbConfig:
@@ -72,7 +80,8 @@ class DbConfig:
 
         """
         config = {}
-        for obj in self.entity.query({"name": re.compile(r"^{}$".format(DbConfig.object_name))}):
+        query = {"name": re.compile(r"^{}$".format(DbConfig.object_name))}
+        for obj in self.entity.query(query, hydrate=True):
             dc = obj.tags["scope"]
             config[dc] = obj.val
 
@@ -346,7 +355,8 @@ class DbConfig:
             b_lines = _to_json_lines(_get(b, branches))
             a_descr = " ".join([path, a_name])
             b_descr = " ".join([path, b_name])
-            if icdiff is not None and not force_unified:
+            icdiff = None if force_unified else _icdiff()
+            if icdiff is not None:
                 consolediff = icdiff.ConsoleDiff(cols=self._terminal_columns())
                 difflines = list(
                     [
@@ -540,15 +550,18 @@ class DbConfig:
 
     def _write(self, config, datacenter=None):
         """Write the given config, if valid, to the datastore."""
+        objects = []
         for dc, data in config.items():
             if datacenter is not None and dc != datacenter:
                 continue
             errors = self._validate(config, datacenter)
             if errors:
                 return ActionResult(False, 10, messages=errors)
-            obj = self.entity(dc, DbConfig.object_name)
+            obj = self.entity.lazy(dc, DbConfig.object_name)
             obj.val = data
-            obj.write()
+            objects.append(obj)
+        # Only write once all datacenters are validated
+        self.entity.write_many(objects)
 
         return ActionResult(True, 0)
 
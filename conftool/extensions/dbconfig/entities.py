@@ -67,7 +67,7 @@ class DbObjBase(ABC):
         """
         Gets a range of dbconfig objects, all by default
         """
-        for obj in self.entity.query(self._query(name, dc)):
+        for obj in self.entity.query(self._query(name, dc), hydrate=True):
             if initialized_only and self._check_uninitialized(obj):
                 continue
             else:
@@ -5,6 +5,8 @@ import logging
 import sys
 
 
+from conftool.cli import add_timings_arguments, setup_timings
+
 from .cli import Requestctl
 from .error import RequestctlError
 from .schema import SCHEMA, SYNC_ENTITIES
@@ -23,6 +25,12 @@ def parse_args(args) -> Namespace:
         "--config", "-c", help="Configuration file", default="/etc/conftool/config.yaml"
     )
     parser.add_argument("--debug", action="store_true")
+    parser.add_argument(
+        "--stale-ok",
+        action="store_true",
+        help="Allow read-only commands to read possibly stale data from any member of the cluster",
+    )
+    add_timings_arguments(parser)
     command = parser.add_subparsers(help="Command to execute", dest="command")
     command.required = True
     # Sync command
@@ -135,6 +143,7 @@ def main():
     """Run the tool."""
     logger = logging.getLogger("reqctl")
     options = parse_args(sys.argv[1:])
+    setup_timings(options)
     rq = Requestctl(options)
     try:
         # TODO: add support to let a custom exit code surface, for example for
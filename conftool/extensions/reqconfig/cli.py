@@ -11,15 +11,11 @@ import logging
 import pathlib
 import re
 from collections import defaultdict
-from typing import Any, Dict, Generator, List, Optional, Tuple
+from typing import TYPE_CHECKING, Any, Dict, Generator, List, Optional, Tuple
 
-import pyparsing as pp
-import yaml
-from wmflib.interactive import AbortError, ask_confirmation
-
-from conftool import IRCSocketHandler, configuration, yaml_safe_load
+from conftool import IRCSocketHandler, configuration, yaml_dump, yaml_safe_load
 from conftool.cli import ConftoolClient
-from conftool.drivers import BackendError
+from conftool.drivers import BackendError, SERIALIZABLE
 from conftool.extensions.reqconfig.translate import VCLTranslator, VSLTranslator
 from conftool.kvobject import Entity
 
@@ -27,15 +23,38 @@ from . import view
 from .schema import SCHEMA, get_obj_from_slug, SYNC_ENTITIES
 from .error import RequestctlError
 
+if TYPE_CHECKING:
+    import pyparsing
+
 irc = logging.getLogger("reqctl.announce")
 logger = logging.getLogger("reqctl")
 config = configuration.Config()
 
 
+# pyparsing and wmflib are slow to import, so they're imported only when needed.
+def ask_confirmation(message: str) -> None:
+    """Ask the user for confirmation, raising wmflib's AbortError if not given."""
+    from wmflib.interactive import ask_confirmation as wmflib_ask_confirmation
+
+    wmflib_ask_confirmation(message)
+
+
+def confirm(message: str) -> bool:
+    """Ask the user for confirmation, and return whether it was given."""
+    from wmflib.interactive import AbortError
+
+    try:
+        ask_confirmation(message)
+    except AbortError:
+        return False
+    return True
+
+
 class Requestctl:
     """Cli tool to interact with the dynamic banning of urls."""
 
     ACTION_ONLY_CMD = ["enable", "disable", "commit", "vcl", "log", "find", "find-ip"]
+    READ_ONLY_CMD = ["get", "dump", "vcl", "log", "find"]
 
     def __init__(self, args: argparse.Namespace) -> None:
         if args.debug:
@@ -72,7 +91,14 @@ class Requestctl:
             self._obj_exist = self._is_obj_on_fs
         else:
             self._obj_exist = self._is_obj_on_backend
-        self.expression_grammar = self.grammar()
+        self._expression_grammar = None
+
+    @property
+    def expression_grammar(self) -> "pyparsing.Forward":
+        """The grammar of expressions, built when first needed."""
+        if self._expression_grammar is None:
+            self._expression_grammar = self.grammar()
+        return self._expression_grammar
 
     @property
     def object_type(self) -> str:
@@ -90,7 +116,12 @@ class Requestctl:
 
         # TODO: add support to let a custom exit code surface, for example for
         # "failed successfully" operations
-        command()
+        if getattr(self.args, "stale_ok", False) and self.args.command in self.READ_ONLY_CMD:
+            # Reads can be served by any member of the cluster
+            with self.cls.backend.driver.with_consistency(SERIALIZABLE):
+                command()
+        else:
+            command()
 
     def validate(self):
         """Scans a directory, checks validity of the objects.
@@ -150,19 +181,18 @@ class Requestctl:
         # Given we also need to check consistency, we need all actions too.
 
         if self.object_type != "action":
-            all_actions = [a for a in self.client.get("action").query({"name": re.compile(".*")})]
+            all_actions = list(
+                self.client.get("action").query({"name": re.compile(".*")}, hydrate=True)
+            )
         else:
             all_actions = []
-        for reqobj in self.cls.query({"name": re.compile(".*")}):
+        for reqobj in self.cls.query({"name": re.compile(".*")}, hydrate=True):
             if not self._should_have_path(reqobj).is_file():
                 if not self._is_safe_to_remove(reqobj, all_actions):
                     failed = True
                     continue
-                if self.args.interactive:
-                    try:
-                        ask_confirmation(f"Proceed to delete {reqobj}?")
-                    except AbortError:
-                        continue
+                if self.args.interactive and not confirm(f"Proceed to delete {reqobj}?"):
+                    continue
                 logger.info("Deleting %s", reqobj.name)
                 reqobj.delete()
 
@@ -173,11 +203,11 @@ class Requestctl:
 
     def dump(self):
         """Dump an object type."""
-        for reqobj in self.cls.query({"name": re.compile(".*")}):
+        for reqobj in self.cls.query({"name": re.compile(".*")}, hydrate=True):
             object_path = self.base_path / f"{reqobj.pprint()}.yaml"
             object_path.absolute().parent.mkdir(parents=True, exist_ok=True)
             contents = reqobj.asdict()[reqobj.name]
-            object_path.write_text(yaml.dump(contents))
+            object_path.write_text(yaml_dump(contents))
 
     def enable(self):
         """Enable an action."""
@@ -194,8 +224,8 @@ class Requestctl:
     def log(self):
         """Print out the varnishlog command corresponding to the selected action."""
         objs = self._get(must_exist=True)
-        objs[0].vsl_expression = self._vsl_from_expression(objs[0].expression)
-        print(view.get("vsl").render(objs, "action"))
+        expressions = {objs[0].pprint(): self._vsl_from_expression(objs[0].expression)}
+        print(view.get("vsl").render(objs, "action", expressions))
 
     def find(self):
         """Find actions that correspond to the searched pattern."""
@@ -229,8 +259,8 @@ class Requestctl:
     def vcl(self):
         """Print out the VCL for a specific action."""
         objs = self._get(must_exist=True)
-        objs[0].vcl_expression = self._vcl_from_expression(objs[0].expression)
-        print(view.get("vcl").render(objs, "vcl"))
+        expressions = {objs[0].pprint(): self._vcl_from_expression(objs[0].expression)}
+        print(view.get("vcl").render(objs, "vcl", expressions))
 
     def commit(self):
         """Commit the enabled actions to vcl, asking confirmation with a diff."""
@@ -241,10 +271,11 @@ class Requestctl:
         batch = self.args.batch
         vcl = self.client.get("vcl")
         actions_by_tag_site = defaultdict(lambda: defaultdict(list))
+        expressions = {}
         for action in self._get():
             if not any([action.enabled, action.log_matching]):
                 continue
-            action.vcl_expression = self._vcl_from_expression(action.expression)
+            expressions[action.pprint()] = self._vcl_from_expression(action.expression)
             cluster = action.tags["cluster"]
             if not action.sites:
                 actions_by_tag_site[cluster]["global"].append(action)
@@ -253,7 +284,7 @@ class Requestctl:
                     actions_by_tag_site[cluster][site].append(action)
         for cluster, entries in actions_by_tag_site.items():
             for name, actions in entries.items():
-                vcl_content = view.get("vcl").render(actions, "commit")
+                vcl_content = view.get("vcl").render(actions, "commit", expressions)
                 obj = vcl(cluster, name)
                 if not batch:
                     if obj.exists:
@@ -265,7 +296,7 @@ class Requestctl:
                 obj.vcl = vcl_content
                 obj.write()
         # Now clean up things that are leftover
-        for rules in vcl.query({"name": re.compile(".*")}):
+        for rules in vcl.query({"name": re.compile(".*")}, hydrate=True):
             cluster = rules.tags["cluster"]
             if rules.name not in actions_by_tag_site[cluster]:
                 if not batch and not self._confirm_diff(rules.vcl, "", obj.pprint()):
@@ -298,11 +329,7 @@ class Requestctl:
         if not diff:
             return False
         print(diff)
-        try:
-            ask_confirmation("Ok to commit these changes?")
-        except AbortError:
-            return False
-        return True
+        return confirm("Ok to commit these changes?")
 
     def _vcl_diff(self, old: str, new: str, slug: str) -> str:
         """Diffs between two pieces of VCL."""
@@ -333,7 +360,7 @@ class Requestctl:
             elif must_exist:
                 raise RequestctlError(f"{self.object_type} {obj.pprint()} not found.")
         else:
-            objs = list(self.cls.query({"name": re.compile(".")}))
+            objs = list(self.cls.query({"name": re.compile(".")}, hydrate=True))
         return objs
 
     def _enable(self, enable: bool):
@@ -368,7 +395,7 @@ class Requestctl:
 
         return flatten(parsed.asList())
 
-    def grammar(self) -> pp.Forward:
+    def grammar(self) -> "pyparsing.Forward":
         """
         Pyparsing based grammar for expressions in actions.
 
@@ -380,6 +407,8 @@ class Requestctl:
         <boolean> ::= "AND" | "OR" | "AND NOT" | "OR NOT"
 
         """
+        import pyparsing as pp
+
         boolean = (
             pp.Keyword("AND NOT") | pp.Keyword("OR NOT") | pp.Keyword("AND") | pp.Keyword("OR")
         )
@@ -395,6 +424,8 @@ class Requestctl:
 
     def _validate_pattern(self, _all, _pos, tokens):
         """Ensure a pattern referenced exists."""
+        import pyparsing as pp
+
         for pattern in tokens:
             if not self._obj_exist("pattern", pattern):
                 msg = f"The pattern {pattern} is not present on the backend."
@@ -404,6 +435,8 @@ class Requestctl:
 
     def _validate_ipblock(self, _all, _pos, tokens):
         """Ensure an ipblock referenced exists."""
+        import pyparsing as pp
+
         for ipblock in tokens:
             if not self._obj_exist("ipblock", ipblock):
                 msg = f"The ipblock {ipblock} is not present on the backend."
@@ -442,7 +475,7 @@ class Requestctl:
         """Get an entity from a file path, and the corresponding data to update."""
         from_disk = yaml_safe_load(file_path, {})
         entity_name = file_path.stem
-        entity = self.cls(tag, entity_name)
+        entity = self.cls.lazy(tag, entity_name)
         return (entity, from_disk)
 
     def _verify_change(self, changes: Dict[str, Any], object_type: Optional[str] = None) -> Dict:
@@ -457,6 +490,8 @@ class Requestctl:
                 raise RequestctlError("Cannot add a request body in a request other than POST.")
         if object_type != "action":
             return changes
+        import pyparsing as pp
+
         try:
             changes["expression"] = " ".join(self._parse_and_check(changes["expression"]))
         except pp.ParseException as e:
@@ -483,9 +518,7 @@ class Requestctl:
             print(msg)
             for key, value in changes.items():
                 print(f"{entity.name}.{key}: '{getattr(entity, key)}' => {value}")
-            try:
-                ask_confirmation(f"Do you want to {action} this object?")
-            except AbortError:
+            if not confirm(f"Do you want to {action} this object?"):
                 # act like there were no changes
                 return {}
         return changes
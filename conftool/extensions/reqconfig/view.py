@@ -3,10 +3,9 @@
 import json
 import textwrap
 from string import Template
-from typing import Dict, List
+from typing import Dict, List, Optional
 
-import tabulate
-import yaml
+from conftool import yaml_dump
 from conftool.kvobject import Entity
 
 
@@ -51,7 +50,7 @@ class YamlView(View):
 
     @classmethod
     def render(cls, data: List[Entity], _: str) -> str:
-        return yaml.dump(cls.dump(data))
+        return yaml_dump(cls.dump(data))
 
 
 class JsonView(YamlView):
@@ -88,7 +87,10 @@ class PrettyView(View):
                     str(entity.do_throttle).lower(),
                 )
             tabular.append(element)
-        return tabulate.tabulate(tabular, headers, tablefmt="pretty")
+        # Only imported when needed, as it's slow to import
+        from tabulate import tabulate
+
+        return tabulate(tabular, headers, tablefmt="pretty")
 
     @classmethod
     def get_pattern(cls, entity: Entity) -> str:
@@ -154,17 +156,22 @@ if (!req.http.X-Requestctl) {
 """
 
     @classmethod
-    def render(cls, data: List[Entity], object_type: str = "") -> str:
+    def render(
+        cls, data: List[Entity], object_type: str = "", expressions: Optional[Dict] = None
+    ) -> str:
+        """Renders the actions, given a dict of their VCL expressions indexed by pprint()."""
+        if expressions is None:
+            expressions = {}
         out = [cls.header]
         for action in sorted(data, key=lambda k: k.name):
-            # TODO: Check vcl_expression is there?
+            # TODO: Check the vcl expression is there?
             substitutions = dict(
                 name=action.name,
                 comment=action.comment,
                 pprint=action.pprint(),
                 reason=action.resp_reason,
                 status=action.resp_status,
-                expression=action.vcl_expression,
+                expression=expressions.get(action.pprint(), ""),
                 retry_after=max(1, action.throttle_duration),
                 driver="etcd",  # TODO: get this from configuration
             )
@@ -208,5 +215,8 @@ sudo varnishncsa -n frontend -g request \\
     )
 
     @classmethod
-    def render(cls, data: List[Entity], _: str = "") -> str:
-        return cls.tpl_log.substitute(vsl=data[0].vsl_expression)
+    def render(cls, data: List[Entity], _: str = "", expressions: Optional[Dict] = None) -> str:
+        """Renders the first action, given a dict of VSL expressions indexed by pprint()."""
+        if expressions is None:
+            expressions = {}
+        return cls.tpl_log.substitute(vsl=expressions.get(data[0].pprint(), ""))
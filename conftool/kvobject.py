@@ -1,21 +1,73 @@
+import copy
+import functools
+import itertools
 import json
 import os
+import re
+import sys
+import threading
 
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 from typing import Dict
 
 from conftool import _log, backend, drivers
 
+# Sentinel for data that still needs to be read from the backend
+_UNREAD = object()
+# Selector values that only match themselves: words, dashes and escaped dots
+_LITERAL = re.compile(r"(?:[\w-]|\\\.)+")
+# Limits on the number of subtrees query() will read instead of the whole tree
+_MAX_QUERY_PREFIXES = 64
+_MAX_QUERY_WORKERS = 8
+# How many times to try writing the changes to an object that keeps being modified
+_MAX_MERGE_ATTEMPTS = 3
+# The objects whose writes are deferred by KVObject.batch(), in each thread
+_batch = threading.local()
+
+
+def _literal_values(regex):
+    """
+    Return the strings an anchored selector like ^eqiad$ or ^(eqiad|codfw)$
+    matches, or None if the selector is not that simple.
+    """
+    pattern = regex.pattern
+    if regex.flags & re.IGNORECASE or not pattern.endswith("$"):
+        return None
+    pattern = pattern[1:-1] if pattern.startswith("^") else pattern[:-1]
+    if pattern.startswith("(") and pattern.endswith(")"):
+        pattern = pattern[3:-1] if pattern.startswith("(?:") else pattern[1:-1]
+    elif "|" in pattern:
+        # ^eqiad|codfw$ is only anchored on one side for each branch
+        return None
+    values = pattern.split("|")
+    if not all(_LITERAL.fullmatch(value) for value in values):
+        return None
+    values = [value.replace("\\", "") for value in values]
+    # Values like .. or a/b would be path components reaching outside of the subtree
+    if any(set(value) <= {"."} or "/" in value for value in values):
+        return None
+    return values
+
 
 class KVObject:
     """Basic key-value object implementation."""
 
+    __slots__ = ()
     backend = None
     config = None
     _schema = {}
     _tags = {}
     strict_schema = True
+    # The backend index the data was fetched at, used for conditional writes.
+    # 0 means the object was found not to exist, None that it's unknown.
+    _net_index = None
+    # A copy of the values as they are on the backend, or None if unknown
+    _net_values = None
+    # Set on objects built via Entity.lazy() until their data is fetched
+    _pending_fetch = False
 
     @classmethod
     def setup(cls, configobj):
@@ -26,32 +78,141 @@ class KVObject:
         return os.path.join(self.base_path(), *args)
 
     @classmethod
-    def query(cls, query):
+    def query(cls, query, hydrate=False):
         """
         Return all matching object given a tag:regexp dictionary as a query
 
         If any tag (or the object name) are omitted, all of them are supposed to
         get selected.
+
+        If hydrate is True, the objects are built from the data returned by the
+        recursive read of the base path, instead of being fetched one by one.
+
+        Anchored literal selectors (like ^eqiad$ or ^(eqiad|codfw)$) on the leading
+        tags restrict the recursive read to the matching subtrees, read in parallel.
         """
-        tags = cls._tags + ["name"]
-        non_existent = set(query.keys()) - set(tags)
+        cls._check_query(query)
+        prefixes = cls._query_prefixes(query)
+        if len(prefixes) == 1:
+            results = cls._query_subtree(prefixes[0], hydrate)
+        else:
+            # Workers must read at the consistency level, and write to the batch, of this thread
+            driver = cls.backend.driver
+            level = driver.read_consistency
+
+            @KVObject.bind_batch
+            def query_subtree(prefix):
+                with driver.with_consistency(level):
+                    return cls._query_subtree(prefix, hydrate)
+
+            with ThreadPoolExecutor(min(len(prefixes), _MAX_QUERY_WORKERS)) as executor:
+                subtrees = list(executor.map(query_subtree, prefixes))
+            results = itertools.chain.from_iterable(subtrees)
+        for labels, values, index in results:
+            if not cls._query_matches(query, labels):
+                continue
+            if hydrate and values is not drivers.MALFORMED:
+                yield cls.from_net_data(labels, values, index=index)
+            else:
+                # Objects with malformed data are fetched, which logs the error
+                yield cls(*labels)
+
+    @classmethod
+    async def async_query(cls, query):
+        """
+        Asyncio version of query(), always hydrating the objects.
+
+        Returns the list of the matching objects.
+        """
+        # Not imported at the top, so that synchronous users don't pay for it
+        import asyncio
+
+        cls._check_query(query)
+        subtrees = await asyncio.gather(
+            *[cls._async_query_subtree(prefix) for prefix in cls._query_prefixes(query)]
+        )
+        objects = []
+        malformed = []
+        for labels, values, index in itertools.chain.from_iterable(subtrees):
+            if not cls._query_matches(query, labels):
+                continue
+            if values is drivers.MALFORMED:
+                # Fetched one by one, which logs the error
+                obj = cls.lazy(*labels)
+                malformed.append(obj.async_fetch())
+            else:
+                obj = cls.from_net_data(labels, values, index=index)
+            objects.append(obj)
+        await asyncio.gather(*malformed)
+        return objects
+
+    @classmethod
+    def _check_query(cls, query):
+        non_existent = set(query.keys()) - set(cls._tags + ["name"])
         if non_existent:
             raise ValueError(
                 "The query includes non-existent tags: {}".format(",".join(non_existent))
             )
-        for labels in cls.backend.driver.all_keys(cls.base_path()):
-            is_matching = True
-            for i, tag in enumerate(tags):
-                regex = query.get(tag, None)
-                if regex is None:
-                    # Label selector not specified, we catch anything
-                    continue
-                if not regex.match(labels[i]):
-                    _log.debug("label %s did not match regex %s", labels[i], regex.pattern)
-                    is_matching = False
-                    break
-            if is_matching:
-                yield cls(*labels)
+
+    @classmethod
+    def _query_matches(cls, query, labels):
+        """Check if the labels of an object match all the selectors of the query."""
+        for i, tag in enumerate(cls._tags + ["name"]):
+            regex = query.get(tag, None)
+            if regex is None:
+                # Label selector not specified, we catch anything
+                continue
+            if not regex.match(labels[i]):
+                _log.debug("label %s did not match regex %s", labels[i], regex.pattern)
+                return False
+        return True
+
+    @classmethod
+    def _query_prefixes(cls, query):
+        """
+        Return the deepest directories, as lists of tags relative to base_path(),
+        that hold all the objects the query can match.
+        """
+        prefixes = [[]]
+        for tag in cls._tags:
+            regex = query.get(tag, None)
+            values = None if regex is None else _literal_values(regex)
+            if values is None or len(prefixes) * len(values) > _MAX_QUERY_PREFIXES:
+                break
+            prefixes = [prefix + [value] for prefix in prefixes for value in values]
+        return prefixes
+
+    @classmethod
+    def _query_subtree(cls, prefix, hydrate):
+        """Return a (labels, values, index) tuple for all the objects under prefix."""
+        path = os.path.join(cls.base_path(), *prefix)
+        try:
+            if hydrate:
+                return [
+                    (prefix + relpath.replace("//", "/").split("/"), values, index)
+                    for relpath, values, index in cls.backend.driver.all_data_versioned(path)
+                ]
+            return [(prefix + labels, None, None) for labels in cls.backend.driver.all_keys(path)]
+        except ValueError:
+            if not prefix:
+                raise
+            # The directory does not exist, so nothing in it can match
+            return []
+
+    @classmethod
+    async def _async_query_subtree(cls, prefix):
+        """Asyncio version of _query_subtree(), always returning the values."""
+        path = os.path.join(cls.base_path(), *prefix)
+        try:
+            results = await cls.backend.async_driver.all_data_versioned(path)
+        except ValueError:
+            if not prefix:
+                raise
+            return []
+        return [
+            (prefix + relpath.replace("//", "/").split("/"), values, index)
+            for relpath, values, index in results
+        ]
 
     @classmethod
     def base_path(cls):
@@ -84,24 +245,320 @@ class KVObject:
         raise NotImplementedError("All kvstore objects should implement this.")
 
     def fetch(self):
+        self._pending_fetch = False
         self.exists = False
+        self._net_index = None
         try:
-            values = self.backend.driver.read(self.key)
-            if values:
-                self.exists = True
-            self.from_net(values)
+            values, index = self.backend.driver.read_versioned(self.key)
         except drivers.NotFoundError:
-            self.from_net(None)
+            values, index = None, 0
         except drivers.BackendError as e:
             _log.error("Backend error while fetching %s: %s", self.key, e)
             # TODO: maybe catch the backend errors separately
+            return
+        self._load(values, index=index)
+
+    async def async_fetch(self):
+        """Asyncio version of fetch()."""
+        self._pending_fetch = False
+        self.exists = False
+        self._net_index = None
+        try:
+            values, index = await self.backend.async_driver.read_versioned(self.key)
+        except drivers.NotFoundError:
+            values, index = None, 0
+        except drivers.BackendError as e:
+            _log.error("Backend error while fetching %s: %s", self.key, e)
+            return
+        self._load(values, index=index)
+
+    def _load(self, values, index=None):
+        """Load the values read from the backend into the object."""
+        self._pending_fetch = False
+        self.exists = bool(values)
+        self.from_net(values)
+        # Values outside of the schema would be lost rewriting the whole object,
+        # so such objects are not written conditionally.
+        if values and self.strict_schema and not values.keys() <= self._schema.keys():
+            index = None
+        self._net_index = index
+        if self.exists:
+            # Keep the values as stored, not as validated, so that fields that were
+            # missing or invalid and got a default count as modified.
+            self._net_values = copy.deepcopy(
+                {key: values[key] for key in self._to_net() if key in values}
+            )
+        else:
+            self._net_values = None
+
+    def dirty_fields(self):
+        """
+        Returns a dict of the values that were modified since the object was fetched.
+        All values are returned if the object doesn't exist on the backend.
+        """
+        values = self._to_net()
+        if self._net_values is None:
+            return values
+        return {
+            k: v for k, v in values.items() if k not in self._net_values or self._net_values[k] != v
+        }
 
     def write(self):
-        return self.backend.driver.write(self.key, self._to_net())
+        values = self._to_net()
+        if values == self._net_values:
+            _log.debug("Not writing %s: no changes since it was fetched", self.key)
+            return values
+        if getattr(_batch, "objects", None) is not None:
+            _batch.objects[id(self)] = self
+            return values
+        try:
+            res = self.backend.driver.write(self.key, values, **self._write_args())
+        except drivers.ConflictError:
+            return self._merge_changes()
+        self._written(values)
+        return res
+
+    async def async_write(self):
+        """Asyncio version of write(). Writes are never deferred by batch()."""
+        values = self._to_net()
+        if values == self._net_values:
+            _log.debug("Not writing %s: no changes since it was fetched", self.key)
+            return values
+        try:
+            res = await self.backend.async_driver.write(self.key, values, **self._write_args())
+        except drivers.ConflictError:
+            return await self._async_merge_changes()
+        self._written(values)
+        return res
+
+    def _write_args(self):
+        """The arguments to write conditionally on the index the object was fetched at."""
+        if self._net_index is None:
+            return {}
+        return {"prev_index": self._net_index}
+
+    def _read_current(self):
+        """
+        Read the values on the backend and their index, which is 0 if there are none.
+        The read is linearizable, as it's used to check for or to resolve conflicts.
+        """
+        try:
+            with self.backend.driver.with_consistency(drivers.LINEARIZABLE):
+                return self.backend.driver.read_versioned(self.key)
+        except drivers.NotFoundError:
+            return None, 0
+
+    def _merged_changes(self, current, changes):
+        if current is None:
+            # Deleted in the meantime
+            return self._to_net()
+        return dict(current, **changes)
+
+    def _merge_changes(self):
+        """
+        Write the fields changed since the object was fetched over the values found
+        on the backend, after a conditional write found the object modified since.
+        The object is then reloaded with the resulting values, which are returned.
+        """
+        _log.info("%s was modified since it was fetched, writing only the changes", self.key)
+        changes = self.dirty_fields()
+        for _ in range(_MAX_MERGE_ATTEMPTS):
+            current, index = self._read_current()
+            values = self._merged_changes(current, changes)
+            try:
+                self.backend.driver.write(self.key, values, prev_index=index)
+            except drivers.ConflictError:
+                continue
+            self._load(values)
+            return values
+        raise drivers.ConflictError("{} keeps being modified".format(self.key))
+
+    async def _async_merge_changes(self):
+        """Asyncio version of _merge_changes()."""
+        _log.info("%s was modified since it was fetched, writing only the changes", self.key)
+        changes = self.dirty_fields()
+        driver = self.backend.async_driver
+        for _ in range(_MAX_MERGE_ATTEMPTS):
+            try:
+                with self.backend.driver.with_consistency(drivers.LINEARIZABLE):
+                    current, index = await driver.read_versioned(self.key)
+            except drivers.NotFoundError:
+                current, index = None, 0
+            values = self._merged_changes(current, changes)
+            try:
+                await driver.write(self.key, values, prev_index=index)
+            except drivers.ConflictError:
+                continue
+            self._load(values)
+            return values
+        raise drivers.ConflictError("{} keeps being modified".format(self.key))
+
+    @classmethod
+    def _read_current_many(cls, objects):
+        """
+        Read the current values and indexes of objects, by key, listing each
+        directory holding more than one of them instead of reading the keys one by one.
+        """
+        by_dir = defaultdict(list)
+        for obj in objects:
+            by_dir[os.path.dirname(obj.key)].append(obj)
+        current = {}
+        for path, objs in by_dir.items():
+            if len(objs) == 1:
+                current[objs[0].key] = objs[0]._read_current()
+                continue
+            try:
+                with cls.backend.driver.with_consistency(drivers.LINEARIZABLE):
+                    listing = cls.backend.driver.all_data_versioned(path)
+            except ValueError:
+                # The directory doesn't exist
+                listing = []
+            found = {
+                os.path.join(path, relpath): (values, index) for relpath, values, index in listing
+            }
+            for obj in objs:
+                current[obj.key] = found.get(obj.key, (None, 0))
+        return current
+
+    def _check_unchanged(self, values, current):
+        """
+        Check that current, as read from the backend, still holds the values last
+        seen for the object, returning values merged into it. Raises ConflictError
+        otherwise.
+        """
+        if current in (None, drivers.MALFORMED) or any(
+            current.get(k) != v for k, v in self._net_values.items()
+        ):
+            raise drivers.ConflictError("{} was modified since it was written".format(self.key))
+        return dict(current, **values)
+
+    def _forget_net_data(self):
+        """Record that we don't know what's on the backend anymore."""
+        self._net_index = None
+        self._net_values = None
+
+    def _written(self, values):
+        """Record that values were written to the backend."""
+        # We don't know the index of what we just wrote
+        self._net_index = None
+        self._net_values = copy.deepcopy(values)
+
+    @classmethod
+    def write_many(cls, objects, strict=False):
+        """
+        Write all the objects that changed with a single call to the driver.
+
+        Objects fetched at a known index are written only if they weren't modified
+        since, and otherwise get just the fields they changed written over the
+        current values. With strict, such a conflict is an error instead, and the
+        objects whose index is unknown, like those written already, are first
+        checked to still hold the values last seen.
+
+        Returns the list of the results of the writes. If some of them failed,
+        the others are still recorded as written, and a WriteError with the
+        errors of the failed ones, by key, is raised.
+        """
+        changed = []
+        for obj in objects:
+            values = obj._to_net()
+            if values == obj._net_values:
+                _log.debug("Not writing %s: no changes since it was fetched", obj.key)
+                continue
+            changed.append((obj, values))
+        current = {}
+        if strict:
+            current = cls._read_current_many(
+                [
+                    obj
+                    for obj, _ in changed
+                    if obj._net_index is None and obj._net_values is not None
+                ]
+            )
+        pending = []
+        errors = {}
+        for obj, values in changed:
+            if obj.key not in current:
+                pending.append((obj, values, values, obj._net_index))
+                continue
+            data, index = current[obj.key]
+            try:
+                pending.append((obj, values, obj._check_unchanged(values, data), index))
+            except drivers.ConflictError as e:
+                obj._forget_net_data()
+                errors[obj.key] = e
+        res = []
+        if pending:
+            writes = [(obj.key, to_write, idx) for obj, _, to_write, idx in pending]
+            try:
+                res = cls.backend.driver.write_many(writes)
+            except drivers.BackendError:
+                # We can't know which writes went through
+                for obj, _, _, _ in pending:
+                    obj._forget_net_data()
+                raise
+        for i, (obj, values, _, _) in enumerate(pending):
+            if isinstance(res[i], drivers.ConflictError) and not strict:
+                try:
+                    res[i] = obj._merge_changes()
+                    continue
+                except drivers.BackendError as e:
+                    res[i] = e
+            if isinstance(res[i], drivers.BackendError):
+                obj._forget_net_data()
+                errors[obj.key] = res[i]
+            else:
+                obj._written(values)
+        if errors:
+            raise drivers.WriteError(errors)
+        return res
+
+    @staticmethod
+    @contextmanager
+    def batch(strict=False):
+        """
+        Defer the writes of all objects within the context, and send them together
+        via write_many(), with strict, when the context exits; that raises a
+        WriteError if some of them fail. Nothing is written if the context exits
+        with an exception.
+        """
+        if getattr(_batch, "objects", None) is not None:
+            # Nested batches are written by the outermost one
+            yield
+            return
+        _batch.objects = {}
+        try:
+            yield
+            objects = list(_batch.objects.values())
+        finally:
+            _batch.objects = None
+        KVObject.write_many(objects, strict=strict)
+
+    @staticmethod
+    def bind_batch(func):
+        """
+        Wrap func so that its writes are deferred to the batch active in the
+        calling thread, if any, even when it's run in another thread.
+        """
+        objects = getattr(_batch, "objects", None)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            previous = getattr(_batch, "objects", None)
+            _batch.objects = objects
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _batch.objects = previous
+
+        return wrapper
 
     def delete(self):
         self.backend.driver.delete(self.key)
 
+    async def async_delete(self):
+        """Asyncio version of delete()."""
+        await self.backend.async_driver.delete(self.key)
+
     @classmethod
     def parse_tags(cls, taglist):
         """Given a taglist as a string, return an ordered list of tags"""
@@ -229,21 +686,127 @@ class Entity(KVObject):
     General-purpose entity with a strict schema
     """
 
+    # Classes generated by loader.factory add the schema values to the slots,
+    # so that their instances don't carry a __dict__.
+    __slots__ = (
+        "_name",
+        "_key",
+        "_current_tags",
+        "exists",
+        "_pending_fetch",
+        "_net_index",
+        "_net_values",
+    )
     # Allows to store dependencies
     depends = []
+    # Tags dicts shared among objects, see _shared_tags()
+    _tags_cache = {}
 
     def __init__(self, *tags):
+        self._setup(tags)
+        self.fetch()
+
+    def _setup(self, tags):
         if len(tags) != (len(self._tags) + 1):
             raise ValueError(
                 "Need %s as tags, %s provided" % (",".join(self._tags), ",".join(tags[:-1]))
             )
+        self._pending_fetch = False
+        self._net_index = None
+        self._net_values = None
+        tags = tuple(sys.intern(tag) for tag in tags)
         self._name = tags[-1]
         self._key = self.kvpath(*tags)
-        self._current_tags = {}
-        for i, tag in enumerate(self._tags):
-            self._current_tags[tag] = tags[i]
-        self.fetch()
-        self._defaults = {}
+        self._current_tags = self._shared_tags(tags[:-1])
+
+    @classmethod
+    def _shared_tags(cls, values):
+        """
+        Returns the tags dict for the given tag values, shared among all the objects
+        of the class with the same tags, so it must not be modified.
+        """
+        cache_key = (cls, values)
+        try:
+            return cls._tags_cache[cache_key]
+        except KeyError:
+            tags = dict(zip(cls._tags, values))
+            cls._tags_cache[cache_key] = tags
+            return tags
+
+    @classmethod
+    def from_net_data(cls, tags, values, index=None):
+        """
+        Build an object from data already read from the backend, without fetching it again.
+        A value of None means the object doesn't exist on the backend.
+        """
+        obj = cls.__new__(cls)
+        obj._setup(tags)
+        obj._load(values, index=index)
+        return obj
+
+    @classmethod
+    def lazy(cls, *tags):
+        """
+        Build an object without reading it from the backend. The data will be fetched
+        the first time a value in the schema, exists or _to_net() are accessed.
+        """
+        obj = cls.__new__(cls)
+        obj._setup(tags)
+        obj._pending_fetch = True
+        return obj
+
+    @classmethod
+    def fetch_many(cls, objects):
+        """
+        Fetch all the lazily-built objects in the list that weren't fetched yet,
+        reading each directory they belong to only once.
+        """
+        by_dir = defaultdict(list)
+        for obj in objects:
+            if obj._pending_fetch:
+                by_dir[os.path.dirname(obj.key)].append(obj)
+        for path, objs in by_dir.items():
+            if len(objs) == 1:
+                objs[0]._fetch_pending()
+                continue
+            try:
+                data = dict(cls.backend.driver.ls(path))
+            except ValueError:
+                # The directory doesn't exist, so neither do the objects
+                data = {}
+            except drivers.BackendError as e:
+                _log.error("Backend error while fetching %s: %s", path, e)
+                continue
+            for obj in objs:
+                obj._fetch_pending(data.get(obj.name))
+
+    def _fetch_pending(self, values=_UNREAD):
+        """
+        Fetch a lazily-built object, keeping the values set on it in the meantime.
+        If values are passed, they're used instead of reading from the backend.
+        """
+        local = {}
+        for key in self._schema:
+            try:
+                local[key] = object.__getattribute__(self, key)
+            except AttributeError:
+                pass
+        if values is _UNREAD:
+            self.fetch()
+        else:
+            self._load(values)
+        for key, value in local.items():
+            setattr(self, key, value)
+
+    def __getattr__(self, name):
+        # Only called when the attribute is not found, so objects built via
+        # lazy() get fetched the first time their data is needed.
+        if self._pending_fetch and (name == "exists" or name in self._schema):
+            self._fetch_pending()
+            return getattr(self, name)
+        raise AttributeError(
+            "'{}' object has no attribute '{}'".format(self.__class__.__name__, name)
+        )
 
     @property
     def key(self):
@@ -269,12 +832,13 @@ class JsonSchemaEntity(Entity):
     Specific class for json-schema based entities
     """
 
+    __slots__ = ("rules",)
     # loader gets injected into the derived classes when they get generated
     # by loader.factory
     loader = None
 
-    def __init__(self, *tags):
-        super().__init__(*tags)
+    def _setup(self, tags):
+        super()._setup(tags)
         if self.loader is not None:
             self.rules = self.loader.rules_for(self.tags, self._name)
 
@@ -290,12 +854,19 @@ class JsonSchemaEntity(Entity):
 
 
 class FreeSchemaEntity(Entity):
+    __slots__ = ("_schemaless",)
     strict_schema = False
 
     def __init__(self, *tags, **kwargs):
         self._schemaless = kwargs
         super().__init__(*tags)
 
+    def _setup(self, tags):
+        super()._setup(tags)
+        # Objects built via from_net_data() don't go through __init__
+        if not hasattr(self, "_schemaless"):
+            self._schemaless = {}
+
     def _to_net(self):
         values = super()._to_net()
         for k, v in self._schemaless.items():
@@ -1,9 +1,12 @@
+import hashlib
+import json
 import os
 import re
+import tempfile
 
 from conftool import _log, node, yaml_safe_load
 from conftool.kvobject import Entity, FreeSchemaEntity, JsonSchemaEntity
-from conftool.types import get_validator, get_json_schema
+from conftool.types import JsonSchemaLoader, get_validator, get_json_schema
 
 
 def factory(name, defs):
@@ -17,6 +20,8 @@ def factory(name, defs):
         "depends": defs.get("depends", []),
         "_schema": {},
         "_default_values": {},
+        # Instances only hold their schema values, and no __dict__
+        "__slots__": tuple(defs["schema"].keys()),
     }
 
     json_schema = defs.get("json_schema", False)
@@ -50,6 +55,63 @@ def factory(name, defs):
     return type(name, (cls,), properties)
 
 
+class CompiledSchema:
+    """
+    Compiled form of a schema file, saved under the cache path.
+
+    It holds the parsed entity definitions and the JSON schemas they reference,
+    and is only valid as long as none of those source files changed.
+    """
+
+    def __init__(self, filename, cache_path):
+        self.source = os.path.abspath(filename)
+        digest = hashlib.sha1(self.source.encode("utf-8")).hexdigest()
+        self.path = os.path.join(cache_path, "schema-{}.json".format(digest[:16]))
+
+    @staticmethod
+    def _stat(path):
+        stat = os.stat(path)
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def load(self):
+        """Return the (definitions, json schemas) tuple if up to date, None otherwise."""
+        try:
+            with open(self.path) as fh:
+                compiled = json.load(fh)
+            if compiled["source"] != self.source:
+                return None
+            for path, stat in compiled["sources"].items():
+                if self._stat(path) != stat:
+                    _log.debug("Schema source %s changed, ignoring %s", path, self.path)
+                    return None
+            return (compiled["definitions"], compiled["json_schemas"])
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return None
+
+    def save(self, definitions, sources, json_schemas):
+        """
+        Save the compiled schema. sources is a dict of paths of the json schemas to
+        the stats taken before reading them.
+        """
+        sources = dict(sources)
+        sources[self.source] = self._stat(self.source)
+        compiled = {
+            "source": self.source,
+            "sources": sources,
+            "definitions": definitions,
+            "json_schemas": json_schemas,
+        }
+        try:
+            fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=".tmp-")
+            with os.fdopen(fd, "w") as fh:
+                json.dump(compiled, fh)
+            os.chmod(tmpfile, 0o644)
+            os.replace(tmpfile, self.path)
+        except (OSError, TypeError, ValueError) as e:
+            # Not being able to cache the schema is not fatal
+            _log.debug("Could not save the compiled schema to %s: %s", self.path, e)
+
+
 class Schema:
     """
     Allows loading entities definitions from a file declaration
@@ -63,15 +125,27 @@ class Schema:
             self._add_default_entities()
 
     @classmethod
-    def from_file(cls, filename):
+    def from_file(cls, filename, cache_path=None):
         """
         Load a yaml file
+
+        If cache_path is an existing directory, the schema is compiled and saved
+        there, so that the following loads don't need to parse the sources again
+        unless they change.
         """
         instance = cls()
         if not os.path.isfile(filename):
             return instance
 
-        data = yaml_safe_load(filename, default={})
+        compiled = None
+        cached = None
+        if cache_path is not None and os.path.isdir(cache_path):
+            compiled = CompiledSchema(filename, cache_path)
+            cached = compiled.load()
+        if cached is not None:
+            data, json_schemas = cached
+        else:
+            data = yaml_safe_load(filename, default={})
         if not data:
             instance.has_errors = True
             return instance
@@ -85,6 +159,10 @@ class Schema:
             except Exception as e:
                 _log.error("Could not load entity %s: %s", objname, e, exc_info=True)
                 instance.has_errors = True
+        if cached is not None:
+            instance._preload_json_schemas(json_schemas)
+        elif compiled is not None and not instance.has_errors:
+            compiled.save(data, *instance._read_json_schemas())
         return instance
 
     @classmethod
@@ -108,5 +186,34 @@ class Schema:
                 instance.has_errors = True
         return instance
 
+    def _json_schema_rules(self):
+        for entity in self.entities.values():
+            if isinstance(getattr(entity, "loader", None), JsonSchemaLoader):
+                yield from entity.loader.rules
+
+    def _read_json_schemas(self):
+        """
+        Read the JSON schemas used by the entities, returning a tuple with the
+        stats of their files and their content, by absolute path.
+        """
+        sources = {}
+        schemas = {}
+        for rule in self._json_schema_rules():
+            path = os.path.abspath(rule.path)
+            try:
+                stat = CompiledSchema._stat(path)
+                schemas[path] = rule.schema
+            except (OSError, ValueError):
+                # Broken schemas are reported when used
+                continue
+            sources[path] = stat
+        return (sources, schemas)
+
+    def _preload_json_schemas(self, json_schemas):
+        for rule in self._json_schema_rules():
+            path = os.path.abspath(rule.path)
+            if path in json_schemas:
+                rule._schema = json_schemas[path]
+
     def _add_default_entities(self):
         self.entities["node"] = node.Node
@@ -1,14 +1,27 @@
+import os
 from collections import defaultdict
 
 from conftool import _log
+from conftool.drivers import BackendError, ConflictError, NotFoundError, WriteError
 from conftool.types import get_validator
 from conftool.kvobject import Entity
 
+# Directory holding the index of the nodes of every host, maintained by conftool-sync.
+# Every key is a hostname, and its value lists the tags of the host's nodes, e.g.
+# {"keys": ["eqiad/cache_text/nginx", "eqiad/cache_text/varnish-fe"]}
+INDEX_PATH = "_index/node"
+# Key telling if nodes were added or removed since the index was last rebuilt, in
+# which case it can't be trusted to list all the nodes of a host: {"stale": true}
+INDEX_STATUS_PATH = "_index/node-status"
+
 
 class Node(Entity):
+    __slots__ = ("weight", "pooled")
     _schema = {"weight": get_validator("int"), "pooled": get_validator("enum:yes|no|inactive")}
     _tags = ["dc", "cluster", "service"]
     _defaults = {"pooled": "inactive", "weight": 0}
+    # If this process knows the index to be stale already, so that it's marked once
+    _index_stale = False
 
     @classmethod
     def base_path(cls):
@@ -39,3 +52,121 @@ class Node(Entity):
                     for service in services:
                         transformed[dc][cluster][service].append(host)
         return super().from_yaml(transformed)
+
+    @classmethod
+    def update_index(cls):
+        """
+        Rebuild the index of the nodes of every host from the datastore, only
+        writing the entries that changed.
+        """
+        driver = cls.backend.driver
+        Node._index_stale = False
+        # Read before the nodes, so that changes made meanwhile leave the index stale
+        try:
+            _, status_index = driver.read_versioned(INDEX_STATUS_PATH)
+        except NotFoundError:
+            status_index = 0
+        hosts = defaultdict(list)
+        for labels in cls._all_keys(driver.all_keys, cls.base_path()):
+            hosts[labels[-1]].append("/".join(labels[:-1]))
+        current = dict(cls._all_keys(driver.all_data, INDEX_PATH))
+        writes = []
+        for host, keys in sorted(hosts.items()):
+            entry = {"keys": sorted(keys)}
+            if current.get(host) != entry:
+                writes.append((os.path.join(INDEX_PATH, host), entry, None))
+        if writes:
+            _log.info("Updating the index of %d hosts", len(writes))
+            errors = {
+                key: res
+                for (key, _, _), res in zip(writes, driver.write_many(writes))
+                if isinstance(res, BackendError)
+            }
+            if errors:
+                raise WriteError(errors)
+        for host in sorted(set(current) - set(hosts)):
+            _log.info("Removing %s from the index", host)
+            driver.delete(os.path.join(INDEX_PATH, host))
+        try:
+            driver.write(INDEX_STATUS_PATH, {"stale": False}, prev_index=status_index)
+        except ConflictError:
+            _log.warning("Nodes were added or removed while updating the index, leaving it stale")
+
+    @classmethod
+    def invalidate_index(cls):
+        """
+        Record that nodes were added or removed since the index was rebuilt,
+        unless this process did already.
+        """
+        if Node._index_stale:
+            return
+        try:
+            cls.backend.driver.write(INDEX_STATUS_PATH, {"stale": True})
+            Node._index_stale = True
+        except BackendError as e:
+            _log.error("Could not mark the index of the nodes as stale: %s", e)
+
+    @classmethod
+    async def async_invalidate_index(cls):
+        """Asyncio version of invalidate_index()."""
+        if Node._index_stale:
+            return
+        try:
+            await cls.backend.async_driver.write(INDEX_STATUS_PATH, {"stale": True})
+            Node._index_stale = True
+        except BackendError as e:
+            _log.error("Could not mark the index of the nodes as stale: %s", e)
+
+    def _written(self, values):
+        if not self.exists:
+            # A new node, that the index doesn't know about
+            self.invalidate_index()
+            self.exists = True
+        super()._written(values)
+
+    def delete(self):
+        super().delete()
+        self.invalidate_index()
+
+    async def async_delete(self):
+        await super().async_delete()
+        await self.async_invalidate_index()
+
+    @staticmethod
+    def _all_keys(listing, path):
+        try:
+            return listing(path)
+        except ValueError:
+            # Nothing there yet
+            return []
+
+    @classmethod
+    def from_index(cls, name):
+        """
+        Return the nodes of the host called name using the index, or None if it
+        can't be used: if the host is not indexed, if nodes were added or removed
+        since the index was rebuilt, or if some of the nodes it lists are gone.
+        """
+        driver = cls.backend.driver
+        try:
+            stale = driver.read(INDEX_STATUS_PATH).get("stale", True)
+            # Another process may have rebuilt it since we marked it
+            Node._index_stale = stale
+            if stale:
+                _log.debug("The index of the nodes is stale")
+                return None
+            entry = driver.read(os.path.join(INDEX_PATH, name))
+        except NotFoundError:
+            return None
+        objects = []
+        for key in entry.get("keys", []):
+            tags = key.split("/")
+            if len(tags) != len(cls._tags):
+                _log.warning("Ignoring the index of %s: invalid key %s", name, key)
+                return None
+            objects.append(cls.lazy(*tags, name))
+        cls.fetch_many(objects)
+        if not all(obj.exists for obj in objects):
+            _log.debug("The index of %s lists nodes that are gone", name)
+            return None
+        return objects
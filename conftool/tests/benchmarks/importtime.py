@@ -0,0 +1,71 @@
+"""Import-time benchmark of the conftool command line tools.
+
+Run it as:
+
+    python -m conftool.tests.benchmarks.importtime [NUM_RUNS]
+
+For each tool it reports the best cumulative import time, as measured by
+`python -X importtime`, over NUM_RUNS (default: 5) fresh interpreters, next to
+the time of a bare `import conftool`. The unit tests check the time of each tool
+against a multiple of the latter.
+"""
+
+import subprocess
+import sys
+
+# The modules implementing the entry points of the tools
+TOOLS = {
+    "confctl": "conftool.cli.tool",
+    "conftool-sync": "conftool.cli.syncer",
+    "conftool-server": "conftool.cli.server",
+    "dbctl": "conftool.extensions.dbconfig",
+    "requestctl": "conftool.extensions.reqconfig",
+}
+
+# Slow to import modules, that must only be imported by the code paths needing them
+LAZY_MODULES = [
+    "asyncio",
+    "icdiff",
+    "importlib.metadata",
+    "jsonschema",
+    "pkg_resources",
+    "pyparsing",
+    "tabulate",
+    "wmflib",
+]
+
+
+def import_profile(module):
+    """
+    Import module in a new interpreter, and return a tuple with its cumulative
+    import time, in microseconds, and the dict of the cumulative import times of
+    all the modules imported.
+    """
+    res = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import {}".format(module)],
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    times = {}
+    for line in res.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        times[name.strip()] = int(cumulative)
+    return (times[module], times)
+
+
+def best_time(module, runs):
+    return min(import_profile(module)[0] for _ in range(runs))
+
+
+def main(runs=5):
+    print("%-15s %7.1f ms" % ("(conftool)", best_time("conftool", runs) / 1000))
+    for tool, module in TOOLS.items():
+        print("%-15s %7.1f ms" % (tool, best_time(module, runs) / 1000))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
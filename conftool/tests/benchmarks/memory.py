@@ -0,0 +1,47 @@
+"""Memory benchmark for fleet-wide hydration of entities.
+
+Run it as:
+
+    python -m conftool.tests.benchmarks.memory [NUM_ENTITIES]
+"""
+
+import sys
+import tracemalloc
+
+from conftool import configuration, loader
+from conftool.kvobject import KVObject
+from conftool.tests.unit import MockBackend
+
+DEFS = {
+    "path": "pools",
+    "tags": ["dc", "cluster", "service"],
+    "schema": {
+        "weight": {"type": "int", "default": 0},
+        "pooled": {"type": "enum:yes|no|inactive", "default": "inactive"},
+    },
+}
+
+
+def hydrate(cls, num):
+    """Build num entities as query(hydrate=True) would."""
+    objects = []
+    for i in range(num):
+        tags = ["eqiad", "cluster%d" % (i % 20), "service%d" % (i % 5), "host%d.example.org" % i]
+        objects.append(cls.from_net_data(tags, {"weight": 10, "pooled": "yes"}))
+    return objects
+
+
+def main(num=100000):
+    KVObject.backend = MockBackend({})
+    KVObject.config = configuration.Config(driver="")
+    cls = loader.factory("node", DEFS)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = hydrate(cls, num)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print("%d entities: %.1f MiB, %d bytes/entity" % (len(objects), used / 2**20, used // num))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
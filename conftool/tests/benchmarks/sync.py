@@ -0,0 +1,69 @@
+"""Benchmark of the parsing of the data directory by conftool-sync.
+
+Run it as:
+
+    python -m conftool.tests.benchmarks.sync [NUM_HOSTS]
+
+It generates a data directory with NUM_HOSTS (default: 50000) nodes, and
+reports the time it takes to load it with the libyaml bindings and with the
+pure-Python YAML loader.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+from unittest import mock
+
+import yaml
+
+from conftool import configuration, yaml_dump
+from conftool.cli.syncer import EntitySyncer
+from conftool.kvobject import KVObject
+from conftool.node import Node
+from conftool.tests.unit import MockBackend
+
+DATACENTERS = ["eqiad", "codfw", "esams", "ulsfo", "eqsin", "drmrs"]
+
+
+def generate(rootdir, num):
+    """Write the definition of num nodes, one file per datacenter."""
+    node_path = os.path.join(rootdir, "node")
+    os.mkdir(node_path)
+    for dc in DATACENTERS:
+        clusters = {}
+        for i in range(0, num, len(DATACENTERS)):
+            cluster = clusters.setdefault("cluster%d" % (i % 50), {})
+            hosts = ["%s%d.example.org" % (dc, i)]
+            for service in range(i % 5 + 1):
+                cluster.setdefault("service%d" % service, []).extend(hosts)
+        with open(os.path.join(node_path, "%s.yaml" % dc), "w") as fh:
+            yaml_dump({dc: clusters}, fh)
+
+
+def load(rootdir):
+    start = time.monotonic()
+    syncer = EntitySyncer("node", Node)
+    syncer.load_files(rootdir)
+    return (time.monotonic() - start, len(syncer.data))
+
+
+def main(num=50000):
+    KVObject.backend = MockBackend({})
+    KVObject.config = configuration.Config(driver="")
+    rootdir = tempfile.mkdtemp()
+    try:
+        generate(rootdir, num)
+        if yaml.__with_libyaml__:
+            elapsed, objects = load(rootdir)
+            print("libyaml:     %d objects loaded in %.2f s" % (objects, elapsed))
+        with mock.patch("conftool.YamlLoader", yaml.SafeLoader):
+            elapsed, objects = load(rootdir)
+        print("pure python: %d objects loaded in %.2f s" % (objects, elapsed))
+    finally:
+        shutil.rmtree(rootdir)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -1,10 +1,12 @@
-from conftool import drivers
+from conftool import configuration, drivers
 from conftool.kvobject import KVObject, Entity, FreeSchemaEntity, JsonSchemaEntity
 from conftool.types import get_validator, JsonSchemaLoader
 
 
 class MockDriver(drivers.BaseDriver):
     def __init__(self, config):
+        # Tests often pass an empty config
+        super().__init__(configuration.Config())
         self.base_path = "/base_path/v2"
 
 
@@ -12,6 +14,7 @@ class MockBackend:
     def __init__(self, config):
         self.config = config
         self.driver = MockDriver(config)
+        self.async_driver = drivers.AsyncDriver(self.driver)
 
 
 class MockBasicEntity(KVObject):
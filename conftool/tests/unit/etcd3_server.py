@@ -0,0 +1,152 @@
+"""A minimal in-process stand-in for the etcd v3 JSON gateway, for tests."""
+
+import base64
+import copy
+import json
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def _dec(data):
+    return base64.b64decode(data).decode("utf-8")
+
+
+def _enc(data):
+    return base64.b64encode(data.encode("utf-8")).decode("ascii")
+
+
+class Etcd3StandIn:
+    """Supports range, put, deleterange and txn on a single in-memory keyspace."""
+
+    def __init__(self, users=None):
+        self.lock = threading.Lock()
+        self.revision = 1
+        self.kv = {}
+        # revision => keyspace at that revision
+        self.history = {1: {}}
+        self.users = users or {}
+        self.tokens = set()
+        self.requests = []
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers["Content-Length"])
+                data = json.loads(self.rfile.read(length))
+                with standin.lock:
+                    standin.requests.append((self.path, data))
+                    status, payload = standin.handle(self.path, data, self.headers)
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{}".format(self.server.server_address[1])
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def header(self):
+        return {"revision": str(self.revision)}
+
+    def handle(self, path, data, headers):
+        if path == "/v3/auth/authenticate":
+            if self.users.get(data["name"]) != data["password"]:
+                return 401, {"error": "authentication failed"}
+            self.tokens.add("token-" + data["name"])
+            return 200, {"header": self.header(), "token": "token-" + data["name"]}
+        if self.users and headers.get("Authorization") is None:
+            return 401, {"error": "user name is empty"}
+        if self.users and headers.get("Authorization") not in self.tokens:
+            return 401, {"error": "etcdserver: invalid auth token"}
+        if path == "/v3/kv/txn":
+            return 200, self.txn(data)
+        handler = {
+            "/v3/kv/range": self.range,
+            "/v3/kv/put": self.put,
+            "/v3/kv/deleterange": self.deleterange,
+        }.get(path)
+        if handler is None:
+            return 404, {"error": "Not Found"}
+        res = handler(data)
+        self.commit()
+        return 200, res
+
+    def commit(self):
+        if self.kv != self.history[max(self.history)]:
+            self.revision += 1
+            self.history[self.revision] = copy.deepcopy(self.kv)
+
+    def _keys(self, data, kv):
+        key = _dec(data["key"])
+        if "range_end" not in data:
+            return [key] if key in kv else []
+        end = _dec(data["range_end"])
+        return sorted(k for k in kv if key <= k < end)
+
+    def range(self, data):
+        kv = self.history[int(data["revision"])] if "revision" in data else self.kv
+        keys = self._keys(data, kv)
+        res = {"header": self.header(), "count": str(len(keys))}
+        if data.get("count_only"):
+            return res
+        limit = int(data.get("limit", 0))
+        if limit and len(keys) > limit:
+            keys = keys[:limit]
+            res["more"] = True
+        res["kvs"] = []
+        for key in keys:
+            item = {"key": _enc(key), "mod_revision": str(kv[key]["mod_revision"])}
+            if not data.get("keys_only"):
+                item["value"] = kv[key]["value"]
+            res["kvs"].append(item)
+        return res
+
+    def put(self, data):
+        key = _dec(data["key"])
+        self.kv[key] = {"value": data["value"], "mod_revision": self.revision + 1}
+        return {"header": self.header()}
+
+    def deleterange(self, data):
+        keys = self._keys(data, self.kv)
+        for key in keys:
+            del self.kv[key]
+        return {"header": self.header(), "deleted": str(len(keys))}
+
+    def txn(self, data):
+        succeeded = True
+        for cmp in data.get("compare", []):
+            assert cmp["target"] == "MOD" and cmp["result"] == "EQUAL"
+            current = self.kv.get(_dec(cmp["key"]), {"mod_revision": 0})["mod_revision"]
+            if current != int(cmp.get("mod_revision", 0)):
+                succeeded = False
+        ops = data.get("success" if succeeded else "failure", [])
+        responses = []
+        for op in ops:
+            if "request_range" in op:
+                responses.append({"response_range": self.range(op["request_range"])})
+            elif "request_put" in op:
+                responses.append({"response_put": self.put(op["request_put"])})
+            elif "request_delete_range" in op:
+                responses.append(
+                    {"response_delete_range": self.deleterange(op["request_delete_range"])}
+                )
+        self.commit()
+        res = {"header": self.header(), "responses": responses}
+        if succeeded:
+            res["succeeded"] = True
+        return res
@@ -1,6 +1,7 @@
 from unittest import mock, TestCase
 
-from conftool import backend, configuration
+from conftool import backend, configuration, drivers
+from conftool.drivers import memory
 
 
 class TestBackend(TestCase):
@@ -8,6 +9,36 @@ class TestBackend(TestCase):
         c = configuration.Config()
         bcknd = backend.Backend(c)
         self.assertEqual(bcknd.driver.base_path, "/conftool/v1")
-        with mock.patch("builtins.open", mock.mock_open) as mocker:
-            mocker.side_effect = Exception("test")
-            self.assertRaises(SystemExit, backend.Backend, c)
+        self.assertIsInstance(bcknd.async_driver, drivers.AsyncDriver)
+        for name in ["nonexistent", "cache"]:
+            self.assertRaises(SystemExit, backend.Backend, configuration.Config(driver=name))
+
+
+class TestDriverRegistry(TestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(drivers._registry, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_builtin(self):
+        self.assertEqual(drivers.get_driver("memory"), (memory.Driver, drivers.AsyncDriver))
+        # Drivers are cached
+        with mock.patch("importlib.import_module") as importer:
+            drivers.get_driver("memory")
+        importer.assert_not_called()
+
+    def test_entry_points(self):
+        class PluginDriver(memory.Driver):
+            pass
+
+        entry_point = mock.Mock()
+        entry_point.name = "plugin"
+        entry_point.load.return_value = PluginDriver
+        with mock.patch("conftool.drivers._entry_points", return_value=[entry_point]) as eps:
+            self.assertEqual(drivers.get_driver("plugin"), (PluginDriver, drivers.AsyncDriver))
+            eps.assert_called_once_with("conftool.drivers")
+            # Entry points can also refer to a module
+            entry_point.name = "module"
+            entry_point.load.return_value = memory
+            self.assertEqual(drivers.get_driver("module")[0], memory.Driver)
+            self.assertRaises(ValueError, drivers.get_driver, "other")
@@ -1,10 +1,16 @@
 import argparse
+import io
+import json
+import os
+import shutil
 import sys
+import tempfile
 
 from unittest import mock, TestCase
 
 from conftool.kvobject import KVObject
-from conftool import configuration
+from conftool import backend, configuration
+from conftool import drivers
 from conftool import node
 from conftool.tests.unit import MockBackend
 from conftool.cli import tool
@@ -99,6 +105,7 @@ class TestToolCli(TestCase):
         cli = tool.ToolCliByLabel(args)
         cli._action = "set"
         cli.entity.query = mock.MagicMock(return_value=query_result)
+        self.addCleanup(delattr, cli.entity, "query")
 
         # With args.host=False we expect input question, answering yes
         with mock.patch("builtins.input", return_value="y") as _raw:
@@ -124,6 +131,131 @@ class TestToolCli(TestCase):
             cli.host_list()
             _raw.assert_called_once_with("confctl>")
 
+    def test_stale_ok(self):
+        args = self._mock_args(taglist="dc=a,cluster=b,service=apache2", stale_ok=False)
+        t = tool.ToolCli(args)
+        driver = KVObject.backend.driver
+        driver.consistency = drivers.LINEARIZABLE
+        with t.consistency(True):
+            self.assertEqual(driver.read_consistency, drivers.LINEARIZABLE)
+        args.stale_ok = True
+        # Stale reads are only allowed for read-only commands
+        with t.consistency(False):
+            self.assertEqual(driver.read_consistency, drivers.LINEARIZABLE)
+        with t.consistency(True):
+            self.assertEqual(driver.read_consistency, drivers.SERIALIZABLE)
+        self.assertEqual(driver.read_consistency, drivers.LINEARIZABLE)
+        args = tool.parse_args(["--stale-ok", "tags", "dc=a", "--action", "get", "all"])
+        self.assertTrue(args.stale_ok)
+
+    def test_run_action_parallel(self):
+        args = self._mock_args(taglist="dc=a,cluster=b,service=apache2", quiet=True, parallel=4)
+        t = tool.ToolCli(args)
+        KVObject.backend = backend.Backend(configuration.Config(driver="memory"))
+        driver = KVObject.backend.driver
+        for i in range(10):
+            driver.write("pools/a/b/apache2/host%d" % i, {"pooled": "no", "weight": 10})
+        driver.round_trips = 0
+        with mock.patch("sys.stdout", new_callable=io.StringIO) as stdout:
+            with mock.patch.object(driver, "write_many", wraps=driver.write_many) as write_many:
+                self.assertTrue(t.run_action(("set/pooled=yes", "re:host[1-4]")))
+        # The results are printed in order, and the writes are sent together
+        self.assertEqual(
+            stdout.getvalue().splitlines(),
+            ["a/b/apache2/host%d: pooled changed no => yes" % i for i in range(1, 5)],
+        )
+        write_many.assert_called_once()
+        self.assertEqual(len(write_many.call_args[0][0]), 4)
+        self.assertEqual(driver.read("pools/a/b/apache2/host2")["pooled"], "yes")
+        self.assertEqual(driver.read("pools/a/b/apache2/host5")["pooled"], "no")
+        # Failures are reported
+        with mock.patch("sys.stdout", new_callable=io.StringIO):
+            self.assertFalse(t.run_action(("set/pooled=maybe", "re:host[1-4]")))
+        # Only the objects that were written are reported as changed
+        failure = drivers.BackendError("fail")
+
+        def write_many(items):
+            return [failure if key.endswith("host2") else value for key, value, _ in items]
+
+        with mock.patch("sys.stdout", new_callable=io.StringIO) as stdout:
+            with mock.patch.object(driver, "write_many", side_effect=write_many):
+                with self.assertLogs("conftool", "ERROR") as logs:
+                    self.assertFalse(t.run_action(("set/weight=5", "re:host[1-3]")))
+        self.assertEqual(
+            stdout.getvalue().splitlines(),
+            ["a/b/apache2/host%d: weight changed 10 => 5" % i for i in (1, 3)],
+        )
+        self.assertIn("pools/a/b/apache2/host2", "\n".join(logs.output))
+        # Without --parallel, every object is written on its own
+        t.args.parallel = 1
+        with mock.patch("sys.stdout", new_callable=io.StringIO):
+            with mock.patch.object(driver, "write_many") as write_many:
+                self.assertTrue(t.run_action(("set/weight=7", "re:host[1-3]")))
+        write_many.assert_not_called()
+        self.assertEqual(driver.read("pools/a/b/apache2/host3")["weight"], 7)
+        # Edits are never run in parallel
+        t._action = "edit"
+        self.assertEqual(t.parallel, 1)
+
+    def test_batch(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, "commands")
+        with open(filename, "w") as fh:
+            fh.write(
+                "# Comments and empty lines are skipped\n"
+                "\n"
+                "select 'name=host1' set/pooled=yes\n"
+                "tags dc=a,cluster=b,service=apache2 --action get host1 --action get host2\n"
+                "select name=host.* set/pooled=no\n"
+                "select name=host2\n"
+                "--object-type unicorn select name=host2 get\n"
+            )
+        new_client = tool.ConftoolClient
+
+        def client(**kwargs):
+            c = new_client(**kwargs)
+            for i in range(3):
+                KVObject.backend.driver.write("pools/a/b/apache2/host%d" % i, {"pooled": "no"})
+            return c
+
+        args = tool.parse_args(["--quiet", "batch", filename])
+        with mock.patch(
+            "conftool.configuration.get", return_value=configuration.Config(driver="memory")
+        ):
+            with mock.patch("conftool.cli.tool.ConftoolClient", side_effect=client) as mocker:
+                with mock.patch("sys.stdout", new_callable=io.StringIO) as stdout:
+                    with mock.patch("sys.stderr", new_callable=io.StringIO):
+                        self.assertEqual(tool.run_batch(args), 1)
+        # Only one session is set up, with the driver options of the configuration
+        mocker.assert_called_once()
+        config = mocker.call_args[1]["config"]
+        self.assertEqual(config.driver_options, {})
+        results = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual([r["line"] for r in results], [3, 4, 5, 6, 7])
+        self.assertEqual([r["success"] for r in results], [True, True, False, False, False])
+        self.assertEqual(results[0]["messages"], ["a/b/apache2/host1: pooled changed no => yes"])
+        host1, host2 = [json.loads(msg) for msg in results[1]["messages"]]
+        self.assertEqual(host1["host1"]["pooled"], "yes")
+        self.assertEqual(host2["host2"]["pooled"], "no")
+        # Selections needing a confirmation are refused
+        self.assertEqual(results[2]["error"], "The selection needs a confirmation")
+        self.assertEqual(KVObject.backend.driver.read("pools/a/b/apache2/host1")["pooled"], "yes")
+        self.assertIn("error", results[3])
+        self.assertIn("unicorn", results[4]["error"])
+        # Reads are served from the driver's snapshot only if asked to
+        with open(filename, "w") as fh:
+            fh.write("select name=host1 get\n")
+        args = tool.parse_args(["--quiet", "batch", "--read-cache", filename])
+        with mock.patch(
+            "conftool.configuration.get", return_value=configuration.Config(driver="memory")
+        ):
+            with mock.patch("conftool.cli.tool.ConftoolClient", side_effect=client) as mocker:
+                with mock.patch("sys.stdout", new_callable=io.StringIO):
+                    self.assertEqual(tool.run_batch(args), 0)
+        config = mocker.call_args[1]["config"]
+        self.assertEqual(config.driver_options, {"read_cache": True})
+
     def test_parse_args(self):
         # Taglist
         cmdline = ["tags", "dc=a,cluster=b", "--action", "get", "all"]
@@ -177,5 +309,142 @@ class TestToolCliSimpleAction(TestCase):
             mock_list.append(node.Node("dcA", "clusterA", "service{}".format(i), "foobar"))
         args = self._args()
         t = tool.ToolCliSimpleAction(args)
-        t.entity.query = mock.MagicMock(return_value=mock_list)
-        self.assertEqual(t.host_list(), mock_list)
+        with mock.patch.object(t.entity, "query", return_value=mock_list):
+            with mock.patch.object(t.entity, "from_index", return_value=None):
+                self.assertEqual(t.host_list(), mock_list)
+
+    def test_host_list_index(self):
+        args = self._args()
+        args.service = "service[12]"
+        t = tool.ToolCliSimpleAction(args)
+        args = self._args()
+        args.hostname = "other"
+        other = tool.ToolCliSimpleAction(args)
+        KVObject.backend = backend.Backend(configuration.Config(driver="memory"))
+        driver = KVObject.backend.driver
+        for i in range(4):
+            driver.write("pools/dcA/clusterA/service%d/foobar" % i, {"pooled": "no", "weight": 1})
+        driver.write("pools/dcA/clusterA/service1/other", {"pooled": "no", "weight": 1})
+        node.Node.update_index()
+        driver.round_trips = 0
+        with mock.patch.object(t.entity, "query") as query:
+            objects = t.host_list()
+        query.assert_not_called()
+        self.assertEqual([obj.tags["service"] for obj in objects], ["service1", "service2"])
+        # Two reads for the index, one for each node of the host
+        self.assertEqual(driver.round_trips, 6)
+        # Hosts not in the index are searched
+        driver.delete("_index/node/other")
+        self.assertEqual([obj.name for obj in other.host_list()], ["other"])
+
+
+class TestToolCliRolling(TestCase):
+    def setUp(self):
+        KVObject.backend = MockBackend({})
+        KVObject.config = configuration.Config(driver="")
+        self.clock = 0
+
+    def _cli(self, *options):
+        cmdline = ["--config", "conftool/tests/fixtures/config.yaml", "--schema", "/nonexistent"]
+        args = tool.parse_args(cmdline + ["rolling"] + list(options))
+        t = tool.ToolCliRolling(args)
+        t.messages = []
+        t.output = t.messages.append
+        return t
+
+    def _sleep(self, seconds):
+        self.clock += seconds
+
+    def _setup_nodes(self):
+        KVObject.backend = backend.Backend(configuration.Config(driver="memory"))
+        driver = KVObject.backend.driver
+        for i in range(1, 5):
+            driver.write("pools/dcA/clusterA/svc/host%d" % i, {"pooled": "yes", "weight": 10})
+        driver.write("pools/dcA/clusterA/other/host1", {"pooled": "yes", "weight": 10})
+        driver.write("pools/dcA/clusterA/other/host2", {"pooled": "no", "weight": 10})
+        return driver
+
+    def test_plan(self):
+        fraction = self._cli("service=svc", "--max-fraction", "0.5", "--dry-run")
+        size = self._cli("service=svc", "--batch-size", "3", "--dry-run")
+        unsafe = self._cli("name=host1", "--max-fraction", "0.5", "--dry-run")
+        ramp = self._cli("service=svc", "--ramp", "50,10", "--dry-run")
+        self._setup_nodes()
+        self.assertTrue(fraction.run_action("rolling"))
+        self.assertEqual(fraction.messages, ["Batch 1: host1, host2", "Batch 2: host3, host4"])
+        # The batch size caps the number of hosts per batch
+        self.assertTrue(size.run_action("rolling"))
+        self.assertEqual(size.messages, ["Batch 1: host1, host2, host3", "Batch 2: host4"])
+        # Half of the nodes of "other" are depooled already, so host1 can't be depooled
+        self.assertFalse(unsafe.run_action("rolling"))
+        # Invalid weight ramps are rejected
+        self.assertFalse(ramp.run_action("rolling"))
+
+    def test_run(self):
+        t = self._cli("service=svc", "--max-fraction", "0.5", "--ramp", "50,100", "--wait", "5")
+        t.args.ramp_interval = 5
+        refused = self._cli("service=svc")
+        driver = self._setup_nodes()
+        driver.round_trips = 0
+        with mock.patch("builtins.input", return_value="y"), mock.patch(
+            "conftool.cli.rolling.time.monotonic", side_effect=lambda: self.clock
+        ), mock.patch("conftool.cli.rolling.time.sleep", side_effect=self._sleep):
+            self.assertTrue(t.run_action("rolling"))
+        self.assertEqual(
+            t.messages,
+            [
+                "Batch 1/2: depooled host1, host2",
+                "Repooled host1, host2 at 50% of the weight",
+                "Batch 2/2: depooled host3, host4",
+                "Ramped host1, host2 up to 100% of the weight",
+                "Repooled host3, host4 at 50% of the weight",
+                "Ramped host3, host4 up to 100% of the weight",
+            ],
+        )
+        # One read for the snapshot, and one write per step: the first ramp step
+        # falls due with the repool of the second batch, and is written with it.
+        # Writes to nodes written already are checked with a listing first.
+        self.assertEqual(driver.round_trips, 9)
+        for i in range(1, 5):
+            self.assertEqual(
+                driver.read("pools/dcA/clusterA/svc/host%d" % i), {"pooled": "yes", "weight": 10}
+            )
+        # Nothing changes when the confirmation is refused
+        with mock.patch("builtins.input", return_value="n"):
+            self.assertRaises(SystemExit, refused.run_action, "rolling")
+        self.assertEqual(driver.read("pools/dcA/clusterA/svc/host1")["pooled"], "yes")
+
+    def test_run_conflict(self):
+        t = self._cli("service=svc", "--batch-size", "2", "--ramp", "50,100", "--wait", "5")
+        t.args.ramp_interval = 5
+        driver = self._setup_nodes()
+
+        def sleep(seconds):
+            # An operator depools host1 while its batch is down
+            if self.clock == 0:
+                driver.write("pools/dcA/clusterA/svc/host1", {"pooled": "inactive"})
+            self._sleep(seconds)
+
+        with mock.patch("builtins.input", return_value="y"), mock.patch(
+            "conftool.cli.rolling.time.monotonic", side_effect=lambda: self.clock
+        ), mock.patch("conftool.cli.rolling.time.sleep", side_effect=sleep), self.assertLogs(
+            "conftool", "ERROR"
+        ) as logs:
+            self.assertFalse(t.run_action("rolling"))
+        # host1 is left as the operator set it, host2 is repooled and ramped up
+        self.assertEqual(
+            driver.read("pools/dcA/clusterA/svc/host1"), {"pooled": "inactive", "weight": 10}
+        )
+        self.assertEqual(
+            driver.read("pools/dcA/clusterA/svc/host2"), {"pooled": "yes", "weight": 10}
+        )
+        self.assertEqual(
+            t.messages[1:],
+            ["Repooled host2 at 50% of the weight", "Ramped host2 up to 100% of the weight"],
+        )
+        # The next batch isn't touched
+        self.assertEqual(driver.read("pools/dcA/clusterA/svc/host3")["pooled"], "yes")
+        # The state of the nodes is reported
+        output = "\n".join(logs.output)
+        self.assertIn("dcA/clusterA/svc/host1: pooled=inactive, weight=10", output)
+        self.assertIn("dcA/clusterA/svc/host2: pooled=yes, weight=10", output)
@@ -95,7 +95,7 @@ class TestDbInstance(TestCase):
         self.assertEqual(len(res), 1)
         self.assertEqual(res[0].name, "db1")
         instance.entity.query.assert_called_with(
-            {"datacenter": re.compile(r"^\w+$"), "name": re.compile(r"^.*$")}
+            {"datacenter": re.compile(r"^\w+$"), "name": re.compile(r"^.*$")}, hydrate=True
         )
 
     def test_get(self):
@@ -106,7 +106,7 @@ class TestDbInstance(TestCase):
         )
         self.assertRaises(ValueError, instance.get, "db")
         instance.entity.query.assert_called_with(
-            {"datacenter": re.compile(r"^\w+$"), "name": re.compile(r"^db$")}
+            {"datacenter": re.compile(r"^\w+$"), "name": re.compile(r"^db$")}, hydrate=True
         )
         # No result => return None
         instance.entity.query = mock.MagicMock(return_value=[])
@@ -143,7 +143,10 @@ class TestDbInstance(TestCase):
             "s1": {"pooled": True, "weight": 10, "percentage": 100},
             "s2": {"pooled": True, "weight": 0, "percentage": 100},
         }
-        obj.write = mock.MagicMock()
+        # Entities have slots, so patch write() on their class
+        patcher = mock.patch.object(type(obj), "write")
+        patcher.start()
+        self.addCleanup(patcher.stop)
         return (instance, obj)
 
     def test_update(self):
@@ -364,7 +367,9 @@ class TestDbSection(TestCase):
         obj = self.section.entity("extra", "x1")
         obj.master = "db1"
         obj.min_replicas = 3
-        obj.write = mock.MagicMock()
+        patcher = mock.patch.object(type(obj), "write")
+        patcher.start()
+        self.addCleanup(patcher.stop)
         self.section.get = mock.MagicMock(return_value=obj)
 
     def test_set_master(self):
@@ -493,7 +498,7 @@ class TestDbConfig(TestCase):
         }
         self.mwconfig.query.return_value = [obj]
         self.assertEqual(self.config.live_config["eqiad"], obj.val)
-        self.mwconfig.query.assert_called_with({"name": re.compile("^dbconfig$")})
+        self.mwconfig.query.assert_called_with({"name": re.compile("^dbconfig$")}, hydrate=True)
 
     def test_config_from_dbstore(self):
         self.config.compute_config = mock.MagicMock(return_value=[])
@@ -529,7 +534,6 @@ class TestDbConfig(TestCase):
         res1 = self.config.compute_config(sections, instances)
         self.assertEqual(res1, expected)
         instances[1].sections["s3"]["groups"] = {"vslow": {"weight": 1, "pooled": True}}
-        instances[1].percentage = 10
         # Let's check groups; first of all let's verify the weights honour the percentage
         res2 = self.config.compute_config(sections, instances)
         expected["test"]["groupLoadsBySection"]["DEFAULT"] = defaultdict(OrderedDict)
@@ -1,9 +1,15 @@
+import os
+import shutil
+import socket
+import tempfile
+import time
+
 from unittest import mock, TestCase
 
 import etcd
 
-from conftool import configuration
-from conftool.drivers import BackendError
+from conftool import configuration, drivers
+from conftool.drivers import BackendError, NotFoundError
 from conftool.drivers.etcd import get_config
 from conftool import backend
 
@@ -25,6 +31,357 @@ class EtcdDriverTestCase(TestCase):
         etcd_mock.side_effect = etcd.EtcdKeyNotFound
         self.assertFalse(self.driver.is_dir("/test"))
 
+    @mock.patch("etcd.Client.read")
+    def test_consistency(self, etcd_mock):
+        etcd_mock.return_value.dir = True
+        # Reads are serializable by default
+        self.assertEqual(self.driver.consistency, drivers.SERIALIZABLE)
+        self.driver.is_dir("test")
+        etcd_mock.assert_called_with("/conftool/v1/test")
+        with self.driver.with_consistency(drivers.LINEARIZABLE):
+            self.driver.is_dir("test")
+            etcd_mock.assert_called_with("/conftool/v1/test", quorum=True)
+        self.driver.is_dir("test")
+        etcd_mock.assert_called_with("/conftool/v1/test")
+        with self.assertRaises(ValueError):
+            with self.driver.with_consistency("eventual"):
+                pass
+        c = configuration.Config(driver="etcd", driver_options={"consistency": "linearizable"})
+        driver = backend.Backend(c).driver
+        driver.is_dir("test")
+        etcd_mock.assert_called_with("/conftool/v1/test", quorum=True)
+
+    @mock.patch("etcd.Client.read")
+    def test_read_versioned(self, etcd_mock):
+        etcd_mock.return_value.dir = False
+        etcd_mock.return_value.value = '{"a": "b"}'
+        etcd_mock.return_value.modifiedIndex = 42
+        self.assertEqual(self.driver.read_versioned("test"), ({"a": "b"}, 42))
+        etcd_mock.assert_called_with("/conftool/v1/test")
+        self.assertEqual(self.driver.read("test"), {"a": "b"})
+
+    @mock.patch("etcd.Client.read")
+    @mock.patch("etcd.Client.write")
+    def test_write_prev_index(self, write_mock, read_mock):
+        write_mock.return_value.dir = False
+        write_mock.return_value.value = '{"a": "b"}'
+        # A conditional write doesn't read the key first
+        self.assertEqual(self.driver.write("test", {"a": "b"}, prev_index=42), {"a": "b"})
+        write_mock.assert_called_with("/conftool/v1/test", '{"a": "b"}', prevIndex=42)
+        read_mock.assert_not_called()
+        # Index 0 means the key must not exist
+        self.driver.write("test", {"a": "b"}, prev_index=0)
+        write_mock.assert_called_with("/conftool/v1/test", '{"a": "b"}', prevExist=False)
+        # If the key was modified in the meantime, nothing is written
+        write_mock.side_effect = etcd.EtcdCompareFailed
+        self.assertRaises(
+            drivers.ConflictError, self.driver.write, "test", {"a": "b"}, prev_index=42
+        )
+        write_mock.side_effect = etcd.EtcdAlreadyExist
+        self.assertRaises(
+            drivers.ConflictError, self.driver.write, "test", {"a": "b"}, prev_index=0
+        )
+        read_mock.assert_not_called()
+
+    @mock.patch("etcd.Client.read")
+    def test_listing(self, read_mock):
+        read_mock.return_value = etcd.EtcdResult(
+            None,
+            {
+                "key": "/conftool/v1/pools",
+                "dir": True,
+                "nodes": [
+                    {
+                        "key": "/conftool/v1/pools/eqiad",
+                        "dir": True,
+                        "nodes": [
+                            {"key": "/conftool/v1/pools/eqiad/a", "value": "{]", "modifiedIndex": 3}
+                        ],
+                    },
+                    {"key": "/conftool/v1/pools/b", "value": '{"x": 1}', "modifiedIndex": 4},
+                ],
+            },
+        )
+        # Listing keys doesn't need to decode the values
+        self.assertEqual(self.driver.all_keys("pools"), [["eqiad", "a"], ["b"]])
+        read_mock.assert_called_once_with("/conftool/v1/pools", recursive=True)
+        self.assertRaises(BackendError, self.driver.all_data, "pools")
+        # Versioned listings don't fail because of a single malformed key
+        self.assertEqual(
+            self.driver.all_data_versioned("pools"),
+            [("eqiad/a", drivers.MALFORMED, 3), ("b", {"x": 1}, 4)],
+        )
+        read_mock.return_value = etcd.EtcdResult(
+            None,
+            {
+                "key": "/conftool/v1/pools",
+                "dir": True,
+                "nodes": [
+                    {"key": "/conftool/v1/pools/eqiad", "dir": True},
+                    {"key": "/conftool/v1/pools/b", "value": '{"x": 1}', "modifiedIndex": 4},
+                ],
+            },
+        )
+        self.assertEqual(self.driver.ls("pools/"), [("eqiad", None), ("b", {"x": 1})])
+        read_mock.assert_called_with("/conftool/v1/pools/", recursive=False)
+        read_mock.side_effect = etcd.EtcdKeyNotFound
+        self.assertRaises(ValueError, self.driver.all_keys, "pools")
+
+    @mock.patch("etcd.Client.write")
+    def test_write_many(self, write_mock):
+        def write(key, value, **kwargs):
+            if key.endswith("fail"):
+                raise etcd.EtcdException("boom")
+            return etcd.EtcdResult(None, {"key": key, "value": value})
+
+        write_mock.side_effect = write
+        items = [("a", {"x": 1}, 0), ("b", {"x": 2}, 0)]
+        self.assertEqual(self.driver.write_many(items), [{"x": 1}, {"x": 2}])
+        write_mock.assert_any_call("/conftool/v1/b", '{"x": 2}', prevExist=False)
+        # All writes are attempted, and the failures reported for each key
+        items.append(("fail", {"x": 3}, 0))
+        res = self.driver.write_many(items)
+        self.assertEqual(write_mock.call_count, 5)
+        self.assertEqual(res[:2], [{"x": 1}, {"x": 2}])
+        self.assertIsInstance(res[2], BackendError)
+
+    @mock.patch("etcd.Client.read")
+    def test_read_cache(self, read_mock):
+        def result(index, action=None, **node):
+            res = etcd.EtcdResult(action, node)
+            res.etcd_index = index
+            return res
+
+        def tree(index):
+            return result(
+                index,
+                key="/conftool/v1",
+                dir=True,
+                nodes=[
+                    {
+                        "key": "/conftool/v1/pools",
+                        "dir": True,
+                        "nodes": [
+                            {"key": "/conftool/v1/pools/a", "value": '{"x": 1}', "modifiedIndex": 5}
+                        ],
+                    },
+                    {"key": "/conftool/v1/empty", "dir": True},
+                ],
+            )
+
+        events = {
+            11: result(12, "set", key="/conftool/v1/pools/b", value='{"x": 2}', modifiedIndex=11),
+            12: result(12, "delete", key="/conftool/v1/pools/a", modifiedIndex=12),
+        }
+
+        def read(key, recursive=False, wait=False, waitIndex=None, timeout=None, quorum=False):
+            if wait:
+                if waitIndex not in events:
+                    raise etcd.EtcdWatchTimedOut("timed out")
+                return events[waitIndex]
+            if recursive:
+                return tree(self.index)
+            return result(self.index, key=key, dir=True)
+
+        read_mock.side_effect = read
+        cache_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_path)
+        c = configuration.Config(
+            driver="etcd", cache_path=cache_path, driver_options={"read_cache": True}
+        )
+        # The first read loads the whole namespace, and saves it to disk
+        self.index = 10
+        driver = backend.Backend(c).driver
+        self.assertEqual(driver.read_versioned("pools/a"), ({"x": 1}, 5))
+        self.assertEqual(read_mock.call_count, 2)
+        cache_file = os.path.join(cache_path, "etcd-read-cache.json")
+        self.assertEqual(os.stat(cache_file).st_mode & 0o777, 0o600)
+        self.assertTrue(driver.is_dir("empty"))
+        self.assertEqual(driver.ls("pools"), [("a", {"x": 1})])
+        self.assertEqual(read_mock.call_count, 2)
+        # A new driver applies the changes from the snapshot's index
+        self.index = 12
+        read_mock.reset_mock()
+        driver = backend.Backend(c).driver
+        self.assertEqual(driver.all_data("pools"), [("b", {"x": 2})])
+        self.assertRaises(NotFoundError, driver.read, "pools/a")
+        read_mock.assert_called_with(
+            "/conftool/v1", recursive=True, wait=True, waitIndex=12, timeout=1
+        )
+        self.assertEqual(read_mock.call_count, 3)
+        # If nothing changed, only the current index is checked
+        read_mock.reset_mock()
+        driver = backend.Backend(c).driver
+        self.assertEqual(driver.all_keys("pools"), [["b"]])
+        read_mock.assert_called_once_with("/conftool/v1")
+        # After a write, the cache is synced again
+        with mock.patch("etcd.Client.write"):
+            driver.write("pools/c", {"x": 3}, prev_index=0)
+        self.index = 13
+        events[13] = result(
+            13, "create", key="/conftool/v1/pools/c", value='{"x": 3}', modifiedIndex=13
+        )
+        self.assertEqual(driver.read_versioned("pools/c"), ({"x": 3}, 13))
+        # If the last changes happened outside of the namespace, it's reloaded
+        self.index = 15
+        read_mock.reset_mock()
+        driver = backend.Backend(c).driver
+        self.assertEqual(driver.read("pools/a"), {"x": 1})
+        read_mock.assert_called_with("/conftool/v1", recursive=True)
+        self.assertEqual(read_mock.call_count, 3)
+        # So it is if there are too many changes to replay
+        self.index = 100
+        read_mock.reset_mock()
+        driver = backend.Backend(c).driver
+        self.assertEqual(driver.read("pools/a"), {"x": 1})
+        self.assertEqual(
+            read_mock.call_args_list,
+            [mock.call("/conftool/v1"), mock.call("/conftool/v1", recursive=True)],
+        )
+        # Reads explicitly asked to be linearizable are not served from the cache
+        read_mock.reset_mock()
+        with driver.with_consistency(drivers.LINEARIZABLE):
+            driver.read_versioned("pools/a")
+        read_mock.assert_called_once_with("/conftool/v1/pools/a", quorum=True)
+        # Reads outside of the namespace are not cached
+        read_mock.reset_mock()
+        read_mock.side_effect = None
+        read_mock.return_value.dir = True
+        self.assertTrue(driver.is_dir("/other"))
+        read_mock.assert_called_once_with("/other")
+
+    @mock.patch("etcd.Client.read")
+    def test_watch_cache(self, read_mock):
+        def result(index, action=None, **node):
+            res = etcd.EtcdResult(action, node)
+            res.etcd_index = index
+            return res
+
+        events = {}
+
+        def read(key, recursive=False, wait=False, waitIndex=None, timeout=None):
+            if wait:
+                if waitIndex not in events:
+                    raise etcd.EtcdWatchTimedOut("timed out")
+                return events[waitIndex]
+            if recursive:
+                return result(self.index, key="/conftool/v1", dir=True, nodes=[])
+            return result(self.index, key=key, dir=True)
+
+        read_mock.side_effect = read
+        cache_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_path)
+        self.index = 10
+        c = configuration.Config(driver="etcd", cache_path=cache_path)
+        self.assertFalse(backend.Backend(c).driver.watch_cache(5))
+        c = c._replace(driver_options={"read_cache": True})
+        driver = backend.Backend(c).driver
+        # Nothing changed
+        self.assertTrue(driver.watch_cache(5))
+        read_mock.assert_any_call(
+            "/conftool/v1", recursive=True, wait=True, waitIndex=11, timeout=5
+        )
+        self.assertEqual(driver.ls(""), [])
+        # Changes are applied to the cache as they happen
+        events[11] = result(
+            11, "set", key="/conftool/v1/pools/a", value='{"x": 1}', modifiedIndex=11
+        )
+        self.index = 11
+        self.assertTrue(driver.watch_cache(5))
+        read_mock.reset_mock()
+        self.assertEqual(driver.read("pools/a"), {"x": 1})
+        read_mock.assert_not_called()
+
+    def test_pool_options(self):
+        c = configuration.Config(driver="etcd", driver_options={"pool_size": 20, "keepalive": True})
+        b = backend.Backend(c)
+        driver = b.driver
+        self.assertEqual(driver.client.http.connection_pool_kw["maxsize"], 20)
+        # The asyncio interface has as many threads as connections
+        self.assertEqual(b.async_driver.max_workers, 20)
+        b = backend.Backend(configuration.Config(driver="etcd"))
+        self.assertEqual(b.async_driver.max_workers, 10)
+        c = configuration.Config(driver="etcd", driver_options={"async_workers": 4})
+        self.assertEqual(backend.Backend(c).async_driver.max_workers, 4)
+        self.assertIn(
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+            driver.client.http.connection_pool_kw["socket_options"],
+        )
+        self.assertIs(driver.read_client, driver.client)
+
+    @mock.patch("etcd.Client.update")
+    @mock.patch("etcd.Client.read", autospec=True)
+    @mock.patch("urllib3.PoolManager.request")
+    @mock.patch("etcd.Client.machines", new_callable=mock.PropertyMock)
+    def test_read_affinity(self, machines_mock, request_mock, read_mock, update_mock):
+        machines_mock.return_value = ["http://far.example.org:2379", "http://near.example.org:2379"]
+
+        def probe(method, url, **kwargs):
+            if url.startswith("http://far"):
+                time.sleep(0.01)
+            return mock.MagicMock()
+
+        request_mock.side_effect = probe
+        cache_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_path)
+        c = configuration.Config(
+            driver="etcd", cache_path=cache_path, driver_options={"read_affinity": True}
+        )
+        driver = backend.Backend(c).driver
+        self.assertEqual(request_mock.call_count, 2)
+        self.assertEqual(driver.read_client.base_uri, "http://near.example.org:2379")
+        # Both clients share the same pool of connections
+        self.assertIs(driver.read_client.http, driver.client.http)
+        # The ranking is cached
+        request_mock.reset_mock()
+        driver = backend.Backend(c).driver
+        request_mock.assert_not_called()
+        self.assertEqual(driver.read_client.base_uri, "http://near.example.org:2379")
+        # Non-quorum reads go to the nearest member, quorum ones to the configured hosts
+        read_mock.return_value = etcd.EtcdResult(None, {"key": "/test", "value": '{"a": 1}'})
+        update_mock.return_value = read_mock.return_value
+        driver.read("test")
+        driver.write("test", {"a": 2})
+        self.assertEqual(
+            [call[0][0] for call in read_mock.call_args_list],
+            [driver.read_client, driver.client],
+        )
+        # If the nearest member fails, reads revert to the configured hosts
+        read_mock.side_effect = [
+            etcd.EtcdConnectionFailed("down"),
+            etcd.EtcdResult(None, {"key": "/test", "value": '{"a": 1}'}),
+        ]
+        self.assertEqual(driver.read("test"), {"a": 1})
+        self.assertIs(driver.read_client, driver.client)
+
+    @mock.patch("urllib3.PoolManager.request")
+    @mock.patch("etcd.Client.machines", new_callable=mock.PropertyMock)
+    def test_read_affinity_fallback(self, machines_mock, request_mock):
+        machines_mock.return_value = ["http://near.example.org:2379"]
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        user_cache = os.path.join(tmpdir, "home", ".cache", "conftool")
+        c = configuration.Config(
+            driver="etcd",
+            cache_path=os.path.join(tmpdir, "missing"),
+            driver_options={"read_affinity": True, "suppress_san_warnings": False},
+        )
+        with mock.patch("conftool.drivers.etcd._user_cache_path", return_value=user_cache):
+            # A cache_path that can't be written falls back to the cache of the user
+            with mock.patch("conftool.drivers.etcd._log") as log:
+                driver = backend.Backend(c).driver
+            log.warning.assert_not_called()
+            self.assertEqual(request_mock.call_count, 1)
+            self.assertEqual(os.listdir(user_cache), ["etcd-endpoints.json"])
+            request_mock.reset_mock()
+            driver = backend.Backend(c).driver
+            request_mock.assert_not_called()
+            self.assertEqual(driver.read_client.base_uri, "http://near.example.org:2379")
+        # Failed saves leave no temporary files behind
+        with mock.patch("json.dump", side_effect=TypeError("not serializable")):
+            self.assertFalse(driver._save_ranking(os.path.join(tmpdir, "ranking.json"), {}))
+        self.assertEqual(os.listdir(tmpdir), ["home"])
+
     def test_data(self):
         mockResult = mock.MagicMock()
         mockResult.dir = True
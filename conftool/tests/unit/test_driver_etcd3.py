@@ -0,0 +1,153 @@
+import base64
+import json
+
+from unittest import TestCase
+
+from conftool import backend, configuration
+from conftool.drivers import (
+    MALFORMED,
+    SERIALIZABLE,
+    BackendError,
+    ConflictError,
+    NotFoundError,
+)
+from conftool.tests.unit.etcd3_server import Etcd3StandIn
+
+
+class Etcd3DriverTestCase(TestCase):
+    def setUp(self):
+        self.server = Etcd3StandIn()
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.driver = self.get_driver()
+
+    def get_driver(self, **options):
+        c = configuration.Config(
+            driver="etcd3", hosts=["http://127.0.0.1:1", self.server.url], driver_options=options
+        )
+        return backend.Backend(c).driver
+
+    def put(self, key, value):
+        self.server.put(
+            {
+                "key": base64.b64encode(key.encode()).decode(),
+                "value": base64.b64encode(json.dumps(value).encode()).decode(),
+            }
+        )
+        self.server.commit()
+
+    def test_read_write(self):
+        self.assertRaises(NotFoundError, self.driver.read, "pools/a")
+        # Writing a new key only succeeds if it doesn't exist
+        self.assertEqual(self.driver.write("pools/a", {"x": 1}, prev_index=0), {"x": 1})
+        data, index = self.driver.read_versioned("pools/a")
+        self.assertEqual(data, {"x": 1})
+        self.assertEqual(index, self.server.revision)
+        # Unconditional writes are merged into the current value
+        self.assertEqual(self.driver.write("pools/a", {"y": 2}), {"x": 1, "y": 2})
+        # Conditional writes fail if the key was modified since
+        self.put("/conftool/v1/pools/a", {"x": 3, "y": 2})
+        self.assertRaises(
+            ConflictError, self.driver.write, "pools/a", {"x": 1, "y": 4}, prev_index=index
+        )
+        self.assertRaises(ConflictError, self.driver.write, "pools/a", {"x": 1}, prev_index=0)
+        self.assertEqual(self.driver.read("pools/a"), {"x": 3, "y": 2})
+        _, index = self.driver.read_versioned("pools/a")
+        self.assertEqual(
+            self.driver.write("pools/a", {"x": 1, "y": 4}, prev_index=index), {"x": 1, "y": 4}
+        )
+        self.driver.delete("pools/a")
+        self.assertRaises(NotFoundError, self.driver.read, "pools/a")
+        self.assertRaises(NotFoundError, self.driver.delete, "pools/a")
+
+    def test_write_many(self):
+        self.put("/conftool/v1/pools/b", {"x": 1})
+        _, index = self.driver.read_versioned("pools/b")
+        items = [("pools/a", {"x": 1}, 0), ("pools/b", {"x": 2}, index)]
+        self.server.requests = []
+        self.assertEqual(self.driver.write_many(items), [{"x": 1}, {"x": 2}])
+        # Everything is written in a single transaction
+        self.assertEqual([path for path, _ in self.server.requests], ["/v3/kv/txn"])
+        self.assertEqual(self.driver.read("pools/b"), {"x": 2})
+        # A conflict only fails its own write
+        items = [("pools/a", {"x": 3}, 0), ("pools/b", {"y": 3}, None)]
+        res = self.driver.write_many(items)
+        self.assertIsInstance(res[0], ConflictError)
+        self.assertEqual(res[1], {"x": 2, "y": 3})
+        self.assertEqual(self.driver.read("pools/a"), {"x": 1})
+        # Transactions are split according to max_txn_ops
+        driver = self.get_driver(max_txn_ops=2)
+        self.server.requests = []
+        items = [("pools/c{}".format(i), {"x": i}, None) for i in range(5)]
+        driver.write_many(items)
+        self.assertEqual(
+            [path for path, _ in self.server.requests if path.endswith("txn")], ["/v3/kv/txn"] * 6
+        )
+        self.assertEqual(driver.read("pools/c4"), {"x": 4})
+
+    def test_listing(self):
+        self.put("/conftool/v1/pools/eqiad/a", {"x": 1})
+        self.put("/conftool/v1/pools/eqiad/b", {"x": 2})
+        self.put("/conftool/v1/pools/codfw/c", {"x": 3})
+        self.put("/conftool/v1/poolsz", {"x": 4})
+        self.assertTrue(self.driver.is_dir("pools"))
+        self.assertTrue(self.driver.is_dir("pools/eqiad/"))
+        self.assertFalse(self.driver.is_dir("pools/eqiad/a"))
+        self.assertEqual(
+            self.driver.all_keys("pools"), [["codfw", "c"], ["eqiad", "a"], ["eqiad", "b"]]
+        )
+        self.assertEqual(self.driver.all_data("pools/eqiad"), [("a", {"x": 1}), ("b", {"x": 2})])
+        self.assertEqual(self.driver.ls("pools"), [("codfw", None), ("eqiad", None)])
+        self.assertEqual(self.driver.ls("pools/eqiad"), [("a", {"x": 1}), ("b", {"x": 2})])
+        self.assertRaises(ValueError, self.driver.ls, "nope")
+        # Range reads are paginated on a consistent snapshot
+        driver = self.get_driver(page_size=2)
+        self.server.requests = []
+        data = driver.all_data_versioned("pools")
+        self.assertEqual([relpath for relpath, _, _ in data], ["codfw/c", "eqiad/a", "eqiad/b"])
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertIn("revision", self.server.requests[-1][1])
+
+    def test_consistency(self):
+        self.put("/conftool/v1/pools/a", {"x": 1})
+        self.driver.read("pools/a")
+        self.assertNotIn("serializable", self.server.requests[-1][1])
+        # Serializable reads can be served by any member
+        with self.driver.with_consistency(SERIALIZABLE):
+            self.driver.read("pools/a")
+            self.driver.all_data("pools")
+            self.driver.is_dir("pools")
+        self.assertTrue(all(data["serializable"] for _, data in self.server.requests[-3:]))
+        self.driver.write("pools/a", {"x": 2})
+        self.assertNotIn("serializable", json.dumps(self.server.requests[-1][1]))
+
+    def test_malformed_data(self):
+        self.server.put({"key": base64.b64encode(b"/conftool/v1/bad").decode(), "value": "e30="})
+        self.assertEqual(self.driver.read("bad"), {})
+        self.server.put({"key": base64.b64encode(b"/conftool/v1/bad").decode(), "value": "ew=="})
+        self.assertRaises(BackendError, self.driver.read, "bad")
+        self.assertRaises(BackendError, self.driver.all_data, "/conftool/v1")
+        # Versioned listings return the malformed values as such
+        self.assertEqual(
+            self.driver.all_data_versioned("/conftool/v1"),
+            [("bad", MALFORMED, self.server.revision)],
+        )
+
+    def test_auth(self):
+        self.server.users = {"root": "secret"}
+        self.assertRaises(BackendError, self.driver.read, "pools/a")
+        driver = self.get_driver(username="root", password="secret")
+        self.assertRaises(NotFoundError, driver.read, "pools/a")
+        self.assertEqual(driver.token, "token-root")
+        # Expired tokens are renewed
+        self.server.tokens.clear()
+        self.server.requests = []
+        self.assertRaises(NotFoundError, driver.read, "pools/a")
+        self.assertEqual(
+            [path for path, _ in self.server.requests],
+            ["/v3/kv/range", "/v3/auth/authenticate", "/v3/kv/range"],
+        )
+        # But only once per request
+        self.server.users = {"root": "changed"}
+        self.server.tokens.clear()
+        self.assertRaises(BackendError, driver.read, "pools/a")
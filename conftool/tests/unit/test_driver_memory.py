@@ -0,0 +1,125 @@
+import shutil
+import tempfile
+
+from unittest import mock, TestCase
+
+from conftool import backend, configuration, loader
+from conftool.drivers import ConflictError, NotFoundError
+from conftool.kvobject import KVObject
+
+
+class MemoryDriverTestCase(TestCase):
+    driver_name = "memory"
+
+    def get_driver(self, **options):
+        c = configuration.Config(driver=self.driver_name, driver_options=options)
+        return backend.Backend(c).driver
+
+    def setUp(self):
+        self.driver = self.get_driver()
+
+    def test_read_write(self):
+        self.assertRaises(NotFoundError, self.driver.read, "pools/a")
+        self.assertEqual(self.driver.write("pools/a", {"x": 1, "y": 2}), {"x": 1, "y": 2})
+        data, index = self.driver.read_versioned("pools/a")
+        self.assertEqual(data, {"x": 1, "y": 2})
+        # Writes at the current index replace the value, others fail
+        self.assertEqual(self.driver.write("pools/a", {"x": 2}, prev_index=index), {"x": 2})
+        self.assertRaises(ConflictError, self.driver.write, "pools/a", {"y": 3}, prev_index=index)
+        self.assertRaises(ConflictError, self.driver.write, "pools/a", {"y": 3}, prev_index=0)
+        # Unconditional writes are merged
+        self.assertEqual(self.driver.write("pools/a", {"y": 3}), {"x": 2, "y": 3})
+        self.assertGreater(self.driver.read_versioned("pools/a")[1], index)
+        # Values are not shared with the caller
+        data = self.driver.read("pools/a")
+        data["x"] = 5
+        self.assertEqual(self.driver.read("pools/a"), {"x": 2, "y": 3})
+        self.driver.delete("pools/a")
+        self.assertRaises(NotFoundError, self.driver.read, "pools/a")
+        self.assertRaises(NotFoundError, self.driver.delete, "pools/a")
+
+    def test_listing(self):
+        self.driver.write_many(
+            [
+                ("pools/eqiad/a", {"x": 1}, None),
+                ("pools/eqiad/b", {"x": 2}, None),
+                ("pools/codfw/c", {"x": 3}, None),
+                ("poolsz", {"x": 4}, None),
+            ]
+        )
+        self.assertTrue(self.driver.is_dir("pools"))
+        self.assertFalse(self.driver.is_dir("pools/eqiad/a"))
+        self.assertEqual(
+            self.driver.all_keys("pools"), [["codfw", "c"], ["eqiad", "a"], ["eqiad", "b"]]
+        )
+        self.assertEqual(self.driver.all_data("pools/eqiad"), [("a", {"x": 1}), ("b", {"x": 2})])
+        self.assertEqual(
+            [(p, d) for p, d, _ in self.driver.all_data_versioned("pools/codfw")],
+            [("c", {"x": 3})],
+        )
+        self.assertEqual(self.driver.ls("pools"), [("codfw", None), ("eqiad", None)])
+        self.assertRaises(ValueError, self.driver.ls, "nope")
+        self.assertRaises(ValueError, self.driver.all_keys, "nope")
+
+    @mock.patch("time.sleep")
+    def test_latency(self, sleep):
+        driver = self.get_driver(latency=0.01)
+        driver.write_many([("a/b", {"x": 1}, None), ("a/c", {"x": 2}, None)])
+        driver.read("a/b")
+        driver.all_data("a")
+        self.assertEqual(driver.round_trips, 3)
+        sleep.assert_called_with(0.01)
+        self.assertEqual(sleep.call_count, 3)
+
+    def test_round_trips(self):
+        """Hermetic checks of the number of round trips of common access patterns."""
+        KVObject.config = configuration.Config(driver=self.driver_name)
+        KVObject.backend = backend.Backend(KVObject.config)
+        KVObject.backend.driver = self.driver
+        Node = loader.factory(
+            "Node",
+            {
+                "path": "pools",
+                "tags": ["dc", "cluster", "service"],
+                "schema": {"weight": {"type": "int", "default": 0}},
+            },
+        )
+        for i in range(10):
+            Node.lazy("eqiad", "cache_text", "https", "cp10{:02d}".format(i)).write()
+        start = self.driver.round_trips
+        self.assertEqual(len(list(Node.query({}, hydrate=True))), 10)
+        self.assertEqual(self.driver.round_trips - start, 1)
+        objects = [
+            Node.lazy("eqiad", "cache_text", "https", "cp10{:02d}".format(i)) for i in range(10)
+        ]
+        start = self.driver.round_trips
+        Node.fetch_many(objects)
+        self.assertEqual(self.driver.round_trips - start, 1)
+        for obj in objects:
+            obj.weight = 10
+        start = self.driver.round_trips
+        with KVObject.batch():
+            for obj in objects:
+                obj.write()
+        self.assertEqual(self.driver.round_trips - start, 1)
+
+
+class FilesystemDriverTestCase(MemoryDriverTestCase):
+    driver_name = "filesystem"
+
+    def get_driver(self, **options):
+        options["root"] = self.root
+        return super().get_driver(**options)
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        super().setUp()
+
+    def test_persistence(self):
+        self.driver.write("pools/a", {"x": 1})
+        _, index = self.driver.read_versioned("pools/a")
+        driver = self.get_driver()
+        self.assertEqual(driver.read_versioned("pools/a"), ({"x": 1}, index))
+        driver.write("pools/b", {"x": 2})
+        self.assertGreater(self.driver.read_versioned("pools/b")[1], index)
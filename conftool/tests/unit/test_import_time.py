@@ -0,0 +1,22 @@
+from unittest import TestCase
+
+from conftool.tests.benchmarks.importtime import LAZY_MODULES, TOOLS, best_time, import_profile
+
+# Wall-clock timings depend on the machine and its load, so the import of each
+# tool is timed against a bare `import conftool`, which the tools can't avoid:
+# at the time of writing they all take about three times as long, so this only
+# catches gross regressions, left to test_lazy_imports to pin down.
+MAX_RATIO = 5
+
+
+class ImportTimeTestCase(TestCase):
+    def test_lazy_imports(self):
+        for tool, module in TOOLS.items():
+            _, times = import_profile(module)
+            eager = [name for name in LAZY_MODULES if name in times]
+            self.assertEqual(eager, [], "{} imports slow modules eagerly".format(tool))
+
+    def test_budget(self):
+        budget = MAX_RATIO * best_time("conftool", 5)
+        for tool, module in TOOLS.items():
+            self.assertLess(best_time(module, 5), budget, "{} is too slow to import".format(tool))
@@ -0,0 +1,68 @@
+import json
+import os
+import shutil
+import tempfile
+
+from unittest import TestCase, mock
+
+from conftool import backend, configuration
+from conftool.drivers import NotFoundError, instrumentation
+from conftool.tests.unit.etcd3_server import Etcd3StandIn
+
+
+class InstrumentationTestCase(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(instrumentation, "_enabled", True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        instrumentation.stats.reset()
+
+    def test_driver_calls(self):
+        b = backend.Backend(configuration.Config(driver="memory"))
+        self.assertIsInstance(b.driver, instrumentation.InstrumentedDriver)
+        self.assertIs(b.async_driver.driver, b.driver)
+        b.driver.write("pools/a", {"x": 1})
+        b.driver.write_many([("pools/b", {"x": 2}, None), ("pools/c", {"x": 3}, None)])
+        self.assertEqual(b.driver.read("pools/a"), {"x": 1})
+        self.assertEqual(len(b.driver.all_data("pools")), 3)
+        self.assertRaises(NotFoundError, b.driver.read, "pools/d")
+        # Other attributes are those of the driver
+        self.assertEqual(b.driver.round_trips, 5)
+        data = instrumentation.stats.asdict()
+        self.assertEqual(sorted(data["methods"]), ["all_data", "read", "write", "write_many"])
+        read = data["methods"]["read"]
+        self.assertEqual(read["calls"], 2)
+        self.assertEqual(read["errors"], 1)
+        self.assertEqual(read["bytes"], len('{"x": 1}'))
+        self.assertEqual(sum(read["histogram"].values()), 2)
+        # Both the data written and the one returned are accounted for
+        self.assertEqual(
+            data["methods"]["write_many"]["bytes"],
+            2 * len('{"x": 2}') + len('[{"x": 2}, {"x": 3}]'),
+        )
+        summary = instrumentation.stats.summary()
+        self.assertIn("write_many", summary)
+        self.assertIn("0 round trips", summary)
+
+    def test_round_trips(self):
+        server = Etcd3StandIn()
+        server.start()
+        self.addCleanup(server.stop)
+        c = configuration.Config(driver="etcd3", hosts=[server.url])
+        driver = backend.Backend(c).driver
+        driver.write("pools/a", {"x": 1})
+        driver.read("pools/a")
+        data = instrumentation.stats.asdict()
+        self.assertEqual(data["round_trips"], len(server.requests))
+        self.assertGreater(data["received_bytes"], 0)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, "timings.json")
+        instrumentation.stats.dump(filename)
+        with open(filename) as fh:
+            self.assertEqual(json.load(fh)["round_trips"], len(server.requests))
+
+    def test_disabled(self):
+        with mock.patch.object(instrumentation, "_enabled", False):
+            b = backend.Backend(configuration.Config(driver="memory"))
+        self.assertNotIsInstance(b.driver, instrumentation.InstrumentedDriver)
@@ -1,10 +1,11 @@
+import asyncio
 import json
 import re
 from collections import OrderedDict
 from unittest import TestCase, mock
 
 import pytest
-from conftool import configuration, drivers
+from conftool import backend, configuration, drivers, kvobject
 from conftool.kvobject import KVObject
 from conftool.tests.unit import (
     MockBackend,
@@ -58,6 +59,118 @@ class TestKVObject(TestCase):
         res = [el for el in MockEntity.query({"bar": re.compile("Far")})]
         self.assertEqual([], res)
 
+    def test_query_hydrate(self):
+        """
+        Test `KvObject.query` builds the objects from the recursive read when hydrating
+        """
+        MockEntity.backend.driver.all_data = mock.Mock(
+            return_value=[("Foo/Bar/test", {"a": 10, "b": "meh"}), ("Foo/Baz/test1", None)]
+        )
+        MockEntity.backend.driver.read = mock.Mock()
+        res = list(MockEntity.query({"name": re.compile("tes.*")}, hydrate=True))
+        self.assertEqual(2, len(res))
+        self.assertEqual(res[0].tags, {"foo": "Foo", "bar": "Bar"})
+        self.assertEqual(res[0]._to_net(), {"a": 10, "b": "meh"})
+        self.assertTrue(res[0].exists)
+        self.assertFalse(res[1].exists)
+        self.assertEqual(res[1].a, 1)
+        MockEntity.backend.driver.read.assert_not_called()
+        res = list(MockEntity.query({"bar": re.compile("Baz")}, hydrate=True))
+        self.assertEqual(["test1"], [el.name for el in res])
+
+    def test_query_malformed(self):
+        """
+        Test `KvObject.query` fetches the objects with malformed data one by one
+        """
+        driver = MockEntity.backend.driver
+        driver.all_data_versioned = mock.Mock(
+            return_value=[("Foo/Bar/bad", drivers.MALFORMED, 3), ("Foo/Bar/good", {"a": 2}, 4)]
+        )
+        driver.read_versioned = mock.Mock(side_effect=drivers.BackendError("malformed data"))
+        with self.assertLogs("conftool", "ERROR"):
+            res = list(MockEntity.query({"bar": re.compile("Bar")}, hydrate=True))
+        self.assertEqual(["bad", "good"], [el.name for el in res])
+        driver.read_versioned.assert_called_once_with("Mock/entity/Foo/Bar/bad")
+        self.assertFalse(res[0].exists)
+        self.assertEqual(res[1].a, 2)
+        with self.assertLogs("conftool", "ERROR"):
+            res = asyncio.run(MockEntity.async_query({"bar": re.compile("Bar")}))
+        self.assertEqual(["bad", "good"], [el.name for el in res])
+        self.assertFalse(res[0].exists)
+
+    def test_query_prefix(self):
+        """
+        Test `KvObject.query` only reads the subtrees selected by literal selectors
+        """
+        data = {
+            "Mock/entity/Foo/Bar": [("test", {"a": 10, "b": "meh"}, 3)],
+            "Mock/entity/Baz/Bar": [("test1", None, 4)],
+        }
+
+        def all_data(path):
+            if path not in data:
+                raise ValueError("{} is not a directory".format(path))
+            return data[path]
+
+        MockEntity.backend.driver.all_data_versioned = mock.Mock(side_effect=all_data)
+        res = list(MockEntity.query({"foo": re.compile("^Foo$")}, hydrate=True))
+        MockEntity.backend.driver.all_data_versioned.assert_called_once_with("Mock/entity/Foo")
+        self.assertEqual(res, [])
+        res = list(
+            MockEntity.query(
+                {"foo": re.compile("^(Foo|Baz|Qux)$"), "bar": re.compile("^Bar$")}, hydrate=True
+            )
+        )
+        self.assertEqual(["test", "test1"], [el.name for el in res])
+        self.assertEqual(res[0].tags, {"foo": "Foo", "bar": "Bar"})
+        self.assertEqual(res[0]._net_index, 3)
+        MockEntity.backend.driver.all_data_versioned.assert_any_call("Mock/entity/Qux/Bar")
+        # The subtrees are read at the consistency level, and within the batch, of the caller
+        driver = MockEntity.backend.driver
+        contexts = []
+
+        def all_data_context(path):
+            contexts.append(
+                (driver.read_consistency, getattr(kvobject._batch, "objects", None) is not None)
+            )
+            return all_data(path)
+
+        driver.all_data_versioned.side_effect = all_data_context
+        with driver.with_consistency(drivers.SERIALIZABLE), KVObject.batch():
+            list(MockEntity.query({"foo": re.compile("^(Foo|Baz)$")}, hydrate=True))
+        self.assertEqual(contexts, [(drivers.SERIALIZABLE, True)] * 2)
+        # Non-literal selectors read the whole tree
+        MockEntity.backend.driver.all_keys = mock.Mock(return_value=[["Foo", "Bar", "test"]])
+        MockEntity.backend.driver.read = mock.Mock(return_value=None)
+        res = list(MockEntity.query({"foo": re.compile("^Fo.$"), "bar": re.compile("^Bar$")}))
+        MockEntity.backend.driver.all_keys.assert_called_once_with("Mock/entity")
+        self.assertEqual(["test"], [el.name for el in res])
+
+    def test_query_prefixes(self):
+        """
+        Test `KvObject._query_prefixes` only pushes down literal selectors
+        """
+        self.assertEqual(MockEntity._query_prefixes({}), [[]])
+        self.assertEqual(MockEntity._query_prefixes({"bar": re.compile("^Bar$")}), [[]])
+        self.assertEqual(
+            MockEntity._query_prefixes(
+                {"foo": re.compile(r"^(?:Foo|cp1\.eqiad)$"), "bar": re.compile("^Bar$")}
+            ),
+            [["Foo", "Bar"], ["cp1.eqiad", "Bar"]],
+        )
+        for pattern in ["Foo", "^Foo|Bar$", "^F.o$", "^$", "^(Foo)|(Bar)$"]:
+            self.assertEqual(MockEntity._query_prefixes({"foo": re.compile(pattern)}), [[]])
+        self.assertEqual(
+            MockEntity._query_prefixes({"foo": re.compile("^Foo$", re.IGNORECASE)}), [[]]
+        )
+        # Dots alone would make paths outside of the base path
+        for pattern in [r"^\.\.$", r"^\.$", r"^(Foo|\.\.)$"]:
+            self.assertEqual(MockEntity._query_prefixes({"foo": re.compile(pattern)}), [[]])
+        MockEntity.backend.driver.all_keys = mock.Mock(return_value=[["Foo", "Bar", "test"]])
+        query = {tag: re.compile(r"^\.\.$") for tag in ["foo", "bar", "name"]}
+        self.assertEqual(list(MockEntity.query(query)), [])
+        MockEntity.backend.driver.all_keys.assert_called_once_with("Mock/entity")
+
     def test_query_wrong_tag(self):
         """
         Test `KvObject.query` returns no result when we pass a wrong tag to it.
@@ -102,8 +215,253 @@ class TestKVObject(TestCase):
         res = obj.write()
         # A driver exception gets passed to us
         MockEntity.backend.driver.write.side_effect = ValueError("bad json, bad!")
+        obj.a = 2
         self.assertRaises(ValueError, obj.write)
 
+    def test_write_prev_index(self):
+        MockEntity.backend.driver.read_versioned = mock.Mock(return_value=({"a": 5}, 42))
+        MockEntity.backend.driver.write = mock.Mock(return_value={"a": 5, "b": "FooBar"})
+        obj = MockEntity("Foo", "Baz", "new")
+        obj.a = 6
+        obj.write()
+        MockEntity.backend.driver.write.assert_called_with(
+            "Mock/entity/Foo/Baz/new", {"a": 6, "b": "FooBar"}, prev_index=42
+        )
+        # After writing, the index is unknown
+        obj.a = 5
+        obj.write()
+        MockEntity.backend.driver.write.assert_called_with(
+            "Mock/entity/Foo/Baz/new", {"a": 5, "b": "FooBar"}
+        )
+        # A missing object is written only if it still doesn't exist
+        MockEntity.backend.driver.read_versioned.side_effect = drivers.NotFoundError("test")
+        obj.fetch()
+        obj.write()
+        MockEntity.backend.driver.write.assert_called_with(
+            "Mock/entity/Foo/Baz/new", {"a": 1, "b": "FooBar"}, prev_index=0
+        )
+        # Values outside of the schema are not written conditionally
+        MockEntity.backend.driver.read_versioned = mock.Mock(return_value=({"a": 5, "z": 1}, 42))
+        obj.fetch()
+        obj.b = "changed"
+        obj.write()
+        MockEntity.backend.driver.write.assert_called_with(
+            "Mock/entity/Foo/Baz/new", {"a": 5, "b": "changed"}
+        )
+
+    def test_dirty_fields(self):
+        MockEntity.backend.driver.read = mock.Mock(return_value={"a": 5, "b": "meh"})
+        MockEntity.backend.driver.write = mock.Mock()
+        obj = MockEntity("Foo", "Bar", "test")
+        self.assertEqual(obj.dirty_fields(), {})
+        # No-op writes are skipped
+        obj.write()
+        MockEntity.backend.driver.write.assert_not_called()
+        obj.a = 10
+        self.assertEqual(obj.dirty_fields(), {"a": 10})
+        obj.write()
+        MockEntity.backend.driver.write.assert_called_once_with(
+            "Mock/entity/Foo/Bar/test", {"a": 10, "b": "meh"}
+        )
+        self.assertEqual(obj.dirty_fields(), {})
+        # Fields that were missing or invalid on the backend are dirty, so that
+        # writing the object repairs them
+        MockEntity.backend.driver.read.return_value = {"a": "invalid"}
+        obj.fetch()
+        self.assertEqual(obj.dirty_fields(), {"a": 1, "b": "FooBar"})
+        MockEntity.backend.driver.write.reset_mock()
+        obj.write()
+        MockEntity.backend.driver.write.assert_called_once_with(
+            "Mock/entity/Foo/Bar/test", {"a": 1, "b": "FooBar"}
+        )
+        # Objects that don't exist are entirely dirty
+        MockEntity.backend.driver.read.side_effect = drivers.NotFoundError("test")
+        obj.fetch()
+        self.assertEqual(obj.dirty_fields(), {"a": 1, "b": "FooBar"})
+
+    def test_write_conflict(self):
+        KVObject.backend = backend.Backend(configuration.Config(driver="memory"))
+        driver = KVObject.backend.driver
+        key = "Mock/entity/Foo/Bar/test"
+        driver.write(key, {"a": 5, "b": "meh"})
+        obj = MockEntity("Foo", "Bar", "test")
+        # Modified since it was fetched: only the changed fields are written
+        driver.write(key, {"b": "other"})
+        obj.a = 6
+        obj.write()
+        self.assertEqual(driver.read(key), {"a": 6, "b": "other"})
+        self.assertEqual(obj.b, "other")
+        obj.fetch()
+        driver.write(key, {"b": "again"})
+        obj.a = 7
+        asyncio.run(obj.async_write())
+        self.assertEqual(driver.read(key), {"a": 7, "b": "again"})
+        obj.fetch()
+        driver.write(key, {"b": "more"})
+        obj.a = 8
+        KVObject.write_many([obj])
+        self.assertEqual(driver.read(key), {"a": 8, "b": "more"})
+        # In a strict batch, a conflict is an error
+        obj.fetch()
+        driver.write(key, {"b": "last"})
+        with self.assertRaises(drivers.WriteError) as cm:
+            with KVObject.batch(strict=True):
+                obj.a = 9
+                obj.write()
+        self.assertIsInstance(cm.exception.errors[key], drivers.ConflictError)
+        self.assertEqual(driver.read(key), {"a": 8, "b": "last"})
+        # Including for objects written already, if they changed since
+        obj.fetch()
+        obj.a = 9
+        KVObject.write_many([obj], strict=True)
+        obj.a = 10
+        KVObject.write_many([obj], strict=True)
+        self.assertEqual(driver.read(key), {"a": 10, "b": "last"})
+        driver.write(key, {"b": "changed"})
+        obj.a = 11
+        self.assertRaises(drivers.WriteError, KVObject.write_many, [obj], strict=True)
+        self.assertEqual(driver.read(key), {"a": 10, "b": "changed"})
+        # Objects in the same directory are checked with a single listing
+        other = MockEntity("Foo", "Bar", "other")
+        other.a = 2
+        obj.fetch()
+        obj.a = 12
+        KVObject.write_many([obj, other], strict=True)
+        obj.a, other.a = 13, 3
+        driver.round_trips = 0
+        KVObject.write_many([obj, other], strict=True)
+        self.assertEqual(driver.round_trips, 2)
+        driver.delete("Mock/entity/Foo/Bar/other")
+        obj.a, other.a = 14, 4
+        with self.assertRaises(drivers.WriteError) as cm:
+            KVObject.write_many([obj, other], strict=True)
+        self.assertEqual(list(cm.exception.errors), ["Mock/entity/Foo/Bar/other"])
+        self.assertEqual(driver.read(key), {"a": 14, "b": "changed"})
+
+    def test_write_conflict_stale_reads(self):
+        KVObject.backend = backend.Backend(
+            configuration.Config(driver="memory", driver_options={"consistency": "serializable"})
+        )
+        driver = KVObject.backend.driver
+        key = "Mock/entity/Foo/Bar/test"
+        driver.write(key, {"a": 5, "b": "meh"})
+        obj = MockEntity("Foo", "Bar", "test")
+        # Serializable reads, like those of a follower or a cache, lag behind
+        stale = driver.read_versioned(key)
+        read_versioned = driver.read_versioned
+
+        def lagging_read(path):
+            if driver.read_consistency == drivers.LINEARIZABLE:
+                return read_versioned(path)
+            return stale
+
+        driver.write(key, {"b": "other"})
+        # Conflicts are resolved reading the latest values
+        with mock.patch.object(driver, "read_versioned", side_effect=lagging_read):
+            obj.a = 6
+            obj.write()
+            self.assertEqual(read_versioned(key)[0], {"a": 6, "b": "other"})
+            obj.fetch()
+            stale = read_versioned(key)
+            driver.write(key, {"b": "again"})
+            obj.a = 7
+            asyncio.run(obj.async_write())
+            self.assertEqual(read_versioned(key)[0], {"a": 7, "b": "again"})
+
+    def test_write_many(self):
+        MockEntity.backend.driver.read_versioned = mock.Mock(
+            return_value=({"a": 5, "b": "FooBar"}, 42)
+        )
+        MockEntity.backend.driver.write = mock.Mock(return_value={"a": 6, "b": "FooBar"})
+        objs = [MockEntity("Foo", "Bar", "test"), MockEntity("Foo", "Bar", "test1")]
+        objs[1].a = 6
+        with mock.patch.object(
+            MockEntity.backend.driver, "write_many", wraps=MockEntity.backend.driver.write_many
+        ) as write_many:
+            # Unchanged objects are skipped
+            self.assertEqual(MockEntity.write_many(objs), [{"a": 6, "b": "FooBar"}])
+            write_many.assert_called_once_with(
+                [("Mock/entity/Foo/Bar/test1", {"a": 6, "b": "FooBar"}, 42)]
+            )
+            self.assertEqual(objs[1].dirty_fields(), {})
+            self.assertEqual(MockEntity.write_many(objs), [])
+            # If the write fails, we don't know what's on the backend anymore
+            write_many.side_effect = drivers.BackendError("fail")
+            objs[0].a = 7
+            self.assertRaises(drivers.BackendError, MockEntity.write_many, objs)
+            self.assertEqual(objs[0].dirty_fields(), {"a": 7, "b": "FooBar"})
+            # Writes failing on their own don't affect the others
+            write_many.side_effect = None
+            write_many.return_value = [drivers.BackendError("fail"), {"a": 8}]
+            objs[1].a = 8
+            with self.assertRaises(drivers.WriteError) as cm:
+                MockEntity.write_many(objs)
+            self.assertEqual(list(cm.exception.errors), ["Mock/entity/Foo/Bar/test"])
+            self.assertEqual(objs[0].dirty_fields(), {"a": 7, "b": "FooBar"})
+            self.assertEqual(objs[1].dirty_fields(), {})
+
+    def test_batch(self):
+        MockEntity.backend.driver.read_versioned = mock.Mock(return_value=({"a": 5}, 42))
+        MockEntity.backend.driver.write = mock.Mock()
+        MockEntity.backend.driver.write_many = mock.Mock(return_value=[{"a": 6, "b": "meh"}])
+        obj = MockEntity("Foo", "Bar", "test")
+        with KVObject.batch():
+            obj.a = 6
+            obj.write()
+            with KVObject.batch():
+                obj.b = "meh"
+                obj.write()
+            MockEntity.backend.driver.write_many.assert_not_called()
+        # The object is written once, with its latest values
+        MockEntity.backend.driver.write_many.assert_called_once_with(
+            [("Mock/entity/Foo/Bar/test", {"a": 6, "b": "meh"}, 42)]
+        )
+        MockEntity.backend.driver.write.assert_not_called()
+        # Nothing is written if the batch fails
+        MockEntity.backend.driver.write_many.reset_mock()
+        with self.assertRaises(ValueError):
+            with KVObject.batch():
+                obj.a = 7
+                obj.write()
+                raise ValueError("fail")
+        MockEntity.backend.driver.write_many.assert_not_called()
+        # Outside of a batch, writes go through immediately
+        obj.write()
+        MockEntity.backend.driver.write.assert_called_once_with(
+            "Mock/entity/Foo/Bar/test", {"a": 7, "b": "meh"}
+        )
+
+    def test_async(self):
+        driver = MockEntity.backend.driver
+        driver.read_versioned = mock.Mock(return_value=({"a": 5, "b": "meh"}, 42))
+        driver.write = mock.Mock(return_value={"a": 6, "b": "meh"})
+        driver.delete = mock.Mock()
+        driver.all_data_versioned = mock.Mock(
+            return_value=[("Foo/Bar/test", {"a": 10, "b": "meh"}, 3), ("Foo/Baz/test1", None, 0)]
+        )
+
+        async def run():
+            objs = [MockEntity.lazy("Foo", "Bar", "test{}".format(i)) for i in range(5)]
+            await asyncio.gather(*[obj.async_fetch() for obj in objs])
+            for obj in objs:
+                obj.a = 6
+            res = await asyncio.gather(*[obj.async_write() for obj in objs])
+            await objs[0].async_delete()
+            found = await MockEntity.async_query({"bar": re.compile("Bar")})
+            return objs, res, found
+
+        objs, res, found = asyncio.run(run())
+        self.assertEqual(driver.read_versioned.call_count, 5)
+        self.assertTrue(objs[0].exists)
+        self.assertEqual(res, [{"a": 6, "b": "meh"}] * 5)
+        driver.write.assert_any_call(
+            "Mock/entity/Foo/Bar/test3", {"a": 6, "b": "meh"}, prev_index=42
+        )
+        self.assertEqual(objs[0].dirty_fields(), {})
+        driver.delete.assert_called_once_with("Mock/entity/Foo/Bar/test0")
+        self.assertEqual([obj.name for obj in found], ["test"])
+        self.assertEqual(found[0]._net_index, 3)
+
     def test_delete(self):
         MockEntity.backend.driver.delete = mock.Mock(return_value=None)
         obj = MockEntity("Foo", "Baz", "new")
@@ -208,6 +566,48 @@ class TestEntity(TestCase):
         self.assertEqual(MockEntity.dir("Foo", "Bar"), "Mock/entity/Foo/Bar")
         self.assertRaises(ValueError, MockEntity.dir, "Foo")
 
+    def test_lazy(self):
+        MockEntity.backend.driver.read = mock.Mock(return_value={"a": 5, "b": "meh"})
+        obj = MockEntity.lazy("Foo", "Bar", "test")
+        self.assertEqual(obj.pprint(), "Foo/Bar/test")
+        self.assertEqual(obj.tags, {"foo": "Foo", "bar": "Bar"})
+        MockEntity.backend.driver.read.assert_not_called()
+        # Accessing a value fetches the object, only once
+        self.assertEqual(obj.a, 5)
+        self.assertTrue(obj.exists)
+        self.assertEqual(obj.b, "meh")
+        MockEntity.backend.driver.read.assert_called_once_with("Mock/entity/Foo/Bar/test")
+        with self.assertRaises(AttributeError):
+            obj.c
+
+    def test_lazy_keeps_local_values(self):
+        MockEntity.backend.driver.read = mock.Mock(return_value={"a": 5, "b": "meh"})
+        obj = MockEntity.lazy("Foo", "Bar", "test")
+        obj.a = 10
+        self.assertEqual(obj._to_net(), {"a": 10, "b": "meh"})
+        MockEntity.backend.driver.read.assert_called_once_with("Mock/entity/Foo/Bar/test")
+
+    def test_fetch_many(self):
+        MockEntity.backend.driver.read = mock.Mock(return_value={"a": 5, "b": "single"})
+        MockEntity.backend.driver.ls = mock.Mock(
+            return_value=[("test", {"a": 2, "b": "listed"}), ("other", {})]
+        )
+        objs = [
+            MockEntity.lazy("Foo", "Bar", "test"),
+            MockEntity.lazy("Foo", "Bar", "missing"),
+            MockEntity.lazy("Foo", "Baz", "alone"),
+        ]
+        MockEntity.fetch_many(objs)
+        MockEntity.backend.driver.ls.assert_called_once_with("Mock/entity/Foo/Bar")
+        MockEntity.backend.driver.read.assert_called_once_with("Mock/entity/Foo/Baz/alone")
+        self.assertEqual(objs[0].b, "listed")
+        self.assertFalse(objs[1].exists)
+        self.assertEqual(objs[1].b, "FooBar")
+        self.assertEqual(objs[2].b, "single")
+        # Nothing is left to fetch
+        MockEntity.fetch_many(objs)
+        self.assertEqual(MockEntity.backend.driver.ls.call_count, 1)
+
 
 class TestFreeSchemaObject(TestCase):
     def setUp(self):
@@ -1,9 +1,12 @@
 import os
+import shutil
+import tempfile
 
 from unittest import mock, TestCase
 
 import yaml
 
+import conftool
 from conftool import loader
 from conftool.kvobject import KVObject, Entity, FreeSchemaEntity
 from conftool import configuration
@@ -62,6 +65,18 @@ class FactoryTestCase(TestCase):
         with self.assertRaises(ValueError):
             Test.dir("a", "b", "c")
 
+    def test_slots(self):
+        """Test that instances use slots and share their tags"""
+        Test = loader.factory("Test", self.base_defs)
+        t1 = Test.from_net_data(["entity", "foo", "a"], {"astring": "bar"})
+        t2 = Test.from_net_data(["entity", "foo", "b"], {})
+        self.assertFalse(hasattr(t1, "__dict__"))
+        self.assertEqual(t1.astring, "bar")
+        self.assertEqual(t2.astring, "foo")
+        self.assertIs(t1._current_tags, t2._current_tags)
+        with self.assertRaises(AttributeError):
+            t1.notinschema = True
+
     def test_depends(self):
         """Test that dependencies are set as expected"""
         Test = loader.factory("Test", self.base_defs)
@@ -101,11 +116,39 @@ class SchemaTestCase(TestCase):
         self.assertListEqual(sorted(schema.entities.keys()), ["node", "pony", "unicorn"])
         self.assertTrue(schema.has_errors)
         # Case 3: invalid yaml
-        with mock.patch("conftool.yaml.safe_load") as mocker:
+        with mock.patch("conftool.yaml_load") as mocker:
             mocker.side_effect = yaml.YAMLError("something unexpected")
             schema = loader.Schema.from_file(self.schema_file)
             self.assertTrue(schema.has_errors)
         # Case 4: generic exception is *not* handled
-        with mock.patch("conftool.yaml.safe_load") as mocker:
+        with mock.patch("conftool.yaml_load") as mocker:
             mocker.side_effect = Exception("something unexpected")
             self.assertRaises(Exception, loader.Schema.from_file, self.schema_file)
+
+    def test_compiled_schema(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        cache_path = os.path.join(tmpdir, "cache")
+        os.mkdir(cache_path)
+        schema_file = os.path.join(tmpdir, "schema.yaml")
+        shutil.copy(self.schema_file, schema_file)
+        schema = loader.Schema.from_file(schema_file, cache_path=cache_path)
+        self.assertEqual(len(os.listdir(cache_path)), 1)
+        # The schema is now loaded from the cache, including the json schemas
+        with mock.patch("conftool.yaml_load") as mocker:
+            cached = loader.Schema.from_file(schema_file, cache_path=cache_path)
+        mocker.assert_not_called()
+        self.assertFalse(cached.has_errors)
+        self.assertEqual(set(cached.entities.keys()), set(schema.entities.keys()))
+        self.assertEqual(cached.entities["pony"].base_path(), "ponies")
+        rule = cached.entities["horse"].loader.rules[0]
+        self.assertEqual(rule._schema, schema.entities["horse"].loader.rules[0].schema)
+        # Modifying the source invalidates the cache
+        with open(schema_file, "a") as fh:
+            fh.write("\n")
+        with mock.patch("conftool.yaml_load", wraps=conftool.yaml_load) as mocker:
+            loader.Schema.from_file(schema_file, cache_path=cache_path)
+        mocker.assert_called_once()
+        # A missing cache directory is ignored
+        schema = loader.Schema.from_file(schema_file, cache_path=os.path.join(tmpdir, "missing"))
+        self.assertFalse(schema.has_errors)
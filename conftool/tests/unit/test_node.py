@@ -1,7 +1,9 @@
+import asyncio
+
 from unittest import mock, TestCase
 
 from conftool.kvobject import KVObject
-from conftool import node, drivers
+from conftool import backend, node, drivers
 from conftool import configuration
 from conftool.tests.unit import MockBackend
 
@@ -22,6 +24,7 @@ class TestNode(TestCase):
     def setUp(self):
         KVObject.backend = MockBackend({})
         KVObject.config = configuration.Config(driver="")
+        node.Node._index_stale = False
 
     @mock.patch("conftool.node.Node.get_default")
     def test_new_node(self, mocker):
@@ -60,3 +63,67 @@ class TestNode(TestCase):
 
     def test_dir(self):
         self.assertEqual(node.Node.dir("a", "b", "c"), "pools/a/b/c")
+
+    def test_index(self):
+        KVObject.backend = backend.Backend(configuration.Config(driver="memory"))
+        driver = KVObject.backend.driver
+        # Nothing to index
+        node.Node.update_index()
+        self.assertIsNone(node.Node.from_index("foo"))
+        for key in ["a/b/c/foo", "a/b/d/foo", "a/b/c/bar"]:
+            driver.write("pools/" + key, {"pooled": "yes", "weight": 10})
+        # The index is only used once it's built
+        self.assertEqual(driver.read("_index/node-status"), {"stale": False})
+        driver.delete("_index/node-status")
+        node.Node.update_index()
+        self.assertEqual(driver.read("_index/node/foo"), {"keys": ["a/b/c", "a/b/d"]})
+        nodes = node.Node.from_index("foo")
+        self.assertEqual([n.pprint() for n in nodes], ["a/b/c/foo", "a/b/d/foo"])
+        # If some of the nodes are gone, the index can't be used
+        driver.delete("pools/a/b/c/bar")
+        driver.delete("pools/a/b/d/foo")
+        self.assertIsNone(node.Node.from_index("foo"))
+        # Only the entries that changed are written
+        with mock.patch.object(driver, "write_many", wraps=driver.write_many) as write_many:
+            node.Node.update_index()
+        write_many.assert_called_once_with([("_index/node/foo", {"keys": ["a/b/c"]}, None)])
+        self.assertRaises(drivers.NotFoundError, driver.read, "_index/node/bar")
+        self.assertEqual([n.pprint() for n in node.Node.from_index("foo")], ["a/b/c/foo"])
+        # Adding or removing nodes makes the index stale, until it's rebuilt
+        new = node.Node("a", "b", "e", "foo")
+        new.write()
+        self.assertEqual(driver.read("_index/node-status"), {"stale": True})
+        self.assertIsNone(node.Node.from_index("foo"))
+        node.Node.update_index()
+        self.assertEqual(len(node.Node.from_index("foo")), 2)
+        new.delete()
+        self.assertIsNone(node.Node.from_index("foo"))
+        # Changes made while the index is rebuilt leave it stale
+        node.Node.update_index()
+        all_keys = driver.all_keys
+
+        def add_node(path):
+            node.Node("a", "b", "e", "foo").write()
+            return all_keys(path)
+
+        with mock.patch.object(driver, "all_keys", side_effect=add_node):
+            node.Node.update_index()
+        self.assertIsNone(node.Node.from_index("foo"))
+
+    def test_invalidate_index(self):
+        KVObject.backend = backend.Backend(configuration.Config(driver="memory"))
+        driver = KVObject.backend.driver
+        node.Node.update_index()
+        # The index is marked stale once, however many nodes are added or removed
+        with mock.patch.object(driver, "write", wraps=driver.write) as write:
+            for i in range(5):
+                node.Node("a", "b", "c", "host%d" % i).write()
+            node.Node("a", "b", "c", "host0").delete()
+            asyncio.run(node.Node("a", "b", "c", "host1").async_delete())
+        status = [c for c in write.call_args_list if c[0][0] == "_index/node-status"]
+        self.assertEqual(status, [mock.call("_index/node-status", {"stale": True})])
+        # Until it's rebuilt
+        node.Node.update_index()
+        self.assertEqual(driver.read("_index/node-status"), {"stale": False})
+        asyncio.run(node.Node("a", "b", "c", "host2").async_delete())
+        self.assertEqual(driver.read("_index/node-status"), {"stale": True})
@@ -23,13 +23,15 @@ def schema():
 @pytest.fixture
 def requestctl():
     args = argparse.Namespace(debug=True, config=None, command="commit")
-    # We need to patch validate_pattern and validate_ipblock early, before we actually build the object.
+    # We need to patch validate_pattern and validate_ipblock early, before we actually build the grammar.
     with mock.patch(
         "conftool.extensions.reqconfig.Requestctl._validate_pattern"
     ) as val, mock.patch("conftool.extensions.reqconfig.Requestctl._validate_ipblock") as ipb:
         ipb.return_value = None
         val.return_value = None
         req = Requestctl(args)
+        # The grammar is built lazily
+        req.expression_grammar
         kvobject.KVObject.backend = MockBackend({})
         kvobject.KVObject.config = configuration.Config(driver="")
 
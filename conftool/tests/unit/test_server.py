@@ -0,0 +1,103 @@
+import argparse
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+
+from unittest import TestCase, mock
+
+from conftool import configuration
+from conftool.cli import ConftoolClient, server, tool
+from conftool.kvobject import KVObject
+
+SCHEMA = "conftool/tests/fixtures/schema.yaml"
+
+
+class ServerTestCase(TestCase):
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.config_file = os.path.join(tmpdir, "config.yaml")
+        self.path = os.path.join(tmpdir, "conftool.sock")
+        self.client = ConftoolClient(config=configuration.Config(driver="memory"), schema={})
+        self.driver = KVObject.backend.driver
+        for i in range(3):
+            self.driver.write("pools/a/b/apache2/host%d" % i, {"pooled": "no", "weight": 10})
+        self.server = server.Server(self.path, self.client, self.config_file, SCHEMA)
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def request(self, **req):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self.path)
+            sock.sendall(json.dumps(req).encode("utf-8") + b"\n")
+            with sock.makefile("r") as fh:
+                return json.loads(fh.readline())
+
+    def test_socket_mode(self):
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o660)
+
+    def test_get_select(self):
+        res = self.request(op="get", tags=["a", "b", "apache2"], name="host1")
+        self.assertTrue(res["success"])
+        self.assertEqual(res["result"]["host1"]["weight"], 10)
+        res = self.request(op="get", tags=["a", "b", "apache2"], name="host4")
+        self.assertEqual(res, {"success": False, "error": "a/b/apache2/host4 not found"})
+        res = self.request(op="select", selector="name=host[12]")
+        self.assertEqual(sorted(list(obj)[0] for obj in res["result"]), ["host1", "host2"])
+        self.assertFalse(self.request(op="select", entity="unicorn", selector="a=b")["success"])
+        self.assertIn("Invalid request", self.request(op="get")["error"])
+        self.assertIn("Unknown operation", self.request(op="nope")["error"])
+
+    def test_set(self):
+        with mock.patch("conftool.cli.server._irc") as irc:
+            res = self.request(op="set", selector="name=host[12]", values={"pooled": "yes"})
+        self.assertTrue(res["success"])
+        self.assertEqual(len(res["result"]), 2)
+        self.assertEqual(self.driver.read("pools/a/b/apache2/host2")["pooled"], "yes")
+        self.assertEqual(self.driver.read("pools/a/b/apache2/host0")["pooled"], "no")
+        irc.warning.assert_called_once()
+        res = self.request(op="set", selector="name=host1", values={"pooled": "maybe"})
+        self.assertFalse(res["success"])
+
+    def test_confctl(self):
+        args = argparse.Namespace(config=self.config_file, schema=SCHEMA)
+        cmdline = ["--quiet", "select", "name=host1", "set/weight=5"]
+        res = server.remote_command(self.path, cmdline, args)
+        self.assertTrue(res["success"])
+        self.assertEqual(res["messages"], ["a/b/apache2/host1: weight changed 10 => 5"])
+        res = server.remote_command(self.path, ["select", "name=host1", "get"], args)
+        self.assertEqual(json.loads(res["messages"][0])["host1"]["weight"], 5)
+        res = server.remote_command(self.path, ["--quiet", "select", "name=host1", "set/x"], args)
+        self.assertFalse(res["success"])
+        self.assertTrue(any("Could not parse set instructions" in line for line in res["log"]))
+        # Commands needing a confirmation, or another configuration, run locally
+        self.assertIsNone(server.remote_command(self.path, ["select", "name=.*", "delete"], args))
+        # ...unless some earlier action already ran, which must not be run again
+        cmdline = ["--quiet", "tags", "dc=a,cluster=b,service=apache2"]
+        cmdline += ["--action", "set/weight=7", "host1", "--action", "set/pooled=yes", "all"]
+        res = server.remote_command(self.path, cmdline, args)
+        self.assertFalse(res["success"])
+        self.assertNotIn("fallback", res)
+        self.assertEqual(res["error"], "The selection needs a confirmation")
+        self.assertEqual(res["messages"], ["a/b/apache2/host1: weight changed 5 => 7"])
+        self.assertEqual(self.driver.read("pools/a/b/apache2/host0")["pooled"], "no")
+        args.config = "/etc/other.yaml"
+        self.assertIsNone(server.remote_command(self.path, cmdline, args))
+        self.assertIsNone(server.remote_command(self.path + ".missing", cmdline, args))
+
+    def test_thin_client(self):
+        cmdline = ["--config", self.config_file, "--schema", SCHEMA, "--server-socket", self.path]
+        args = tool.parse_args(cmdline + ["select", "name=host1", "get"])
+        self.assertTrue(tool.use_server(args))
+        for extra in [["--local"], ["--timings"]]:
+            self.assertFalse(tool.use_server(tool.parse_args(extra + cmdline + ["pool"])))
+        args = tool.parse_args(cmdline + ["select", "name=host1", "edit"])
+        self.assertFalse(tool.use_server(args))
+        with mock.patch("builtins.print") as mocker:
+            self.assertEqual(tool.run_remote(args, cmdline + ["select", "name=host1", "get"]), 0)
+        self.assertEqual(json.loads(mocker.call_args[0][0])["host1"]["pooled"], "no")
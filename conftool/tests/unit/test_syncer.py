@@ -3,11 +3,11 @@ import os
 from unittest import mock, TestCase
 
 from conftool import configuration, loader
+from conftool.drivers import BackendError
 from conftool.cli.syncer import Syncer, EntitySyncer
 from conftool.tests.unit import MockBackend
 from conftool.kvobject import KVObject
 
-
 test_base = os.path.realpath(os.path.join(os.path.dirname(__file__), os.path.pardir))
 
 
@@ -79,14 +79,17 @@ class EntitySyncerTestCase(TestCase):
         )
         obj = mock.Mock()
         obj.exists = False
-        e.cls = mock.Mock(return_value=obj)
+        e.cls = mock.Mock()
+        e.cls.lazy.return_value = obj
         e.load()
-        e.cls.assert_any_call("dc1", "clusterA", "https", "serv1")
-        e.cls.assert_any_call("dc2", "clusterB", "https", "serv2")
+        e.cls.lazy.assert_any_call("dc1", "clusterA", "https", "serv1")
+        e.cls.lazy.assert_any_call("dc2", "clusterB", "https", "serv2")
+        e.cls.fetch_many.assert_called_with([obj, obj])
+        self.assertEqual(obj.write.call_count, 2)
         e.do_removal = True
         obj.exists = True
         e.cleanup()
-        e.cls.assert_called_with("dc1", "clusterA", "https", "serv2")
+        e.cls.lazy.assert_called_with("dc1", "clusterA", "https", "serv2")
         obj.delete.assert_called_with()
 
 
@@ -136,11 +139,19 @@ class SyncerTestCase(TestCase):
         with mock.patch("conftool.cli.syncer.EntitySyncer") as mocker:
             obj = mock.Mock()
             mocker.return_value = obj
-            self.syncer.load()
+            with mock.patch("conftool.node.Node.update_index") as update_index:
+                self.syncer.load()
             for ent in ["unicorn", "pony", "node"]:
                 mocker.assert_any_call(ent, self.syncer.schema.entities[ent])
             obj.load_files.assert_called_with(self.fixtures_dir)
             obj.load.assert_called_with()
+            update_index.assert_called_once_with()
+            # A failure updating the index doesn't fail the sync, and leaves it stale
+            with mock.patch(
+                "conftool.node.Node.update_index", side_effect=BackendError("fail")
+            ), mock.patch("conftool.node.Node.invalidate_index") as invalidate_index:
+                self.syncer.load()
+            invalidate_index.assert_called_once_with()
 
     def test_load_broken_schema(self):
         """
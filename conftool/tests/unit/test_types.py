@@ -110,6 +110,10 @@ class SchemaRuleTestCase(TestCase):
         self.assertRaises(ValueError, t.validate, empty)
         invalid_data = {"height": 1, "nick": "bogus", "wins": 62}
         self.assertRaises(ValueError, t.validate, invalid_data)
+        # The validator is only built once
+        validator = t.validator
+        t.validate(valid_data)
+        self.assertIs(t.validator, validator)
 
 
 class JsonSchemaLoaderTestCase(TestCase):
@@ -136,12 +140,15 @@ class JsonSchemaLoaderTestCase(TestCase):
         )
         instance.match.return_value = True
         self.assertEqual(s.rules_for({"a": "foo", "b": "bar"}, "test"), [instance])
-        # Returns an empty list if nothing matches.
+        # Results are memoized
         instance.match.return_value = False
-        self.assertEqual(s.rules_for({"a": "foo", "b": "bar"}, "test"), [])
+        self.assertEqual(s.rules_for({"a": "foo", "b": "bar"}, "test"), [instance])
+        instance.match.assert_called_once_with({"a": "foo", "b": "bar"}, "test")
+        # Returns an empty list if nothing matches.
+        self.assertEqual(s.rules_for({"a": "foo", "b": "bar"}, "test2"), [])
         # exceptions are not caught
         instance.match.side_effect = ValueError("meh")
-        self.assertRaises(ValueError, s.rules_for, {"a": "foo", "b": "bar"}, "test")
+        self.assertRaises(ValueError, s.rules_for, {"a": "foo", "b": "bar"}, "test3")
 
     def test_get_json_schema(self):
         s = types.get_json_schema(
@@ -4,8 +4,6 @@ import logging
 import os
 import re
 
-import jsonschema
-
 
 _log = logging.getLogger(__name__)
 
@@ -103,10 +101,11 @@ class SchemaRule:
         for tag in selector.split(","):
             k, expr = tag.split("=", 1)
             # All our selector are anchored regexes
-            self.selectors[k] = "^{}$".format(expr)
+            self.selectors[k] = re.compile("^{}$".format(expr))
         self.path = schemaname
-        # This will be lazy-loaded if the rule gets ever invoked
+        # These will be lazy-loaded if the rule gets ever invoked
         self._schema = None
+        self._validator = None
 
     @property
     def schema(self):
@@ -115,6 +114,18 @@ class SchemaRule:
                 self._schema = json.load(fh)
         return self._schema
 
+    @property
+    def validator(self):
+        """The validator for the schema, checked and built only once."""
+        if self._validator is None:
+            # jsonschema is slow to import, and only needed by some entities
+            from jsonschema.validators import validator_for
+
+            validator_cls = validator_for(self.schema)
+            validator_cls.check_schema(self.schema)
+            self._validator = validator_cls(self.schema)
+        return self._validator
+
     def match(self, tags, name):
         """
         Match the rule against the provided taglist, which should include all tags
@@ -125,26 +136,29 @@ class SchemaRule:
             if tag not in self.selectors:
                 # if the tag is not in the selector, assume it's ok
                 continue
-            if not re.search(self.selectors[tag], value):
+            if not self.selectors[tag].search(value):
                 match = False
                 break
         if match and "name" in self.selectors:
-            match = re.search(self.selectors["name"], name) is not None
+            match = self.selectors["name"].search(name) is not None
 
         return match
 
     def validate(self, entity_data):
-        try:
-            jsonschema.validate(entity_data, self.schema)
-            return True
-        except jsonschema.exceptions.ValidationError as exc:
-            raise ValueError(exc.message)
+        from jsonschema.exceptions import best_match
+
+        # Report the same error jsonschema.validate() would.
+        error = best_match(self.validator.iter_errors(entity_data))
+        if error is not None:
+            raise ValueError(error.message)
+        return True
 
 
 class JsonSchemaLoader:
     def __init__(self, base_path="schemas", rules=None):
         self.base_path = base_path
         self.rules = []  # rules stack
+        self._rules_cache = {}  # (tags, name) => matching rules
         if rules is None:
             return
         for name, schema_def in rules.items():
@@ -153,7 +167,10 @@ class JsonSchemaLoader:
             self.rules.append(rule)
 
     def rules_for(self, tags, name):
-        return [rule for rule in self.rules if rule.match(tags, name)]
+        key = (tuple(tags.items()), name)
+        if key not in self._rules_cache:
+            self._rules_cache[key] = [rule for rule in self.rules if rule.match(tags, name)]
+        return self._rules_cache[key]
 
 
 def get_json_schema(schema_defs):
@@ -20,6 +20,7 @@ setup(
         "console_scripts": [
             "conftool-sync = conftool.cli.syncer:main",
             "confctl = conftool.cli.tool:main",
+            "conftool-server = conftool.cli.server:main",
             "dbctl = conftool.extensions.dbconfig:main [with_dbctl]",
             "requestctl = conftool.extensions.reqconfig:main [with_requestctl]",
         ],